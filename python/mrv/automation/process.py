@@ -10,6 +10,7 @@ import mrv.automation.base as wflbase
 
 from mrv.path import make_path
 from mrv.util import Or
+from mrv.enum import create as enum
 
 
 def track_output_call( func ):
@@ -47,7 +48,8 @@ class ProcessBase( NodeBase ):
         arguments accordingly
     """
     kNo, kGood, kPerfect = 0, 127, 255              # specify how good a certain target can be produced
-    is_state, target_state, dirty_check = ( 1,2,4 )
+    eEvalMode = enum( "is_state", "target_state", "dirty_check", bitflag = True )    # bits of the evaluation mode
+    is_state, target_state, dirty_check = eEvalMode
 
     noun = "Noun ProcessBase,redefine in subclass"  # used in reports
     verb = "Verb ProcessBase,redefine in subclass" # used in reports
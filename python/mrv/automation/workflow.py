@@ -5,6 +5,7 @@ __docformat__ = "restructuredtext"
 import networkx as nx
 from mrv.dge import Graph, ComputeError
 import time
+import os
 import weakref
 import traceback
 import logging
@@ -48,6 +49,31 @@ class DirtyException( Exception ):
 
 #} END exceptions
 
+#{ Utilities
+
+# workflow and target groups of the currently running batch, inherited by forked workers
+_batchjob = None
+
+def _targetErrorMessage( exc ):
+    """:return: message describing the exception exc raised while making a target
+    :note: must be called from within the except clause handling exc"""
+    if isinstance( exc, ComputeError ):
+        return str( exc ) + "\n"
+    msg = "--> UNHANDLED EXCEPTION: " + str( exc ) + "\n"
+    msg += traceback.format_exc( )
+    return msg
+
+def _makeTargetGroupInWorker( groupindex ):
+    """Make the target group at the given index of the current batch job
+    
+    :return: tuple( groupindex, list of error messages or None for each target of the group )
+    :note: runs in a forked worker process"""
+    wfl, groups = _batchjob
+    route, targets = groups[ groupindex ]
+    return ( groupindex, wfl._makeTargetGroup( route, targets ) )
+
+#} END utilities
+
 #####################
 ## CLASSES    ######
 ###################
@@ -135,6 +161,15 @@ class Workflow( Graph ):
             lastprocessdata.endtime = time.clock( )
             lastprocessdata.setResult( result )
 
+        def clear( self ):
+            """Remove all calls, preparing the instance for the next target
+            
+            :note: clears in place as nested workflows share our instance"""
+            super( Workflow.CallGraph, self ).clear( )
+            self.name = "Callgraph"
+            del( self._call_stack[:] )
+            self._root = None
+
         def callRoot( self ):
             """:return: root at which the call started"""
             return self._root
@@ -216,45 +251,135 @@ class Workflow( Graph ):
         shell, result = self._evaluate( target, processmode, globalmode )
         return result
 
-    def makeTargets( self, targetList, errstream=None, donestream=None ):
+    def makeTargets( self, targetList, errstream=None, donestream=None, batch=False, workers=0 ):
         """batch module compatible method allowing to make mutliple targets at once
         
         :param targetList: iterable providing the targets to make
         :param errstream: object with file interface allowing to log errors that occurred
             during operation
         :param donestream: if list, targets successfully done will be appended to it, if
-            it is a stream, the string representation will be wrtten to it"""
-        def to_stream(msg, stream):
-            """print msg to stream or use the logger instead"""
-            if stream:
-                stream.write( msg )
-            else:
-                log.info(msg)
-            # END errstream handling
-        # END utility
+            it is a stream, the string representation will be wrtten to it
+        :param batch: if True, targets will be grouped by the input and output shells
+            used to make them. The processes are prepared only once per group instead 
+            of once per target.
+            Targets are reported in group order then.
+        :param workers: if larger than 1, groups will be made by the given amount of
+            forked worker processes, which implies batch mode. Results are only reported
+            back to the errstream and donestream, changes the processes make to the
+            workflow remain in the workers. Falls back to making the groups serially
+            if the platform cannot fork"""
+        if batch or workers > 1:
+            return self._makeTargetsBatched( targetList, errstream, donestream, workers )
             
         for target in targetList:
+            errmsg = None
             try:
                 self.makeTarget( target )
-            except ComputeError,e:
-                to_stream(str( e ) + "\n", errstream)
             except Exception, e:
-                # except all
-                msg = "--> UNHANDLED EXCEPTION: " + str( e ) + "\n"
-                msg += traceback.format_exc( )
-                to_stream(msg, errstream)
-            if donestream is None:
-                continue
+                errmsg = _targetErrorMessage( e )
+            self._reportTarget( target, errmsg, errstream, donestream )
+        # END for each target
 
-            # all clear, put item to done list
-            if hasattr( donestream, "write" ):
-                donestream.write( str( target ) + "\n" )
+    def _reportTarget( self, target, errmsg, errstream, donestream ):
+        """Write the result of making target into the streams as described by `makeTargets`
+        
+        :param errmsg: error message, or None if target was made successfully"""
+        if errmsg is not None:
+            if errstream:
+                errstream.write( errmsg )
             else:
-                # assume its a list
-                donestream.append( target )
-        # END for each target
+                log.info(errmsg)
+            # END errstream handling
+        # END handle error
+        
+        if donestream is None:
+            return
 
+        # all clear, put item to done list
+        if hasattr( donestream, "write" ):
+            donestream.write( str( target ) + "\n" )
+        else:
+            # assume its a list
+            donestream.append( target )
+
+    def _makeTargetsBatched( self, targetList, errstream, donestream, workers ):
+        """Implements the batch mode of `makeTargets`"""
+        # GROUP BY ROUTE
+        ################
+        # the route is resolved per target as targetRating implementations may rate
+        # targets by value, which is cheap compared to their evaluation
+        groups = list()
+        routes = dict()             # route -> index into groups
+        for target in targetList:
+            try:
+                route = self._resolveRoute( target )
+            except Exception, e:
+                self._reportTarget( target, _targetErrorMessage( e ), errstream, donestream )
+                continue
+            # END handle unsupported targets
+            
+            index = routes.get( route )
+            if index is None:
+                index = routes[ route ] = len( groups )
+                groups.append( ( route, list() ) )
+            # END create group
+            groups[ index ][ 1 ].append( target )
+        # END for each target
+        
+        # MAKE GROUPS
+        #############
+        if workers > 1 and len( groups ) > 1 and hasattr( os, "fork" ):
+            global _batchjob
+            import multiprocessing
+            _batchjob = ( self, groups )
+            pool = multiprocessing.Pool( min( workers, len( groups ) ) )
+            try:
+                for index, errmsgs in pool.imap_unordered( _makeTargetGroupInWorker, range( len( groups ) ) ):
+                    for target, errmsg in zip( groups[ index ][ 1 ], errmsgs ):
+                        self._reportTarget( target, errmsg, errstream, donestream )
+                # END for each finished group
+            finally:
+                pool.terminate()
+                _batchjob = None
+            # END assure pool and job are cleaned up
+            return
+        # END use workers
+        
+        for route, targets in groups:
+            for target, errmsg in zip( targets, self._makeTargetGroup( route, targets ) ):
+                self._reportTarget( target, errmsg, errstream, donestream )
+        # END for each group
 
+    def _makeTargetGroup( self, route, targets ):
+        """Make all targets using the given route, preparing the processes only once
+        
+        :param route: tuple( inputshell, outputshell ) as returned by `_resolveRoute`
+        :return: list of error messages, or None for each target that could be made"""
+        import process
+        pb = process.ProcessBase
+        processmode = globalmode = pb.is_state | pb.target_state
+        inputshell, outputshell = route
+        
+        self._clearState( globalmode )
+        for node in self.iterNodes( ):
+            node.prepareProcess( )
+        # END prepare processes
+        
+        errmsgs = list()
+        for target in targets:
+            errmsg = None
+            self._callgraph.clear()
+            try:
+                inputshell.set( target, ignore_connection = True )
+                outputshell.get( processmode )
+                if len( self._callgraph._call_stack ):
+                    raise AssertionError( "Callstack was not empty after calculations for %r where done" % target )
+            except Exception, e:
+                errmsg = _targetErrorMessage( e )
+            # END handle errors
+            errmsgs.append( errmsg )
+        # END for each target
+        return errmsgs
 
     def _evaluateDirtyState( self, outputplug, processmode ):
         """Evaluate the given plug in process mode and return a dirty report tuple
@@ -353,6 +478,24 @@ class Workflow( Graph ):
         # END reset dg handling
 
 
+        outputshell = self._findOutputShell( inputshell, target )
+
+        # we do not care about ambiguity, simply pull one
+        # QUESTION: should we warn about multiple affected plugs ?
+        inputshell.set( target, ignore_connection = True )
+        return outputshell
+
+    def _resolveRoute( self, target ):
+        """:return: tuple( inputshell, outputshell ) to be used to make the given target
+        :raise TargetError: if target cannot be handled"""
+        inputshell = self.targetRating( target )[1]
+        if inputshell is None:
+            raise TargetError( "Cannot handle target %r" % target )
+        return ( inputshell, self._findOutputShell( inputshell, target ) )
+
+    def _findOutputShell( self, inputshell, target ):
+        """:return: shell that can be queried to get target once it was set into inputshell
+        :raise TypeError: if no such shell could be found"""
         # OUTPUT SHELL HANDLING
         #########################
         # Find a shell that we can query to trigger the graph to evaluate
@@ -406,9 +549,6 @@ class Workflow( Graph ):
         if not outputshell:
             raise TypeError( "Target %s cannot be handled by this workflow (%s) as a computable output for %s cannot be found" % ( target, self, str( inputshell ) ) )
 
-        # we do not care about ambiguity, simply pull one
-        # QUESTION: should we warn about multiple affected plugs ?
-        inputshell.set( target, ignore_connection = True )
         return outputshell
 
 
@@ -6,51 +6,103 @@ from the commandline, possibly wrapped by a shell script to specialize its usae
 """
 import sys,os
 import signal
+import traceback
 from collections import deque
+import itertools
 import subprocess
+import threading
+import Queue
 import time
 
 # module is supposed to be used as standalone program - we prevent from x import *
 __all__ = None
 
-def superviseJobs( jobs, returnIfLessThan, cmdinput, errorstream, donestream ):
-    """Check on the jobs we have and wait for finished ones. Write information
-    about them into the respective streams
-    :param returnIfLessThan: return once we have less than the given amount of running jobs"""
-    sleeptime = 1.0      # wait one second in the main loop before checking the processes
+# marks the end of the input in the event queue of processStream
+_eof = object()
 
-    if not jobs:
-        return
+# seconds to block on queues at once - blocking indefinitely would prevent 
+# KeyboardInterrupts from being delivered
+_waitTimeout = 3600.0
 
-    while True:
-
-        jobscp = jobs[:]            # are going to alter the jobs queue
-        for process in jobscp:
-            # check if subprocess is done
-            if process.poll() == None:
-                continue
-
-            # pop the process off the queue
-            jobs.remove( process )
-
-            # the process finished - get the stderr
-            if errorstream:
-                errorstream.writelines( process.stderr.readlines() )
-                errorstream.flush()
-
-            # append to the done list only if there is no error
-            if donestream is not None and process.returncode == 0:
-                donestream.writelines( "\n".join( cmdinput ) + "\n" )
-                donestream.flush()
+def _watchProcess( process, finished ):
+    """Drain the stderr of process until it exits, then put it into the finished queue.
+    This way children writing a lot of errors will never block on a full pipe"""
+    process.errlines = process.stderr.readlines()       # returns once the pipe closes
+    process.wait()
+    process.endtime = time.time()
+    finished.put( process )
 
-            # can we return ?
-            if len( jobs ) < returnIfLessThan:
-                return
-
-        # END for each job
-
-        time.sleep( sleeptime )
-    # END endless loop
+def _readInput( inputStream, events ):
+    """Put the stripped, non-empty lines or items of inputStream into the events queue
+    as they arrive, followed by the _eof marker"""
+    try:
+        if hasattr( inputStream, 'readline' ):
+            # iterating files directly reads ahead, which would prevent streaming
+            inputStream = iter( inputStream.readline, '' )
+        # END handle files
+        for item in inputStream:
+            item = item.strip()
+            if item:
+                events.put( item )
+        # END for each item
+    finally:
+        events.put( _eof )
+
+def startJob( cmd, args, cmdinput, finished ):
+    """Launch cmd with args and cmdinput appended to it
+    
+    :param cmdinput: list of input strings, they will be passed into the stdin of the process as well
+    :param finished: Queue receiving the process once it exited
+    :return: the started process. Its cmdinput member holds the input it received"""
+    callcmd = (cmd,)+tuple(args)+tuple(cmdinput)
+    process = subprocess.Popen( callcmd,stderr=subprocess.PIPE, stdin=subprocess.PIPE, env=os.environ )
+    process.cmdinput = cmdinput
+    process.errlines = list()
+    process.starttime = process.endtime = time.time()
+
+    # fill our input argumets additionally to stdin
+    try:
+        process.stdin.writelines( '\n'.join( cmdinput ) )
+        process.stdin.flush()
+        process.stdin.close()
+    except IOError:
+        pass    # could be closed already
+
+    watcher = threading.Thread( target=_watchProcess, args=( process, finished ) )
+    watcher.setDaemon( True )
+    watcher.start()
+    return process
+
+def superviseJobs( jobs, returnIfLessThan, finished, errorstream, donestream ):
+    """Wait for finished jobs and write information about them into the respective streams.
+    Returns as soon as enough jobs finished, there is no polling interval
+    
+    :param jobs: list of processes started with `startJob`
+    :param returnIfLessThan: return once we have less than the given amount of running jobs
+    :param finished: the queue the jobs were started with"""
+    while len( jobs ) >= returnIfLessThan and jobs:
+        try:
+            process = finished.get( True, _waitTimeout )
+        except Queue.Empty:
+            continue        # jobs are still running
+        # END handle timeout
+        if process not in jobs:
+            continue        # job was killed and dropped
+        jobs.remove( process )
+        _reportJob( process, errorstream, donestream )
+    # END while we have to wait
+
+def _reportJob( process, errorstream, donestream ):
+    """Write information about the finished process into the respective streams"""
+    # the process finished - get the stderr
+    if errorstream:
+        errorstream.writelines( process.errlines )
+        errorstream.flush()
+
+    # append to the done list only if there is no error
+    if donestream is not None and process.returncode == 0:
+        donestream.writelines( "\n".join( process.cmdinput ) + "\n" )
+        donestream.flush()
 
 def killProcess( process ):
     """Kill the given process
@@ -77,23 +129,12 @@ def process( cmd, args, inputList, errorstream = None, donestream = None, inputs
     """
     # very simple for now - just get the input together and call the cmd
     jobs = list()
+    finished = Queue.Queue()
     numInputs = len( inputList )
     for i in range( 0, numInputs, inputsPerProcess ):
 
         cmdinput = inputList[ i : i + inputsPerProcess ]    # deals with bounds
-        callcmd = (cmd,)+tuple(args)+tuple(cmdinput)
-        process = subprocess.Popen( callcmd,stderr=subprocess.PIPE, stdin=subprocess.PIPE, env=os.environ )
-
-        jobs.append( process )
-
-        # fill our input argumets additionally to stdin
-        try:
-            process.stdin.writelines( '\n'.join( cmdinput ) )
-            process.stdin.flush()
-            process.stdin.close()
-        except IOError:
-            pass    # could be closed already
-
+        jobs.append( startJob( cmd, args, cmdinput, finished ) )
 
         # get another job ?
         if len( jobs ) < numJobs:
@@ -105,7 +146,7 @@ def process( cmd, args, inputList, errorstream = None, donestream = None, inputs
 
         # we have a full queue now - get a new one asap
         try:
-            superviseJobs( jobs, numJobs, cmdinput, errorstream, donestream )
+            superviseJobs( jobs, numJobs, finished, errorstream, donestream )
         except KeyboardInterrupt:
             # kill all processes - we do not know which one hangs
             for process in jobs:
@@ -115,23 +156,286 @@ def process( cmd, args, inputList, errorstream = None, donestream = None, inputs
     # END for each chunk of inputs
 
     # queue is empty, finalize our pending jobs
-    superviseJobs( jobs, 1, list(), errorstream, donestream )
+    superviseJobs( jobs, 1, finished, errorstream, donestream )
+
+def processStream( cmd, args, inputStream, errorstream = None, donestream = None, inputsPerProcess = 1,
+                   numJobs = 1, jobDuration = None, maxInputsPerProcess = 100 ):
+    """Launch process at cmd with args for inputs read from inputStream while they arrive.
+    Jobs are started as soon as enough inputs are available and a job slot is free.
+    
+    :param inputStream: file like object providing newline separated inputs, or any other
+        iterable yielding input strings. It is read in a separate thread
+    :param inputsPerProcess: amount of inputs to pass to each invocation of cmd. If
+        jobDuration is set, this is the amount used until the first job finished
+    :param jobDuration: if not None, the amount of seconds each job should take. The amount
+        of inputs per job will be adjusted according to the measured time per input, which
+        helps to amortize the startup time of cmd
+    :param maxInputsPerProcess: the maximum amount of inputs per job when adjusting it
+    :note: for all other arguments, see `process`"""
+    events = Queue.Queue()              # receives input strings and finished processes
+    reader = threading.Thread( target=_readInput, args=( inputStream, events ) )
+    reader.setDaemon( True )
+    reader.start()
+
+    jobs = list()
+    pending = deque()
+    exhausted = False
+    timePerInput = None
+    while True:
+        # START JOBS
+        ############
+        while pending and len( jobs ) < numJobs:
+            chunksize = inputsPerProcess
+            if jobDuration is not None and timePerInput:
+                chunksize = min( max( int( jobDuration / timePerInput ), 1 ), maxInputsPerProcess )
+            # END adjust chunksize
+
+            if exhausted:
+                # spread the remaining inputs among all free slots
+                numFree = numJobs - len( jobs )
+                chunksize = min( chunksize, ( len( pending ) + numFree - 1 ) / numFree )
+            elif len( pending ) < chunksize and jobs:
+                break       # wait for more input, nothing runs idle
+            # END handle chunksize
+
+            cmdinput = [ pending.popleft() for i in range( min( chunksize, len( pending ) ) ) ]
+            jobs.append( startJob( cmd, args, cmdinput, events ) )
+        # END for each free job slot
+
+        if exhausted and not pending and not jobs:
+            break
+
+        # WAIT FOR EVENTS
+        #################
+        try:
+            item = events.get( True, _waitTimeout )
+        except Queue.Empty:
+            continue        # jobs are still running
+        except KeyboardInterrupt:
+            # kill all processes - we do not know which one hangs
+            for process in jobs:
+                killProcess( process )
+            jobs = list()
+            sys.stdout.write("Aborted all running processes - continuing\n")
+            continue
+        # END handle interrupts
+
+        if item is _eof:
+            exhausted = True
+        elif isinstance( item, basestring ):
+            pending.append( item )
+        elif item in jobs:
+            jobs.remove( item )
+            _reportJob( item, errorstream, donestream )
+
+            # update running average of the time it takes to process an input
+            elapsed = ( item.endtime - item.starttime ) / len( item.cmdinput )
+            if timePerInput is None:
+                timePerInput = elapsed
+            else:
+                timePerInput = ( timePerInput + elapsed ) / 2.0
+        # END handle event
+    # END event loop
+
+#{ Resident Workers
+
+def _memoryUsage( ):
+    """:return: peak memory usage of this process in bytes, or 0 if it is unknown"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # END handle platforms without resource module
+    usage = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform != 'darwin':
+        usage *= 1024       # linux reports kilobytes
+    return usage
+
+def _importCallable( name ):
+    """:return: callable at the given import path, like package.module.function"""
+    modulename, attrname = name.rsplit( '.', 1 )
+    module = __import__( modulename, globals(), locals(), [ attrname ] )
+    return getattr( module, attrname )
+
+def serveItems( func, instream, outstream, maxMemory = 0 ):
+    """Call func for each newline separated item read from instream until it is depleted.
+    Runs within resident worker processes.
+    
+    For each item, a reply is written into outstream, consisting of a header line
+    'status recycle numbytes' followed by numbytes of error text. Status is 0 if func
+    succeeded, recycle is 1 if the worker will exit after the reply.
+    
+    :param maxMemory: if not 0, the worker stops serving once its memory usage in bytes
+        exceeds the given amount"""
+    for item in iter( instream.readline, '' ):
+        item = item.rstrip( '\n' )
+        status, payload = 0, ''
+        try:
+            func( item )
+        except Exception:
+            status, payload = 1, traceback.format_exc()
+        # END handle errors
+
+        recycle = maxMemory and _memoryUsage() > maxMemory
+        outstream.write( "%i %i %i\n%s" % ( status, int( bool( recycle ) ), len( payload ), payload ) )
+        outstream.flush()
+        if recycle:
+            break
+    # END for each item
+
+def _serveMain( callableName, maxMemory = 0 ):
+    """Entry point of resident worker processes, serving items passed in via stdin"""
+    # our own directory would shadow standard modules, like thread
+    if sys.path and os.path.abspath( sys.path[0] ) == os.path.dirname( os.path.abspath( __file__ ) ):
+        del( sys.path[0] )
+    # END fix sys.path
+
+    # the protocol uses stdout - everything func prints goes to stderr instead
+    outstream = os.fdopen( os.dup( sys.stdout.fileno() ), 'w' )
+    os.dup2( sys.stderr.fileno(), sys.stdout.fileno() )
+    serveItems( _importCallable( callableName ), sys.stdin, outstream, maxMemory )
+
+def _startResidentWorker( cmd, args, callableName, maxMemory ):
+    """:return: process running our worker entry point using cmd, which must be a python interpreter"""
+    script = os.path.splitext( os.path.abspath( __file__ ) )[0] + ".py"
+    callcmd = (cmd,)+tuple(args)+( script, "-W", callableName, str( maxMemory ) )
+    return subprocess.Popen( callcmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=os.environ )
+
+def _stopResidentWorker( process ):
+    """Close the input of the given worker and wait for it to exit"""
+    try:
+        process.stdin.close()
+    except IOError:
+        pass
+    process.wait()
+
+def _residentWorkerLoop( cmd, args, callableName, items, results, maxItems, maxMemory ):
+    """Pass items to a resident worker one by one and put tuple( item, errormessage|None )
+    into the results queue. Workers are restarted once they handled maxItems, or if they
+    exceeded their memory or died. Puts _eof into results once items are depleted"""
+    process = None
+    numItems = 0
+    try:
+        while True:
+            item = items.get()
+            if item is _eof:
+                items.put( _eof )       # let the other loops know as well
+                break
+            # END handle end of input
+
+            if process is None:
+                process = _startResidentWorker( cmd, args, callableName, maxMemory )
+                numItems = 0
+            # END start worker
+
+            header = ''
+            try:
+                process.stdin.write( item + "\n" )
+                process.stdin.flush()
+                header = process.stdout.readline()
+            except IOError:
+                pass
+            # END communicate
+
+            if not header:
+                results.put( ( item, "Resident worker process died while processing %r\n" % item ) )
+                _stopResidentWorker( process )
+                process = None
+                continue
+            # END handle dead worker
+
+            status, recycle, numbytes = [ int( v ) for v in header.split() ]
+            payload = process.stdout.read( numbytes )
+            results.put( ( item, ( status and payload ) or None ) )
+
+            numItems += 1
+            if recycle or ( maxItems and numItems >= maxItems ):
+                _stopResidentWorker( process )
+                process = None
+            # END recycle worker
+        # END for each item
+    finally:
+        if process is not None:
+            _stopResidentWorker( process )
+        results.put( _eof )
+    # END assure results are complete
+
+def processResident( cmd, args, callableName, inputStream, errorstream = None, donestream = None,
+                     numJobs = 1, maxItemsPerWorker = 0, maxMemory = 0 ):
+    """Make the given amount of long-lived python interpreters call the callable at callableName
+    for each input read from inputStream. This amortizes the startup time of cmd, which
+    can be considerable in case of mayapy.
+    
+    :param cmd: python interpreter to run the workers with, like mayapy
+    :param args: arguments to pass to cmd before our worker script
+    :param callableName: import path of a callable taking an input string, like package.module.function.
+        An input is considered done if the callable does not raise
+    :param inputStream: file like object or iterable providing the inputs, see `processStream`
+    :param maxItemsPerWorker: if not 0, workers will be restarted after handling the given amount of inputs
+    :param maxMemory: if not 0, workers will be restarted once their memory usage exceeds the
+        given amount of bytes
+    :note: for all other arguments, see `process`"""
+    items = Queue.Queue()
+    results = Queue.Queue()
+    reader = threading.Thread( target=_readInput, args=( inputStream, items ) )
+    reader.setDaemon( True )
+    reader.start()
+
+    for i in range( numJobs ):
+        loop = threading.Thread( target=_residentWorkerLoop, args=( cmd, args, callableName, items, results,
+                                                                     maxItemsPerWorker, maxMemory ) )
+        loop.setDaemon( True )
+        loop.start()
+    # END for each job
+
+    numRunning = numJobs
+    while numRunning:
+        try:
+            result = results.get( True, _waitTimeout )
+        except Queue.Empty:
+            continue        # items are still being processed
+        # END handle timeout
+        if result is _eof:
+            numRunning -= 1
+            continue
+        # END handle finished loops
+
+        item, errmsg = result
+        if errmsg is not None:
+            if errorstream:
+                errorstream.write( errmsg )
+                errorstream.flush()
+        elif donestream is not None:
+            donestream.write( item + "\n" )
+            donestream.flush()
+        # END report item
+    # END while worker loops are running
+
+#} END resident workers
 
 
 #{ Command Line Tool
 
 def _usageAndExit( msg = None ):
     """Print usage"""
-    sys.stdout.write("""python batch.py inputarg [inputarg ...] [-E fileForErrors|-] [-D fileForFinishedOutput|-] [-s numInputsPerProcess] -e cmd [cmdArg ...]
+    sys.stdout.write("""python batch.py inputarg [inputarg ...] [-E fileForErrors|-] [-D fileForFinishedOutput|-] [-s numInputsPerProcess] [-j numJobs] [-I] [-t secondsPerProcess] [-r callable [-n numInputsPerWorker] [-m megabytesPerWorker]] -e cmd [cmdArg ...]
 -E|D -  means to use the default stream, either stderr or stdout
 -I  if specified, arguments will also be read from stdin until it is depleted as
     newline separated list of names
-    Its particlularly important that the pipe to stdin closes once its done as
-    this command currently does not support streaming of input args
+    Jobs will be started while the input is still arriving, so its possible to
+    pipe in the output of long running commands
+-t  the amount of seconds each process should run. The amount of inputs per process
+    will be adjusted to meet it, starting at the value given by -s
 -e  ends the parsing of commandline arguments for the batch process tool
     and uses the rest of the commandline as direct input for your command
 -s  defines how many input arguments will be passed per command invocation
 -j  the number of processes to keep running in parallel, default 1
+-r  import path of a python callable, like package.module.function. Enables the resident
+    worker mode: cmd must be a python interpreter, like mayapy, and -j instances of it
+    will call the callable for each input, which is passed as single argument
+-n  resident workers will be restarted after handling the given amount of inputs
+-m  resident workers will be restarted once they used more than the given amount of
+    megabytes of memory
 
     The given inputargs will be passed as arguments to the commands or into
     the standardinput of the process""")
@@ -169,6 +473,11 @@ def main( *args ):
     if not args:
         _usageAndExit( )
 
+    # RESIDENT WORKER
+    if args[0] == "-W":
+        return _serveMain( args[1], int( args[2] ) )
+    # END worker entry point
+
     inputList = list()
     streams = list( ( None, None ) )
 
@@ -177,6 +486,10 @@ def main( *args ):
     cmd = None
     cmdargs = list()
     haveReadInput = False
+    jobDuration = None
+    callableName = None
+    maxItemsPerWorker = 0
+    maxMemory = 0
 
 
     # PARSE ARGUMENTS
@@ -229,6 +542,39 @@ def main( *args ):
                 _usageAndExit( msg )
         # END -s
 
+        if flagfound: continue
+        if arg == "-t":
+            msg = "-t must be followed by a number > 0"
+            try:
+                jobDuration = float( _popleftchecked( argv, msg ) )
+            except ValueError:
+                _usageAndExit( msg )
+            flagfound = True
+            if jobDuration <= 0:
+                _usageAndExit( msg )
+        # END -t
+
+        if flagfound: continue
+
+        if arg == "-r":
+            callableName = _popleftchecked( argv, "-r must be followed by the import path of a callable" )
+            continue
+        # END -r
+
+        for flag, msg in ( ( "-n", "-n must be followed by a number > 0" ),
+                           ( "-m", "-m must be followed by a number of megabytes > 0" ) ):
+            if arg != flag:
+                continue
+            value = int( _popleftchecked( argv, msg ) )
+            if value < 1:
+                _usageAndExit( msg )
+            if flag == "-n":
+                maxItemsPerWorker = value
+            else:
+                maxMemory = value * 1024 * 1024
+            flagfound = True
+        # END for each resident worker flag
+
         if flagfound: continue
 
         # INPUT ARGUMENTS FROM STDIN
@@ -238,9 +584,7 @@ def main( *args ):
                 _usageAndExit( "-I may only be specified once" )
 
             haveReadInput = True
-            # read stripped lines from stdin
-            inputList.extend( ( l.strip() for l in  sys.stdin.readlines() ) )
-        # END -s
+        # END -I
 
         if flagfound: continue
 
@@ -255,7 +599,20 @@ def main( *args ):
 
 
     # have everything, transfer control to the actual batch method
-    process( cmd, cmdargs, inputList, streams[0], streams[1], inputsPerProcess, numJobs )
+    inputStream = inputList
+    if haveReadInput:
+        inputStream = itertools.chain( inputList, iter( sys.stdin.readline, '' ) )
+    # END stream stdin
+
+    if callableName:
+        processResident( cmd, cmdargs, callableName, inputStream, streams[0], streams[1], numJobs,
+                         maxItemsPerWorker, maxMemory )
+    elif haveReadInput or jobDuration is not None:
+        processStream( cmd, cmdargs, inputStream, streams[0], streams[1], inputsPerProcess,
+                        numJobs, jobDuration )
+    else:
+        process( cmd, cmdargs, inputList, streams[0], streams[1], inputsPerProcess, numJobs )
+    # END handle streaming
 
 
 
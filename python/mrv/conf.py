@@ -25,6 +25,8 @@ from ConfigParser import (  RawConfigParser,
                             ParsingError)
 from exc import MRVError
 import copy
+import cPickle
+import hashlib
 import re
 import sys
 import StringIO
@@ -52,6 +54,80 @@ class ConfigParsingPropertyError(ConfigParsingError):
 
 
 
+#{ Utilities
+
+# increment if the pickled configuration structures or the cache keys change
+_cacheversion = 2
+
+def _cacheKey(fileobjects):
+    """:return: key identifying the given file objects in their current state, or None
+        if they cannot be identified as they are not all `ConfigFile` instances
+    :note: the key uses digests of the file contents as modification times 
+        might not change if files are changed quickly"""
+    key = [_cacheversion]
+    for fp in fileobjects:
+        if not isinstance(fp, ConfigFile):
+            return None
+        name = fp.name()
+        cfp = open(name, 'rb')
+        try:
+            digest = hashlib.md5(cfp.read()).hexdigest()
+        finally:
+            cfp.close()
+        # END assure file is closed
+        key.append((os.path.abspath(name), digest))
+    # END for each file object
+    return tuple(key)
+    
+def _readCache(cachepath, key):
+    """:return: the data stored under the given key in the cache at cachepath, or None
+        if it does not exist or is outdated"""
+    if key is None or not os.path.isfile(cachepath):
+        return None
+    try:
+        fp = open(cachepath, 'rb')
+        try:
+            cachedkey, data = cPickle.load(fp)
+        finally:
+            fp.close()
+    except Exception:
+        log.debug("Failed to read configuration cache at %s: %s" % (cachepath, sys.exc_info()[1]))
+        return None
+    # END handle corrupt or unreadable caches
+    
+    if cachedkey != key:
+        return None
+    return data
+    
+def _writeCache(cachepath, key, data):
+    """Write data under the given key into the cache at cachepath. As other processes 
+    might read the cache at the same time, a temporary file is renamed into place.
+    Failures are ignored"""
+    if key is None:
+        return
+    tmppath = "%s.%i.tmp" % (cachepath, os.getpid())
+    try:
+        fp = open(tmppath, 'wb')
+        try:
+            cPickle.dump((key, data), fp, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        # END assure file is closed
+        
+        if os.name == 'nt' and os.path.exists(cachepath):
+            os.remove(cachepath)
+        os.rename(tmppath, cachepath)
+    except (IOError, OSError, cPickle.PicklingError):
+        log.debug("Failed to write configuration cache at %s: %s" % (cachepath, sys.exc_info()[1]))
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+    # END ignore errors
+
+#} END utilities
+
+
 #{ INI File Converters
 ################################################################################
 # Wrap arbitary sources and implicitly convert them to INI files when read
@@ -138,11 +214,13 @@ class ConfigAccessor(object):
         Their keys and values are used to further define key merging behaviour for example
         
     :note: The configaccessor should only be used in conjunction with the `ConfigManager`"""
-    __slots__ = "_configChain"
+    __slots__ = ("_configChain", "_keyIndex", "_sectionIndex")
 
     def __init__(self):
         """ Initialize instance variables """
         self._configChain = ConfigChain()  # keeps configuration from different sources
+        self._keyIndex = None               # keyname -> [(key, section, node), ...] in chain order
+        self._sectionIndex = None           # sectionname -> [(section, node), ...] in chain order
 
     def __repr__(self):
         stream = ConfigStringIO()
@@ -164,6 +242,95 @@ class ConfigAccessor(object):
             tokens.insert(0, None)
         return tokens
 
+    def _setChain(self, chain):
+        """Use the given configuration chain, and discard our index"""
+        for node in self._configChain:
+            if node._accessor is self:
+                node._accessor = None
+        # END detach previous nodes
+        self._configChain = chain
+        self._keyIndex = None
+        self._sectionIndex = None
+
+    def _sectionSets(self):
+        """:return: list of the section sets of our nodes, which can be pickled and
+            used with `_setSectionSets`"""
+        return [node._sections for node in self._configChain]
+        
+    def _setSectionSets(self, fileobjects, sectionsets):
+        """Initialize our chain with nodes using the given file-like objects and their 
+        sections, as previously obtained by `_sectionSets`"""
+        chain = ConfigChain()
+        for fp, sections in zip(fileobjects, sectionsets):
+            node = ConfigNode(fp)
+            node._sections = sections
+            for section in sections:
+                section._node = node
+            chain.append(node)
+        # END for each file object
+        self._setChain(chain)
+
+    #{ Index
+    
+    def _index(self):
+        """:return: tuple(keyindex, sectionindex), build them if required
+        :note: the nodes of our chain inform us about new sections and keys 
+            once the index exists, which keeps it up to date"""
+        if self._keyIndex is None:
+            keyindex = dict()
+            sectionindex = dict()
+            for node in self._configChain:
+                node._accessor = self
+                for section in node._sections:
+                    sectionindex.setdefault(section.name, list()).append((section, node))
+                    for key in section.keys:
+                        keyindex.setdefault(key.name, list()).append((key, section, node))
+                # END for each section
+            # END for each node
+            self._keyIndex = keyindex
+            self._sectionIndex = sectionindex
+        # END build index
+        return (self._keyIndex, self._sectionIndex)
+        
+    def _insertIndexEntry(self, index, name, entry):
+        """Insert entry into the list of entries of name in index, keeping the order
+        of nodes in our chain. The node must be the last item of the entry tuple"""
+        positions = dict((id(node), i) for i, node in enumerate(self._configChain))
+        pos = positions.get(id(entry[-1]))
+        if pos is None:
+            return
+        entries = index.setdefault(name, list())
+        i = len(entries)
+        while i and positions[id(entries[i-1][-1])] > pos:
+            i -= 1
+        entries.insert(i, entry)
+        
+    def _sectionAdded(self, section, node):
+        """Called by our nodes once they created a new section"""
+        if self._sectionIndex is None:
+            return
+        self._insertIndexEntry(self._sectionIndex, section.name, (section, node))
+        for key in section.keys:
+            self._keyAdded(key, section, node)
+        # END for each key
+        
+    def _keyAdded(self, key, section, node):
+        """Called by the sections of our nodes once they created a new key"""
+        if self._keyIndex is None:
+            return
+        self._insertIndexEntry(self._keyIndex, key.name, (key, section, node))
+        
+    def _keyRemoved(self, key, section):
+        """Called by the sections of our nodes once a key was removed"""
+        if self._keyIndex is None:
+            return
+        entries = self._keyIndex.get(key.name)
+        if not entries:
+            return
+        entries[:] = [e for e in entries if e[1] is not section]
+        
+    #} END index
+
     def _parseProperties(self):
         """Analyse the freshly parsed configuration chain and add the found properties
         to the respective sections and keys
@@ -264,12 +431,12 @@ class ConfigAccessor(object):
                     fp.close()
 
         # keep the chain - no error so far
-        self._configChain = tmpchain
+        self._setChain(tmpchain)
 
         try:
             self._parseProperties()
         except ConfigParsingPropertyError:
-            self._configChain = ConfigChain()   # undo changes and reraise
+            self._setChain(ConfigChain())   # undo changes and reraise
             raise
 
     def write(self, close_fp=True):
@@ -314,8 +481,10 @@ class ConfigAccessor(object):
         :return: Flattened copy of self"""
         # create config node
         ca = ConfigAccessor()
-        ca._configChain.append(ConfigNode(fp))
-        cn = ca._configChain[0]
+        cn = ConfigNode(fp)
+        chain = ConfigChain()
+        chain.append(cn)
+        ca._setChain(chain)
 
         # transfer copies of sections and keys - requires knowledge of internal
         # data strudctures
@@ -372,9 +541,9 @@ class ConfigAccessor(object):
             `flatten` ed list.
             
         :raise NoSectionError: if the requested section name does not exist """
-        for node in self._configChain:
-            if section in node._sections:
-                return node.section(section)
+        entries = self._index()[1].get(section)
+        if entries:
+            return entries[0][0]
 
         raise NoSectionError(section)
 
@@ -392,11 +561,12 @@ class ConfigAccessor(object):
     def keysByName(self, name):
         """:param name: the name of the key you wish to find
         :return: List of  (`Key`,`Section`) tuples of key(s) matching name found in section, or empty list"""
-        return list(self.iterateKeysByName(name))
+        # keys removed from the section directly are still in our index
+        return [(key, section) for key, section, node in self._index()[0].get(name, ()) if key in section.keys]
 
     def iterateKeysByName(self, name):
         """As `keysByName`, but returns an iterator instead"""
-        return self._configChain.iterateKeysByName(name)
+        return iter(self.keysByName(name))
         
     def get(self, key_id, default = None):
         """Convenience function allowing to easily specify the key you wish to retrieve
@@ -435,7 +605,12 @@ class ConfigAccessor(object):
             # END option exception handling
         else:
             if default is None:
-                return self.section(sid).key(kid)
+                section = self.section(sid)
+                for key, ksection, node in self._index()[0].get(kid, ()):
+                    if ksection is section and key in section.keys:
+                        return key
+                # END for each key candidate
+                raise NoOptionError(kid, section.name)
             else:
                 return self.keyDefault(sid, kid, default)
             # END default handling 
@@ -483,16 +658,18 @@ class ConfigAccessor(object):
         :return: the number of nodes that did *not* allow the section to be removed as they are read-only, thus
             0 will be returned if everything was alright"""
         numReadonly = 0
-        for node in self._configChain:
-            if not node.hasSection(name):
-                continue
-
+        keyindex, sectionindex = self._index()
+        for section, node in sectionindex.get(name, list())[:]:
             # can we write it ?
             if not node._isWritable():
                 numReadonly += 1
                 continue
 
             node._sections.remove(name)
+            sectionindex[name].remove((section, node))
+            for key in section.keys:
+                self._keyRemoved(key, section)
+        # END for each node with the section
 
         return numReadonly
 
@@ -533,9 +710,9 @@ class ConfigManager(object):
     For convenience, it will wire through all calls it cannot handle to its `ConfigAccessor`
     stored at .config"""
     
-    __slots__ = ('__config', 'config', '_writeBackOnDestruction', '_closeFp') 
+    __slots__ = ('__config', 'config', '_writeBackOnDestruction', '_closeFp', '_cache') 
 
-    def __init__(self, filePointers=list(), write_back_on_desctruction=True, close_fp = True):
+    def __init__(self, filePointers=list(), write_back_on_desctruction=True, close_fp = True, cache = None):
         """Initialize the class with a list of Extended File Classes
         
         :param filePointers: Point to the actual configuration to use
@@ -547,11 +724,17 @@ class ConfigManager(object):
 
         :param write_back_on_desctruction: if True, the config chain and possible
             changes will be written once this instance is being deleted. If false,
-            the changes must explicitly be written back using the write method"""
+            the changes must explicitly be written back using the write method
+            
+        :param cache: if not None, path to a file keeping the parsed configuration.
+            If the configuration files did not change, it will be loaded from there 
+            instead of being parsed. Only `ConfigFile` instances can be cached,
+            the cache will not be used for other file-like objects."""
         self.__config = ConfigAccessor()
         self.config = None                  # will be set later
         self._writeBackOnDestruction = write_back_on_desctruction
         self._closeFp = close_fp
+        self._cache = cache
 
         self.readfp(filePointers, close_fp=close_fp)
 
@@ -605,10 +788,35 @@ class ConfigManager(object):
         :raise ConfigParsingError:
         :param filefporlist: single file like object or list of such
         :return: the configuration that is meant to be used for accessing the configuration"""
-        self.__config.readfp(filefporlist, close_fp = close_fp)
+        fileobjectlist = filefporlist
+        if not isinstance(fileobjectlist, (list,tuple)):
+            fileobjectlist = (filefporlist,)
+        
+        key = None
+        if self._cache is not None:
+            key = _cacheKey(fileobjectlist)
+            data = _readCache(self._cache, key)
+            if data is not None:
+                sectionsets, flatsections = data
+                self.__config._setSectionSets(fileobjectlist, sectionsets)
+                self.config = ConfigAccessor()
+                self.config._setSectionSets((ConfigStringIO(),), (flatsections,))
+                if close_fp:
+                    for fp in fileobjectlist:
+                        fp.close()
+                # END close file objects
+                return self.config
+            # END use cached configuration
+        # END handle cache
+        
+        self.__config.readfp(fileobjectlist, close_fp = close_fp)
 
         # flatten the list and attach it
         self.config = self.__config.flatten(ConfigStringIO())
+        
+        if key is not None:
+            _writeCache(self._cache, key, (self.__config._sectionSets(), self.config._sectionSets()[0]))
+        # END update cache
         return self.config
 
     #} End IO Methods
@@ -616,7 +824,7 @@ class ConfigManager(object):
 
     #{ Utilities
     @classmethod
-    def taggedFileDescriptors(cls, directories, taglist, pattern=None):
+    def taggedFileDescriptors(cls, directories, taglist, pattern=None, cache=None):
         """Finds tagged configuration files in given directories and return them.
         
         The files retrieved can be files like "file.ext" or can contain tags. Tags are '.'
@@ -639,6 +847,8 @@ class ConfigManager(object):
         :param taglist: [string(tag) ...] of tags, like a tag for the operating system, or the user name
         :param pattern: simple fnmatch pattern as used for globs or a list of them (allowing to match several
             different patterns at once)
+        :param cache: if not None, path to a file keeping the names of the matched files.
+            They will be reused as long as the given directories did not change
         """
 
         # get patterns
@@ -647,6 +857,21 @@ class ConfigManager(object):
             workpatterns.extend(pattern)
         else:
             workpatterns.append(pattern)
+        
+        key = None
+        if cache is not None:
+            mtimes = list()
+            for folder in directories:
+                try:
+                    mtimes.append(os.stat(folder).st_mtime)
+                except OSError:
+                    mtimes.append(None)
+            # END for each directory
+            key = (_cacheversion, tuple(directories), tuple(taglist), tuple(workpatterns), tuple(mtimes))
+            filenames = _readCache(cache, key)
+            if filenames is not None:
+                return [ConfigFile(f) for f in filenames]
+        # END handle cache
 
 
         # GET ALL FILES IN THE GIVEN DIRECTORIES
@@ -676,10 +901,11 @@ class ConfigManager(object):
 
         # END for each tagged file
 
-        outDescriptors = list()
-        for numtags,taggedFile in sorted(tagMatchList):
-            outDescriptors.append(ConfigFile(taggedFile))   # just open for reading
-        return outDescriptors
+        filenames = [str(taggedFile) for numtags,taggedFile in sorted(tagMatchList)]
+        _writeCache(cache, key, filenames)
+        
+        # just open for reading
+        return [ConfigFile(f) for f in filenames]
 
     #} end Utilities
 
@@ -1124,7 +1350,7 @@ class Section(_PropertyHolderBase):
     all its keys and section properties
 
     :note: name will be stored stripped and must not contain certain chars """
-    __slots__ = ('_name', 'keys')
+    __slots__ = ('_name', 'keys', '_node')
     _re_checkName = re.compile(r'\+?\w+(:' + Key.validchars+ r'+)?')
 
     def __iter__(self):
@@ -1137,6 +1363,7 @@ class Section(_PropertyHolderBase):
         :param order: -1 = will be written to end of list, or to given position otherwise """
         self._name          = ''
         self.keys           = BasicSet()
+        self._node          = None          # the `ConfigNode` we belong to, if any
         _PropertyHolderBase.__init__(self, name, order)
 
     def __hash__(self):
@@ -1148,6 +1375,15 @@ class Section(_PropertyHolderBase):
     def __str__(self):
         """ :return: section name """
         return self._name
+        
+    def __getstate__(self):
+        """Copies do not belong to the node we are part of"""
+        return dict((attr, getattr(self, attr)) for attr in ('_name', 'keys', 'properties', 'order'))
+        
+    def __setstate__(self, state):
+        for attr, value in state.iteritems():
+            setattr(self, attr, value)
+        self._node = None
 
     #def __getattr__(self, keyname):
         """:return: the key with the given name if it exists
@@ -1161,6 +1397,12 @@ class Section(_PropertyHolderBase):
     def _excPrependNameAndRaise(self):
         _excmsgprefix("Section = " + self._name + ": ")
         raise
+        
+    def _accessor(self):
+        """:return: the `ConfigAccessor` which indexes us, or None"""
+        if self._node is None:
+            return None
+        return self._node._accessor
 
     def _setName(self, name):
         """:raise ValueError: if name contains invalid chars"""
@@ -1218,8 +1460,21 @@ class Section(_PropertyHolderBase):
             if isinstance(self, PropertySection):
                 key.properties = None
             self.keys.add(key)
+            accessor = self._accessor()
+            if accessor is not None:
+                accessor._keyAdded(key, self, self._node)
             return (key, True)
 
+    def removeKey(self, name):
+        """Remove the key with the given name if it exists"""
+        if name not in self.keys:
+            return
+        key = self.keys[name]
+        self.keys.remove(key)
+        accessor = self._accessor()
+        if accessor is not None:
+            accessor._keyRemoved(key, self)
+
     def setKey(self, name, value):
         """ Set the value to key with name, or create a new key with name and value
         
@@ -1243,11 +1498,12 @@ class ConfigNode(object):
     Additionally, it is aware of it being element of a chain, and can provide next
     and previous elements respectively """
     #{Construction/Destruction
-    __slots__ = ('_sections', '_fp')
+    __slots__ = ('_sections', '_fp', '_accessor')
     def __init__(self, fp):
         """ Initialize Class Instance"""
         self._sections  = BasicSet()            # associate sections with key holders
         self._fp        = fp                    # file-like object that we can read from and possibly write to
+        self._accessor  = None                  # `ConfigAccessor` to inform about new sections
     #}
 
 
@@ -1388,7 +1644,10 @@ class ConfigNode(object):
                 sectionclass = PropertySection
 
             section = sectionclass(name, -1)
+            section._node = self
             self._sections.add(section)
+            if self._accessor is not None:
+                self._accessor._sectionAdded(section, self)
             return section
             
     #} END section access
@@ -1572,8 +1831,7 @@ class DiffSection(DiffData):
 
         # remove moved keys - simply delete them from the list
         for removedkey in self.removed:
-            if removedkey in targetSection.keys:
-                targetSection.keys.remove(removedkey)
+            targetSection.removeKey(removedkey.name)
 
         # handle changed keys - we will create a new key if this is required
         for changedKeyDiff in self.changed:
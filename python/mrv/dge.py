@@ -6,15 +6,18 @@ __docformat__ = "restructuredtext"
 
 import networkx as nx
 from collections import deque
-import inspect
 import weakref
 import itertools
-from util import iDuplicatable
+import threading
+import sys
+from util import ( iDuplicatable, iterGraph, kTraverseBreadthFirst, kTraverseDepthFirst )
+from mrv.thread import ThreadPool
 
 __all__ = ("ConnectionError", "PlugIncompatible", "PlugAlreadyConnected", "AccessError",
            "NotWritableError", "NotReadableError", "MissingDefaultValueError", "ComputeError", 
            "ComputeFailed", "ComputeFailed", "PlugUnhandled", 
-           "iterShells", "Attribute", "iPlug", "plug", "Graph", "NodeBase")
+           "iterShells", "Attribute", "iPlug", "plug", "EvaluationPlan", "CacheStore", "Graph",
+           "NodeBase")
 
 #####################
 ## EXCEPTIONS ######
@@ -61,7 +64,7 @@ class PlugUnhandled( ComputeError ):
 ## Iterators  ######
 ###################
 #{ Iterators
-def iterShells( rootPlugShell, stopAt = lambda x: False, prune = lambda x: False,
+def iterShells( rootPlugShell, stopAt = None, prune = None,
                direction = "up", visit_once = False, branch_first = False ):
     """Iterator starting at rootPlugShell going "up"stream ( input ) or "down"stream ( output )
     breadth first over plugs, applying filter functions as defined.
@@ -79,69 +82,78 @@ def iterShells( rootPlugShell, stopAt = lambda x: False, prune = lambda x: False
     :param branch_first: if True, individual branches will be travelled first ( thuse the node will be left quickly following the datastream ).
             If False, the plugs on the ndoe will be returned first before proceeding to the next node
             encountered several times as several noodes are connected to them in some way. """
-    visited = set()
-    stack = deque()
-    stack.append( rootPlugShell )
-
-    def addToStack( node, stack, lst, branch_first ):
-        if branch_first:
-            stack.extend( node.toShell( plug ) for plug in lst )
-        else:
-            reviter = ( node.toShell( lst[i] ) for i in range( len( lst )-1,-1,-1) )
-            stack.extendleft( reviter )
-    # END addToStack local method
-
-    def addOutputToStack( stack, lst, branch_first ):
-        if branch_first:
-            stack.extend( lst )
-        else:
-            stack.extendleft( reversed( lst[:] ) )
-    # END addOutputToStack local method
-
-    while stack:
-        shell = stack.pop()
-        if shell in visited:
-            continue
-
-        if visit_once:
-            visited.add( shell )
-
-        if stopAt( shell ):
-            continue
-
-        if not prune( shell ):
-            yield shell
-
-        if direction == 'up':
+    # neighbors are traversed last to first, which keeps the established order
+    if direction == 'up':
+        def neighbors( shell ):
             # I-N-O
-            addToStack( shell.node, stack, shell.plug.affectedBy(), branch_first )
-            # END if provides output
-
+            node = shell.node
+            shells = [ node.toShell( plug ) for plug in reversed( shell.plug.affectedBy() ) ]
+            
             # O<-I
             ishell = shell.input( )
             if ishell:
                 if branch_first:
-                    stack.append( ishell )
+                    shells.insert( 0, ishell )
                 else:
-                    stack.appendleft( ishell )
+                    shells.append( ishell )
             # END has input connection
-        # END upstream
-        else:
+            return shells
+        # END upstream neighbors
+    else:
+        def neighbors( shell ):
             # I-N-O and I->O
-            # could also be connected - follow them
-            if branch_first:
-                # fist the outputs, then the internals ( this ends up with the same effect )
-                addToStack( shell.node, stack, shell.plug.affected(), branch_first )
-                addOutputToStack( stack, shell.outputs(), branch_first )
-            else:
-                addOutputToStack( stack, shell.outputs(), branch_first )
-                addToStack( shell.node, stack, shell.plug.affected(), branch_first )
-        # END downstream
-    # END for each shell on work stack
+            node = shell.node
+            shells = list( reversed( shell.outputs() ) )
+            shells.extend( node.toShell( plug ) for plug in reversed( shell.plug.affected() ) )
+            return shells
+        # END downstream neighbors
+    # END handle direction
+    
+    order = kTraverseBreadthFirst
+    if branch_first:
+        order = kTraverseDepthFirst
+    return iterGraph( rootPlugShell, neighbors, order, prune, stopAt, visit_once = visit_once )
 
 #} END iterators
 
 
+#{ Utilities
+
+_emptydict = dict()         # never altered, used as default for lookups
+_missing = object()         # marker for missing values
+
+_generation = itertools.count( 1 )  # stamps of cached values and cache invalidations
+
+# CacheStores with dirty shells scheduled, they are flushed before any cache access as
+# facade nodes propagate changes between the stores of different graphs
+_dirtystores = weakref.WeakKeyDictionary()
+_dirtylock = threading.Lock()
+
+def _flushDirtyStores( ):
+    """Clear all caches affected by shells scheduled in any `CacheStore`"""
+    for store in _dirtystores.keys():
+        store._flushDirty()
+
+_plugtables = dict()        # node class -> _PlugTable
+_plugtables_generation = 0  # changes whenever the relations or flags of plugs change
+
+def _invalidatePlugTables( ):
+    """Mark all plug tables outdated, which happens if the relations or flags of plugs change"""
+    global _plugtables_generation
+    _plugtables_generation += 1
+    
+def _invalidateClassPlugTables( nodecls ):
+    """Drop the plug tables of nodecls and its subclasses, which happens if their plugs change"""
+    for tablecls in _plugtables.keys():
+        if issubclass( tablecls, nodecls ):
+            _plugtables.pop( tablecls, None )
+    # END for each class with table
+
+_classratings = dict()      # ( typecls, cls, exact_type ) -> rating, see `Attribute._getClassRating`
+
+#} END utilities
+
+
 #####################
 ## Classes    ######
 ###################
@@ -200,16 +212,35 @@ class Attribute( object ):
                 raise TypeError( "Default value %r is not compatible with this attribute" % default )
         # END default type check
 
+    def __setattr__( self, name, value ):
+        """Flags define whether plugs provide input or output, changing them invalidates
+        the plug tables"""
+        changed = name == 'flags' and name in self.__dict__ and self.__dict__[ name ] != value
+        object.__setattr__( self, name, value )
+        if changed:
+            _invalidatePlugTables()
+
     def _getClassRating( self, cls, exact_type ):
         """ compute class rating
         
         :return: rating based on value being a class and compare.
                 0 means there is no type compatability, 255 matches comparecls, or linearly 
                 less if is just part of the mro of value
+        :note: ratings are cached, see `clearRatingCache`
         """
         if not isinstance( cls, type ):
             return 0
 
+        key = ( self.typecls, cls, bool( exact_type ) )
+        try:
+            return _classratings[ key ]
+        except KeyError:
+            rate = _classratings[ key ] = self._computeClassRating( cls, exact_type )
+            return rate
+        # END handle cache
+
+    def _computeClassRating( self, cls, exact_type ):
+        """:return: uncached class rating, see `_getClassRating`"""
         mro = self.typecls.mro()
         mro.reverse()
 
@@ -233,6 +264,22 @@ class Attribute( object ):
 
     #{ Interface
 
+    @staticmethod
+    def clearRatingCache( ):
+        """Clear the cached class ratings of all attributes. Needs to be called if
+        the class hierarchy of types used by attributes changes at runtime,
+        for instance if ``__bases__`` is altered or modules are reloaded"""
+        _classratings.clear()
+        
+    @staticmethod
+    def ratingKey( attrOrValue ):
+        """:return: hashable key which is equal for all attributes or values that will 
+            receive the same compatability ratings from any plug
+        :param attrOrValue: attribute, class or instance as rated by `affinity`"""
+        if isinstance( attrOrValue, ( Attribute, type ) ):
+            return attrOrValue
+        return ( _missing, attrOrValue.__class__ )      # we rate instances by their class only
+
     def affinity( self, otherattr ):
         """Compute affinity for otherattr.
         
@@ -396,8 +443,8 @@ class plug( iPlug ):
         """Intialize the plug with a distinctive name"""
         self._name = None
         self.attr = attribute
-        self._affects = list()          # list of plugs that are affected by us
-        self._affectedBy = list()       # keeps record of all plugs that affect us
+        self._affects = tuple()         # plugs that are affected by us
+        self._affectedBy = tuple()      # keeps record of all plugs that affect us
 
     #} END object overridden methods
 
@@ -438,22 +485,24 @@ class plug( iPlug ):
         """Set an affects relation ship between this plug and otherplug, saying
         that this plug affects otherplug."""
         if otherplug not in self._affects:
-            self._affects.append( otherplug )
+            self._affects += ( otherplug, )
 
         if self not in otherplug._affectedBy:
-            otherplug._affectedBy.append( self )
+            otherplug._affectedBy += ( self, )
+
+        _invalidatePlugTables()
 
     def affected( self ):
         """:return: tuple containing affected plugs ( plugs that are affected by our value )"""
-        return tuple( self._affects )
+        return self._affects
 
     def affectedBy( self ):
         """:return: tuple containing plugs that affect us ( plugs affecting our value )"""
-        return tuple( self._affectedBy )
+        return self._affectedBy
 
     def providesOutput( self ):
         """:return: True if this is an output plug that can trigger computations"""
-        return bool( len( self.affectedBy() ) != 0 or self.attr.flags & Attribute.computable )
+        return bool( self._affectedBy or self.attr.flags & Attribute.computable )
 
     def providesInput( self ):
         """:return: True if this is an input plug that will never cause computations"""
@@ -507,8 +556,9 @@ class _PlugShell( tuple ):
     def get( self, mode = None ):
         """:return: value of the plug
         :param mode: optional arbitary value specifying the mode of the get attempt"""
-        if self.hasCache( ):
-            return self.cache( )
+        value = self._cachedValue( )
+        if value is not _missing:
+            return value
 
         # Output plugs compute values
         if self.plug.providesOutput( ):
@@ -659,12 +709,13 @@ class _PlugShell( tuple ):
 
 
     #{Caching
-    def _cachename( self ):
-        return self.plug.name() + "_c"
 
     def hasCache( self ):
         """:return: True if currently store a cached value"""
-        return hasattr( self.node, self._cachename() )
+        if _dirtystores:
+            _flushDirtyStores()
+        store = self.node.cacheStore()
+        return store.has( self.node, self.plug.name() )
 
     def setCache( self, value ):
         """Set the given value to be stored in our cache
@@ -677,45 +728,66 @@ class _PlugShell( tuple ):
         if self.plug.attr.flags & Attribute.uncached:
             return
 
-        # our cache changed - dirty downstream plugs - thus clear the cache
-        # NOTE: this clears our own cache by deleting it, but we re-set it
-        self.clearCache( clear_affected = True )
-        setattr( self.node, self._cachename(), value )
+        # computed values can be recomputed if they get evicted, set values cannot
+        stamp = _generation.next()
+        store = self.node.cacheStore()
+        store.put( self.node, self.plug.name(), value, self.plug.providesOutput(), stamp )
+
+        # our cache changed - dirty downstream plugs once someone needs them
+        store._scheduleDirty( self, stamp )
+
+    def _cachedValue( self ):
+        """:return: the cached value or _missing"""
+        if _dirtystores:
+            _flushDirtyStores()
+        store = self.node.cacheStore()
+        return store.get( self.node, self.plug.name(), _missing )
 
     def cache( self ):
         """:return: the cached value or raise
         :raise ValueError:"""
-        if self.hasCache():
-            return getattr( self.node, self._cachename() )
+        value = self._cachedValue( )
+        if value is not _missing:
+            return value
 
         raise ValueError( "Plug %r did not have a cached value" % repr( self ) )
 
-    def clearCache( self, clear_affected = False, cleared_shells_set = None ):
+    def clearCache( self, clear_affected = False, cleared_shells_set = None, stamp = None ):
         """Empty the cache of our plug
         :param clear_affected: if True, the caches of our affected plugs ( connections
-        or affects relations ) will also be cleared
+        or affects relations ) will also be cleared.
+        Unless a stamp is given, this happens lazily before the next cache is accessed, 
+        which allows to efficiently clear the caches affected by many plugs at once.
         This operation is recursive, and needs to be as different shells on different nodes
         might do things differently.
         :param cleared_shells_set: if set, it can be used to track which plugs have already been dirtied to
         prevent recursive loops
+        :param stamp: if not None, only caches older than the given generation stamp will be cleared,
+        and affected plugs are cleared immediately.
         Propagation will happen even if we do not have a cache to clear ourselves """
-        if self.hasCache():
-            del( self.node.__dict__[ self._cachename() ] )
+        self.node.cacheStore().remove( self.node, self.plug.name(), stamp )
 
-        if clear_affected:
-            # our cache changed - dirty downstream plugs - thus clear the cache
-            if not cleared_shells_set:      # initialize our tracking list
-                cleared_shells_set = set()
+        if not clear_affected:
+            return
+
+        if stamp is None:
+            self.node.cacheStore()._scheduleDirty( self, _generation.next() )
+            return
+        # END lazy propagation
 
-            if self in cleared_shells_set:
-                return
+        # our cache changed - dirty downstream plugs - thus clear the cache
+        if cleared_shells_set is None:      # initialize our tracking list
+            cleared_shells_set = set()
+
+        if self in cleared_shells_set:
+            return
 
-            cleared_shells_set.add( self )  # assure we do not come here twice
+        cleared_shells_set.add( self )  # assure we do not come here twice
 
-            all_shells = itertools.chain( self.node.toShells( self.plug.affected() ), self.outputs() )
-            for shell in all_shells:
-                shell.clearCache( clear_affected = True, cleared_shells_set = cleared_shells_set )
-            # END for each shell in all_shells to clear
+        all_shells = itertools.chain( self.node.toShells( self.plug.affected() ), self.outputs() )
+        for shell in all_shells:
+            shell.clearCache( clear_affected = True, cleared_shells_set = cleared_shells_set, stamp = stamp )
+        # END for each shell in all_shells to clear
     #} END caching
 
 
@@ -729,17 +801,512 @@ class _PlugShell( tuple ):
 
 
 
+class EvaluationPlan( object ):
+    """Flat, topologically ordered list of plug shells which need to be evaluated
+    to obtain the values of a set of target shells.
+    
+    The plan is built once from the connections of the graph and the affects
+    relations of the plugs, and is executed in a simple loop. This way, repeated
+    evaluations of the same targets do not need to traverse the graph again.
+    
+    The plan is invalidated automatically whenever the topology of its graph
+    changes, it will rebuild itself on the next evaluation.
+    
+    :note: Do not instantiate this class yourself, use `Graph.compile` instead"""
+    __slots__ = ( '_graph', '_targets', '_steps', '_levels', '_version' )
+
+    def __init__( self, graph, targets ):
+        """Initialize the plan
+        
+        :param graph: weak proxy to the graph owning the plan
+        :param targets: iterable of plug shells whose values should be computed"""
+        self._graph = graph
+        self._targets = tuple( targets )
+        self._steps = tuple()
+        self._levels = tuple()
+        self._version = None        # forces a build on first use
+
+    def __len__( self ):
+        return len( self.steps() )
+
+    def __iter__( self ):
+        return iter( self.steps() )
+
+    def _dependencies( self, shell ):
+        """:return: list of shells whose values are required to obtain the value of shell"""
+        if shell.plug.providesOutput():
+            # I-N-O
+            return shell.node.toShells( shell.plug.affectedBy() )
+        # O<-I
+        ishell = shell.input()
+        if ishell:
+            return [ ishell ]
+        return list()
+
+    def _build( self ):
+        """Walk the graph upstream from our targets and sort all computable shells
+        such that each shell comes after the shells it depends on.
+        Additionally, steps are grouped into levels whose shells do not depend on
+        each other"""
+        steps = list()
+        seen = set()
+        depth = dict()          # shell -> number of steps in its longest dependency chain
+        for target in self._targets:
+            # iterative post-order depth first traversal, cycles are broken
+            # at the first shell that is encountered twice
+            stack = [ ( target, False ) ]
+            while stack:
+                shell, dependencies_done = stack.pop()
+                if dependencies_done:
+                    # dependencies which are still in progress indicate a cycle
+                    shelldepth = max( [ depth.get( d, 0 ) for d in self._dependencies( shell ) ] or [ 0 ] )
+
+                    # uncached shells would be recomputed by their dependents anyway
+                    plug = shell.plug
+                    if plug.providesOutput() and not plug.attr.flags & Attribute.uncached:
+                        steps.append( shell )
+                        shelldepth += 1
+                    # END handle step
+                    depth[ shell ] = shelldepth
+                    continue
+                # END post-order handling
+
+                if shell in seen:
+                    continue
+                seen.add( shell )
+
+                stack.append( ( shell, True ) )
+                dependencies = self._dependencies( shell )
+                for i in xrange( len( dependencies ) - 1, -1, -1 ):
+                    if dependencies[i] not in seen:
+                        stack.append( ( dependencies[i], False ) )
+                # END for each dependency
+            # END while there is work
+        # END for each target
+
+        levels = list()
+        for shell in steps:
+            level = depth[ shell ] - 1
+            while len( levels ) <= level:
+                levels.append( list() )
+            levels[ level ].append( shell )
+        # END for each step
+
+        self._steps = tuple( steps )
+        self._levels = tuple( tuple( level ) for level in levels )
+        self._version = self._currentVersion()
+        
+    def _currentVersion( self ):
+        """:return: version of everything the plan depends on, which is the topology of 
+            our graph as well as the relations and flags of plugs"""
+        return ( self._graph._version, _plugtables_generation )
+
+    def _evaluateLevels( self, mode, workers, executor ):
+        """Evaluate our levels one after another, computing the thread-safe shells of
+        each level concurrently. Shells whose node is not thread-safe are computed
+        in the calling thread"""
+        pool = None
+        if executor is None:
+            executor = pool = ThreadPool( workers )
+        # END create worker threads
+
+        try:
+            for level in self.levels():
+                futures = list()
+                serial = list()
+                for shell in level:
+                    if not shell.node.thread_safe:
+                        serial.append( shell )
+                    else:
+                        futures.append( executor.submit( shell.get, mode ) )
+                    # END handle shell
+                # END for each shell
+
+                for shell in serial:
+                    shell.get( mode )
+                # END for each serial shell
+
+                # wait for the level to finish, raising the first error
+                for future in futures:
+                    future.result()
+                # END for each future
+            # END for each level
+        finally:
+            if pool is not None:
+                pool.stop_and_join( cancel_pending = True )
+        # END assure threads are stopped
+
+    #{ Interface
+
+    def isValid( self ):
+        """:return: True if the plan matches the current topology of its graph, and the
+            current flags of its plugs"""
+        return self._version == self._currentVersion()
+
+    def targets( self ):
+        """:return: tuple of target shells this plan evaluates"""
+        return self._targets
+
+    def steps( self ):
+        """:return: tuple of shells in evaluation order, dependencies come first.
+            Only computable and cached shells are part of the plan.
+        :note: rebuilds the plan if it is invalid"""
+        if not self.isValid():
+            self._build()
+        return self._steps
+
+    def levels( self ):
+        """:return: tuple of tuples of shells. Shells within one level do not depend on
+            each other and may be computed concurrently once all previous levels are done.
+        :note: rebuilds the plan if it is invalid"""
+        if not self.isValid():
+            self._build()
+        return self._levels
+
+    def evaluate( self, mode = None, workers = 0, executor = None ):
+        """Compute all steps of the plan in order and return the target values
+        
+        :param mode: passed to the ``get`` method of each shell
+        :param workers: if larger than 1, independent shells on nodes marked as
+            ``thread_safe`` will be computed by the given amount of worker threads
+        :param executor: if not None, an object with a ``submit( func, *args )`` method
+            returning a future with a ``result()`` method, like `mrv.thread.ThreadPool`
+            or the concurrent.futures thread pool. It is used instead of creating 
+            our own pool
+        :return: list of values, one for each target, in order"""
+        if executor is None and workers < 2:
+            for shell in self.steps():
+                shell.get( mode )
+            # END for each step
+        else:
+            self._evaluateLevels( mode, workers, executor )
+        # END handle parallel evaluation
+        return [ shell.get( mode ) for shell in self._targets ]
+
+    #} END interface
+
+
+class CacheStore( object ):
+    """Keeps the cached values of plugs, keyed by their node and plug name.
+    
+    The store can be given a budget in entries and/or bytes. If it is exceeded,
+    the least recently used values are evicted. Only values which can be recomputed,
+    that is values of output plugs, will ever be evicted - values set by the user
+    are kept no matter what.
+    
+    Derived classes may override `_evict` to implement a different eviction policy.
+    
+    :note: the size of a value is determined using the ``sizeof`` function, which
+        defaults to ``sys.getsizeof`` and thus does not account for the size of
+        objects referenced by the value"""
+    # indices into our entry lists
+    _value, _size, _evictable, _tick, _stamp = range( 5 )
+
+    def __init__( self, max_entries = 0, max_bytes = 0, sizeof = sys.getsizeof ):
+        """Initialize the store with an optional budget
+        
+        :param max_entries: if not 0, maximum amount of evictable values to keep
+        :param max_bytes: if not 0, maximum amount of bytes the evictable values may use
+        :param sizeof: function returning the size of a value in bytes"""
+        self._nodes = dict()            # node -> dict( plugname -> entry )
+        self._order = deque()           # ( tick, node, plugname ), oldest first, may contain stale items
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+        self._dirty = list()            # ( stamp, shell ) whose affected caches need to be cleared
+        self._flushlock = threading.RLock()
+        self._flushing = False          # True while the dirty shells are being handled
+        self._num_evictable = 0
+        self._num_bytes = 0
+        self._sizeof = sizeof
+        self.max_entries = 0
+        self.max_bytes = 0
+        self.setBudget( max_entries, max_bytes )
+
+    def __len__( self ):
+        return sum( len( entries ) for entries in self._nodes.itervalues() )
+
+    def __iter__( self ):
+        """:return: iterator yielding ( node, plugname ) tuples of all cached values"""
+        for node, entries in self._nodes.items():
+            for name in entries.keys():
+                yield ( node, name )
+            # END for each entry
+        # END for each node
+
+    #{ Internals
+
+    def _hasBudget( self ):
+        return self.max_entries or self.max_bytes
+
+    def _rebuildOrder( self ):
+        """Recreate our usage order from the ticks of our evictable entries"""
+        self._order = deque( sorted( ( e[ self._tick ], n, name )
+                                     for n, entries in self._nodes.items()
+                                     for name, e in entries.items() if e[ self._evictable ] ) )
+
+    def _touch( self, node, name, entry ):
+        """Mark entry as most recently used
+        :note: called with our lock acquired"""
+        entry[ self._tick ] = tick = self._clock.next()
+        if not self._hasBudget():
+            return
+
+        self._order.append( ( tick, node, name ) )
+        # compact our order queue if it contains too many stale items
+        if len( self._order ) > 2 * self._num_evictable + 64:
+            self._rebuildOrder()
+
+    def _used( self, node, name, entry ):
+        """Mark the evictable entry as most recently used, acquiring our lock if required"""
+        if not self._hasBudget():
+            entry[ self._tick ] = self._clock.next()
+            return
+        self._lock.acquire()
+        try:
+            self._touch( node, name, entry )
+        finally:
+            self._lock.release()
+
+    def _exceedsBudget( self ):
+        return ( self.max_entries and self._num_evictable > self.max_entries ) or \
+                ( self.max_bytes and self._num_bytes > self.max_bytes )
+
+    def _evict( self ):
+        """Remove least recently used evictable values until we are within our budget
+        :note: called with our lock acquired"""
+        order = self._order
+        while order and self._exceedsBudget():
+            tick, node, name = order.popleft()
+            entry = self._nodes.get( node, dict() ).get( name )
+            if entry is None or entry[ self._tick ] != tick:
+                continue        # stale item
+            self._remove( node, name )
+        # END while we are over budget
+
+    def _remove( self, node, name ):
+        """:return: removed entry or None"""
+        entries = self._nodes.get( node )
+        if not entries:
+            return None
+        entry = entries.pop( name, None )
+        if entry is None:
+            return None
+        if not entries:
+            del( self._nodes[ node ] )
+        if entry[ self._evictable ]:
+            self._num_evictable -= 1
+            self._num_bytes -= entry[ self._size ]
+        # END update statistics
+        return entry
+
+    def _add( self, node, name, entry ):
+        """Add the given entry, replacing existing ones"""
+        self._remove( node, name )
+        self._nodes.setdefault( node, dict() )[ name ] = entry
+        if entry[ self._evictable ]:
+            self._num_evictable += 1
+            if self.max_bytes:
+                entry[ self._size ] = self._sizeof( entry[ self._value ] )
+            self._num_bytes += entry[ self._size ]
+            self._touch( node, name, entry )
+        # END handle evictable entry
+
+    def _scheduleDirty( self, shell, stamp ):
+        """Remember that all caches affected by shell which are older than stamp need
+        to be cleared. This will happen lazily before the next cache access"""
+        _dirtylock.acquire()
+        try:
+            self._dirty.append( ( stamp, shell ) )
+            _dirtystores[ self ] = True
+        finally:
+            _dirtylock.release()
+
+    def _flushDirty( self ):
+        """Clear all caches affected by shells scheduled using `_scheduleDirty`.
+        
+        All scheduled shells are handled in one pass, newest changes first, such that each
+        affected shell is visited only once. A cache is cleared only if it is older
+        than the change that affects it. 
+        Other threads wait until the pass is done, shells stay scheduled until then.
+        :note: use `_flushDirtyStores` to handle changes affecting other stores as well"""
+        self._flushlock.acquire()
+        try:
+            if self._flushing:
+                return              # caches are accessed while we clear them
+            dirty = self._dirty[:]
+            self._flushing = True
+            try:
+                dirty.sort()
+                dirty.reverse()
+                cleared_shells_set = set()
+                for stamp, shell in dirty:
+                    if shell.node.graph is None:
+                        continue            # node was removed from its graph, nothing is affected anymore
+                    try:
+                        shell.clearCache( clear_affected = True, cleared_shells_set = cleared_shells_set, stamp = stamp )
+                    except ReferenceError:
+                        pass                # graph was deleted
+                # END for each dirty shell
+            finally:
+                self._flushing = False
+                _dirtylock.acquire()
+                try:
+                    del( self._dirty[ :len( dirty ) ] )
+                    if not self._dirty:
+                        _dirtystores.pop( self, None )
+                finally:
+                    _dirtylock.release()
+            # END handle flushing
+        finally:
+            self._flushlock.release()
+
+    #} END internals
+
+    #{ Interface
+
+    def setBudget( self, max_entries = 0, max_bytes = 0 ):
+        """Set the budget of this store, evicting values if required
+        
+        :param max_entries: maximum amount of evictable values, 0 means unlimited
+        :param max_bytes: maximum amount of bytes used by evictable values, 0 means unlimited"""
+        self._lock.acquire()
+        try:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+
+            # update sizes, keeping the usage order
+            self._num_bytes = 0
+            for entries in self._nodes.itervalues():
+                for entry in entries.itervalues():
+                    if entry[ self._evictable ]:
+                        entry[ self._size ] = ( max_bytes and self._sizeof( entry[ self._value ] ) ) or 0
+                        self._num_bytes += entry[ self._size ]
+                    # END if entry is evictable
+                # END for each entry
+            # END for each node
+
+            self._order = deque()
+            if self._hasBudget():
+                self._rebuildOrder()
+                self._evict()
+            # END handle budget
+        finally:
+            self._lock.release()
+
+    def numBytes( self ):
+        """:return: amount of bytes used by evictable values, only maintained if
+            the budget limits the amount of bytes"""
+        return self._num_bytes
+
+    def has( self, node, name ):
+        """:return: True if a value is stored for the given node's plug name"""
+        entry = self._nodes.get( node, _emptydict ).get( name )
+        if entry is None:
+            return False
+        if entry[ self._evictable ]:
+            self._used( node, name, entry )
+        return True
+
+    def get( self, node, name, default = None ):
+        """:return: value stored for the given node's plug name, or default"""
+        entry = self._nodes.get( node, _emptydict ).get( name )
+        if entry is None:
+            return default
+        if entry[ self._evictable ]:
+            self._used( node, name, entry )
+        return entry[ self._value ]
+
+    def stamp( self, node, name ):
+        """:return: generation stamp of the value stored for the given node's plug name,
+            or None if there is no value. Values with a higher stamp were stored later"""
+        entry = self._nodes.get( node, _emptydict ).get( name )
+        if entry is None:
+            return None
+        return entry[ self._stamp ]
+
+    def put( self, node, name, value, evictable = True, stamp = 0 ):
+        """Store value for the given node's plug name
+        
+        :param evictable: if True, the value may be evicted if the store exceeds its budget
+        :param stamp: generation stamp of the value, see `stamp`"""
+        self._lock.acquire()
+        try:
+            self._add( node, name, [ value, 0, evictable, 0, stamp ] )
+            if evictable and self._hasBudget():
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def remove( self, node, name, stamp = None ):
+        """Remove the value stored for the given node's plug name
+        
+        :param stamp: if not None, the value will only be removed if its stamp is
+            smaller than the given one, thus if it is older
+        :return: True if a value was removed"""
+        entry = self._nodes.get( node, _emptydict ).get( name )
+        if entry is None or ( stamp is not None and entry[ self._stamp ] >= stamp ):
+            return False
+        self._lock.acquire()
+        try:
+            return self._remove( node, name ) is not None
+        finally:
+            self._lock.release()
+
+    def popNode( self, node ):
+        """Remove all values of the given node
+        
+        :return: dict( plugname -> entry ) suitable to be passed to `updateNode`"""
+        self._lock.acquire()
+        try:
+            entries = dict( self._nodes.get( node, _emptydict ) )
+            for name in entries:
+                self._remove( node, name )
+            return entries
+        finally:
+            self._lock.release()
+
+    def updateNode( self, node, entries ):
+        """Add the entries as retrieved by `popNode` to this store"""
+        self._lock.acquire()
+        try:
+            for name, entry in entries.iteritems():
+                entry[ self._size ] = 0
+                self._add( node, name, entry )
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear( self ):
+        """Remove all values"""
+        self._lock.acquire()
+        try:
+            self._nodes.clear()
+            self._order.clear()
+            self._num_evictable = self._num_bytes = 0
+        finally:
+            self._lock.release()
+
+    #} END interface
+
+
 class Graph( nx.DiGraph, iDuplicatable ):
     """Holds the nodes and their connections
 
     Nodes are kept in a separate list whereas the plug connections are kept
-    in the underlying DiGraph"""
+    in the underlying DiGraph. The cached plug values of all nodes are kept in
+    a `CacheStore`"""
+    #{ Configuration
+    cachestorecls = CacheStore      # class used to store cached plug values
+    #} END configuration
 
     #{ Overridden Object Methods
     def __init__( self, **kwargs ):
         """initialize the DiGraph and add some additional attributes"""
         super( Graph, self ).__init__( **kwargs )
         self._nodes = set()         # our processes from which we can make connections
+        self._version = 0           # incremented whenever our topology changes
+        self._plans = dict()        # tuple( targetshells ) -> EvaluationPlan
+        self._cachestore = self.cachestorecls()     # cached plug values of our nodes
 
     def __del__( self ):
         """Clear our graph"""
@@ -853,11 +1420,21 @@ class Graph( nx.DiGraph, iDuplicatable ):
 
         self._nodes.add( node )     # assure the node knows us
         node.graph = weakref.proxy( self )
+        self._invalidatePlans()
+
+        # take over the caches the node kept while it was not part of a graph
+        nodestore = node.__dict__.pop( '_plugcache', None )
+        if nodestore is not None:
+            nodestore._flushDirty()
+            self._cachestore.updateNode( node, nodestore.popNode( node ) )
+        # END transfer caches
 
         return self     # assure we have the graph set
 
     def removeNode( self, node ):
         """Remove the given node from the graph ( if it exists in it )"""
+        if _dirtystores:            # propagate pending changes while we are still connected
+            _flushDirtyStores()
         try:
             # remove connections
             for sshell, eshell in node.connections( 1, 1 ):
@@ -866,9 +1443,20 @@ class Graph( nx.DiGraph, iDuplicatable ):
             # assure the node does not call us anymore
             node.graph = None
             self._nodes.remove( node )
+            self._invalidatePlans()
+
+            # the node keeps its caches
+            entries = self._cachestore.popNode( node )
+            if entries:
+                node.cacheStore().updateNode( node, entries )
+            # END transfer caches
         except KeyError:
             pass
 
+    def cacheStore( self ):
+        """:return: `CacheStore` keeping the cached plug values of our nodes"""
+        return self._cachestore
+
     def clearCache( self ):
         """Clear the cache of all nodes in the graph - this forces the graph
         to reevaluate on the next request"""
@@ -877,6 +1465,41 @@ class Graph( nx.DiGraph, iDuplicatable ):
 
     #} END node handling
 
+    #{ Evaluation
+
+    def _invalidatePlans( self ):
+        """Mark all evaluation plans as invalid as our topology changed"""
+        self._version += 1
+        self._plans.clear()
+
+    def compile( self, outputShells ):
+        """:return: `EvaluationPlan` computing the given shells in topological order.
+            Plans are cached, asking for the same targets again returns the same plan
+            as long as the topology of the graph did not change.
+        :param outputShells: iterable of plug shells whose values should be computed"""
+        targets = tuple( outputShells )
+        plan = self._plans.get( targets )
+        if plan is None:
+            plan = EvaluationPlan( weakref.proxy( self ), targets )
+            self._plans[ targets ] = plan
+        # END create plan
+        return plan
+
+    def evaluate( self, targets, mode = None, workers = 0, executor = None ):
+        """Compute the values of the given target shells using a compiled plan
+        
+        :param targets: iterable of plug shells to compute
+        :param mode: passed to the ``get`` method of each shell
+        :param workers: amount of worker threads computing independent branches
+            of the graph, see `EvaluationPlan.evaluate`
+        :param executor: concurrent.futures compatible executor to use instead
+            of our own worker threads
+        :return: list of values, one for each target, in order
+        :note: only nodes whose class sets ``thread_safe`` are computed concurrently"""
+        return self.compile( targets ).evaluate( mode, workers = workers, executor = executor )
+
+    #} END evaluation
+
     #{ Query
 
     def hasNode( self , node ):
@@ -965,12 +1588,16 @@ class Graph( nx.DiGraph, iDuplicatable ):
 
         # connect us
         self.add_edge( sourceshell, v = destinationshell )
+        self._invalidatePlans()
         return sourceshell
 
     def disconnect( self, sourceshell, destinationshell ):
         """Remove the connection between sourceshell to destinationshell if they are connected
         :note: does not raise if no connection is present"""
+        if _dirtystores:            # propagate pending changes along the connection
+            _flushDirtyStores()
         self.remove_edge( sourceshell, v = destinationshell )
+        self._invalidatePlans()
 
         # also, delete the plugshells if they are not connnected elsewhere
         for shell in sourceshell,destinationshell:
@@ -1000,8 +1627,50 @@ class Graph( nx.DiGraph, iDuplicatable ):
     #} END connections
 
 
+class _PlugTable( object ):
+    """Precomputed plug information of a node class, see `_NodeBaseCheckMeta`"""
+    __slots__ = ( 'generation', 'plugs', 'inputs', 'outputs',
+                  'static', 'staticinputs', 'staticoutputs', 'dynamic' )
+
+    def __init__( self, cls ):
+        self.generation = _plugtables_generation
+        mro = cls.mro()
+
+        # all plugs as found in the dicts of our class hierarchy, as used by `NodeBase.plugs`
+        self.plugs = tuple( v for c in mro for v in c.__dict__.itervalues() if isinstance( v, plug ) )
+        self.inputs = tuple( p for p in self.plugs if p.providesInput() )
+        self.outputs = tuple( p for p in self.plugs if p.providesOutput() )
+
+        # plugs accessible as class members, sorted by member name, as used by `NodeBase.plugsStatic`
+        members = dict()
+        for c in reversed( mro ):
+            for name, v in c.__dict__.iteritems():
+                if isinstance( v, plug ):
+                    members[ name ] = v
+                else:
+                    members.pop( name, None )
+            # END for each class member
+        # END for each class
+        self.static = tuple( members[ name ] for name in sorted( members ) )
+        self.staticinputs = tuple( p for p in self.static if p.providesInput() )
+        self.staticoutputs = tuple( p for p in self.static if p.providesOutput() )
+
+        # if plugs are overridden, we may not use our precomputed values for instances
+        self.dynamic = cls.plugs.im_func is not NodeBase.plugs.im_func
+
+    @classmethod
+    def get( cls, nodecls ):
+        """:return: uptodate plug table for the given node class"""
+        table = _plugtables.get( nodecls )
+        if table is None or table.generation != _plugtables_generation:
+            table = _plugtables[ nodecls ] = cls( nodecls )
+        return table
+
+
 class _NodeBaseCheckMeta( type ):
-    """Class checking the consistency of the nodebase class before it is being created"""
+    """Class checking the consistency of the nodebase class before it is being created.
+    It keeps a table of the plugs of each class which is updated automatically if
+    plugs change"""
     def __new__( metacls, name, bases, clsdict ):
         """Check:
             - every plugname must correspond to a node member name
@@ -1010,32 +1679,43 @@ class _NodeBaseCheckMeta( type ):
 
         # EVERY PLUG NAME MUST MATCH WITH THE ACTUAL NAME IN THE CLASS
         # set the name according to its slot name in the parent class
-        membersdict = inspect.getmembers( newcls )      # do not filter, as plugs could be overridden
-        try:
-            if hasattr( newcls, "plugsStatic" ):
-                for plug in newcls.plugsStatic( ):
-                    for name,member in membersdict:
-                        if member == plug and plug.name() != name:
-                            # try to set it
-                            if hasattr( plug, 'setName' ):
-                                plug.setName( name )
-                            else:
-                                raise AssertionError( "Plug %r is named %s, but must be named %s as in its class %s" % ( plug, plug.name(), name, newcls ) )
-                            # END setName special handling
-                        # END if member nanme is wrong
-                    # END for each class member
-
-                    # ignore plugs we possibly did not find in the physical class
-                # END for each plug in class
-            # END if method exists
-        except TypeError:
-            # it can be that a subclass overrides this method and makes it an instance method
-            # this is valid - the rest of the dgengine always accesses this method
-            # through instance - so we have to handle it
-            pass
+        # do not filter, as plugs could be overridden
+        for c in newcls.mro():
+            for name, member in c.__dict__.iteritems():
+                if not isinstance( member, plug ) or member.name() == name:
+                    continue
+                if getattr( newcls, name ) is not member:
+                    continue        # overridden in a subclass
+                # try to set it
+                if hasattr( member, 'setName' ):
+                    member.setName( name )
+                else:
+                    raise AssertionError( "Plug %r is named %s, but must be named %s as in its class %s" % ( member, member.name(), name, newcls ) )
+                # END setName special handling
+            # END for each class member
+        # END for each class
 
         return newcls
+        
+    def _isPlugMember( cls, name ):
+        """:return: True if name refers to a plug in our class hierarchy"""
+        return any( isinstance( c.__dict__.get( name ), plug ) for c in cls.mro() )
+
+    def __setattr__( cls, name, value ):
+        """Plugs might be added to the class, they will be named after their member"""
+        changes_plugs = isinstance( value, plug ) or cls._isPlugMember( name )
+        if isinstance( value, plug ) and not value.name():
+            value.setName( name )
+        super( _NodeBaseCheckMeta, cls ).__setattr__( name, value )
+        if changes_plugs:
+            _invalidateClassPlugTables( cls )
 
+    def __delattr__( cls, name ):
+        """Plugs might be removed from the class"""
+        changes_plugs = cls._isPlugMember( name )
+        super( _NodeBaseCheckMeta, cls ).__delattr__( name )
+        if changes_plugs:
+            _invalidateClassPlugTables( cls )
 
 
 
@@ -1052,6 +1732,12 @@ class NodeBase( iDuplicatable ):
     shellcls = _PlugShell                   # class used to instantiate new shells
     __metaclass__ = _NodeBaseCheckMeta      # check the class before its being created
 
+    #{ Configuration
+    # if True, compute may be called from worker threads while other nodes compute
+    # concurrently. The node may not change anything but its own plugs
+    thread_safe = False
+    #} END configuration
+
     #{ Overridden from Object
     def __init__( self, *args, **kwargs ):
         """We require a directed graph to track the connectivity between the plugs.
@@ -1097,9 +1783,8 @@ class NodeBase( iDuplicatable ):
         """Just take the graph from other, but do not ( never ) duplicate it
         
         :param add_to_graph: if true, the new node instance will be added to the graph of
-        :note: default implementation does not copy plug caches ( which are stored in
-            the node dict - this is because a reevaluate is usually required on the
-            duplicated node"""
+        :note: default implementation does not copy plug caches - this is because
+            a reevaluate is usually required on the duplicated node"""
         self.setID( other.id() )                # id copying would create equally named clones for now
         if add_to_graph and other.graph:        # add ourselves to the graph of the other node
             other.graph.addNode( self )
@@ -1147,6 +1832,21 @@ class NodeBase( iDuplicatable ):
         """:return: a plugshell as suitable to for this class"""
         return getattr( self, 'shellcls' )( self, plug )        # prevent cls variable to be bound !
 
+    def cacheStore( self ):
+        """:return: `CacheStore` keeping the cached values of our plugs. It is owned
+            by our graph, or by ourselves while we are not part of a graph"""
+        if self.graph is not None:
+            try:
+                return self.graph.cacheStore()
+            except ReferenceError:
+                pass        # graph was deleted
+        # END use graph store
+
+        store = self.__dict__.get( '_plugcache' )
+        if store is None:
+            store = self.__dict__[ '_plugcache' ] = CacheStore()
+        return store
+
     def clearCache( self ):
         """Clear the cache of all plugs on this node - this basically forces it
         to recompute the next time an output plug is being queried"""
@@ -1154,53 +1854,68 @@ class NodeBase( iDuplicatable ):
             self.toShell( plug ).clearCache( clear_affected = False )
 
     @classmethod
-    def plugsStatic( cls, predicate = lambda x: True ):
+    def plugsStatic( cls, predicate = None ):
         """:return: list of static plugs as defined on this node - they are class members
         :param predicate: return static plug only if predicate is true
         :note: Use this method only if you do not have an instance - there are nodes
             that actually have no static plug information, but will dynamically generate them.
             For this to work, they need an instance - thus the plugs method is an instance
             method and is meant to be the most commonly used one."""
-        pred = lambda m: isinstance( m, plug )
+        plugs = _PlugTable.get( cls ).static
+        if predicate is None:
+            return list( plugs )
+        return [ p for p in plugs if predicate( p ) ]
 
-        # END sanity check
-        pluggen = ( m[1] for m in inspect.getmembers( cls, predicate = pred ) if predicate( m[1] ) )
-        return list( pluggen )
+    def _instancePlugs( self ):
+        """:return: list of plugs overridden on instance level"""
+        return [ v for v in self.__dict__.itervalues() if isinstance( v, plug ) ]
 
-    def plugs( self, predicate = lambda x: True ):
+    def plugs( self, predicate = None ):
         """:return: list of dynamic plugs as defined on this node - they are usually retrieved
             on class level, but may be overridden on instance level
         :param predicate: return static plug only if predicate is true"""
-        # the getmembers function appears to be ... buggy with my classes
-        # use special handling to assure he gets all the instance members AND the class members
-        # In ipython tests this worked as expected - get the dicts individually
-        all_dict_holders = itertools.chain( ( self, ), self.__class__.mro() )
-        all_dicts = ( instance.__dict__ for instance in all_dict_holders )
-        pluggen = ( v for d in all_dicts for v in d.itervalues() if isinstance( v, plug ) and predicate( v ) )
-
-        return list( pluggen )
+        # instance plugs come first, followed by the plugs of our class hierarchy
+        plugs = self._instancePlugs()
+        plugs.extend( _PlugTable.get( self.__class__ ).plugs )
+        if predicate is None:
+            return plugs
+        return [ p for p in plugs if predicate( p ) ]
 
     @classmethod
     def inputPlugsStatic( cls, **kwargs ):
         """:return: list of static plugs suitable as input
         :note: convenience method"""
+        if not kwargs:
+            return list( _PlugTable.get( cls ).staticinputs )
         return cls.plugsStatic( predicate = lambda p: p.providesInput(), **kwargs )
 
     def inputPlugs( self, **kwargs ):
         """:return: list of plugs suitable as input
         :note: convenience method"""
-        return self.plugs( predicate = lambda p: p.providesInput(), **kwargs )
+        table = _PlugTable.get( self.__class__ )
+        if kwargs or table.dynamic:
+            return self.plugs( predicate = lambda p: p.providesInput(), **kwargs )
+        plugs = [ p for p in self._instancePlugs() if p.providesInput() ]
+        plugs.extend( table.inputs )
+        return plugs
 
     @classmethod
     def outputPlugsStatic( cls, **kwargs ):
         """:return: list of static plugs suitable to deliver output
         :note: convenience method"""
+        if not kwargs:
+            return list( _PlugTable.get( cls ).staticoutputs )
         return cls.plugsStatic( predicate = lambda p: p.providesOutput(), **kwargs )
 
     def outputPlugs( self, **kwargs ):
         """:return: list of plugs suitable to deliver output
         :note: convenience method"""
-        return self.plugs( predicate = lambda p: p.providesOutput(), **kwargs )
+        table = _PlugTable.get( self.__class__ )
+        if kwargs or table.dynamic:
+            return self.plugs( predicate = lambda p: p.providesOutput(), **kwargs )
+        plugs = [ p for p in self._instancePlugs() if p.providesOutput() ]
+        plugs.extend( table.outputs )
+        return plugs
 
     def connections( self, inpt, output ):
         """:return: Tuples of input shells defining a connection of the given type from
@@ -1209,10 +1924,9 @@ class NodeBase( iDuplicatable ):
         :param inpt: include input connections to this node
         :param output: include output connections ( from this node to others )"""
         outConnections = list()
-        plugs = self.plugs()
         # HANDLE INPUT
         if inpt:
-            shells = self.toShells( ( p for p in plugs if p.providesInput() ) )
+            shells = self.toShells( self.inputPlugs() )
             for shell in shells:
                 ishell = shell.input( )
                 if ishell:
@@ -1222,7 +1936,7 @@ class NodeBase( iDuplicatable ):
 
         # HANDLE OUTPUT
         if output:
-            shells = self.toShells( ( p for p in plugs if p.providesOutput() ) )
+            shells = self.toShells( self.outputPlugs() )
             for shell in shells:
                 outConnections.extend( ( ( shell, oshell ) for oshell in shell.outputs() ) )
         # END output handling
@@ -1305,6 +2019,29 @@ class NodeBase( iDuplicatable ):
 
         return outSorted
 
+    @classmethod
+    def filterCompatiblePlugsMulti( cls, plugs, targets, **kwargs ):
+        """Rate many attributes or values against the same plugs at once.
+        Targets which cannot receive different ratings, like instances of the same class,
+        are rated only once.
+        
+        :param targets: iterable of attributes or values, see ``attrOrValue`` in `filterCompatiblePlugs`
+        :param kwargs: all arguments supported by `filterCompatiblePlugs`
+        :return: list of results as returned by `filterCompatiblePlugs`, one for each target, in order
+        :raise TypeError: if ambiguous input was found for any target and raise_on_ambiguity is set"""
+        plugs = list( plugs )
+        ratings = dict()
+        outResults = list()
+        for target in targets:
+            key = Attribute.ratingKey( target )
+            rating = ratings.get( key )
+            if rating is None:
+                rating = ratings[ key ] = cls.filterCompatiblePlugs( plugs, target, **kwargs )
+            # END rate target
+            outResults.append( list( rating ) )
+        # END for each target
+        return outResults
+
     #} END base
 
 
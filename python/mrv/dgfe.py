@@ -86,8 +86,11 @@ class _IOShellMeta( _OIShellMeta ):
                 # This means for get we specifiaclly override the normal "original last"
                 # behaviour to allow greater flexibility
                 oshell = self._getOriginalShell( )
-                if oshell.hasCache():
+                try:
                     return oshell.cache()
+                except ValueError:
+                    pass            # not cached
+                # END handle cache
 
                 return getattr( self._getShells( "input" )[0], funcname )( *args, **kwargs )
             method = unfacadeMethod
@@ -37,11 +37,14 @@ __docformat__ = "restructuredtext"
 __contact__='garret at bgb dot cc'
 __license__='freeware'
 
-import platform
+import sys
 
-__all__ = ("Element", "Enumeration", "create")
+__all__ = ("Element", "Flags", "Enumeration", "create")
 
-class Element(object):
+# integer types which may be ored with elements and flags
+_plainInts = ( int, long )
+
+class Element(int):
     """Internal helper class used to represent an ordered abstract value.
 
     The values have string representations, have strictly defined ordering
@@ -52,33 +55,73 @@ class Element(object):
 
     They assume that the enumeration member will be filled in before any
     comparisons are used. This is done by the Enumeration constructor.
-    """
-    # we do not define slots to stay pickable ( without reimplementing things )
+    
+    :note: Elements are integers carrying their value, which allows to use them
+        directly in integer operations. Equality is identity, hence comparisons
+        are O(1) and never involve the python level type checks of ordering."""
+    __slots__ = ("_name", "enumeration")
+    
+    def __new__(cls, name, value):
+        if not isinstance(value, (int, long)):
+            raise TypeError("Element values must be integers, got %r" % (value, ))
+        return int.__new__(cls, value)
+    
     def __init__(self, name, value):
         self._name = name
-        self._value = value
         self.enumeration = None # Will be filled in later
 
     def __repr__(self):
         return self._name
+        
+    __str__ = __repr__
+    
+    def __reduce__(self):
+        """Elements unpickle as members of their unpickled enumeration"""
+        if self.enumeration is None:
+            return (self.__class__, (self._name, int(self)))
+        return (_restoreElement, (self.enumeration, self._name))
+        
+    def __copy__(self):
+        return self
+        
+    def __deepcopy__(self, memo):
+        return self
 
     def _checkType( self, other ):
         """:raise TypeError: if other cannot be used with this element"""
-        if ( self.__class__ != other.__class__ ) or ( self.enumeration is not other.enumeration ):
+        if ( self.__class__ is not other.__class__ ) or ( self.enumeration is not other.enumeration ):
             raise TypeError( "%s is incompatible with %s" % ( other, self ) )
 
-    def __cmp__(self, other):
-        """We override cmp only because we want the ordering of elements
+    def __eq__(self, other):
+        return self is other
+        
+    def __ne__(self, other):
+        return self is not other
+        
+    __hash__ = int.__hash__
+    
+    def __lt__(self, other):
+        """We override the ordering only because we want the ordering of elements
         in an enumeration to reflect their position in the enumeration.
         """
-        try:
-            self._checkType( other )
-        except TypeError:
-            return NotImplemented   # to make cmp fail
-
-        # If we are both elements in the same enumeration, compare
-        #   values for ordering
-        return cmp(self._value, other._value)
+        if other.__class__ is not self.__class__ or other.enumeration is not self.enumeration:
+            return NotImplemented
+        return int.__cmp__(self, other) < 0
+        
+    def __le__(self, other):
+        if other.__class__ is not self.__class__ or other.enumeration is not self.enumeration:
+            return NotImplemented
+        return int.__cmp__(self, other) < 1
+        
+    def __gt__(self, other):
+        if other.__class__ is not self.__class__ or other.enumeration is not self.enumeration:
+            return NotImplemented
+        return int.__cmp__(self, other) > 0
+        
+    def __ge__(self, other):
+        if other.__class__ is not self.__class__ or other.enumeration is not self.enumeration:
+            return NotImplemented
+        return int.__cmp__(self, other) > -1
 
     def _checkBitflag( self ):
         if not self.enumeration._supports_bitflags:
@@ -88,11 +131,22 @@ class Element(object):
         """Allows oring values together - only works if the values are actually orable
         integer values
         
-        :return: integer with the ored result
-        :raise TypeError: if we are not a bitflag or other is not an element of our enumeration"""
-        self._checkType( other )
+        :param other: element or flags of our enumeration, or a plain integer
+            whose bits are part of our enumeration
+        :return: `Flags` instance with the ored result
+        :raise TypeError: if we are not a bitflag or other is not an element of our enumeration
+        :raise ValueError: if other is an integer with bits not being part of our enumeration"""
+        if other.__class__ in _plainInts:
+            pass
+        elif other.__class__ is not Flags:
+            self._checkType( other )
+        elif other.enumeration is not self.enumeration:
+            raise TypeError( "%s is incompatible with %s" % ( other, self ) )
+        # END handle other type
         self._checkBitflag()
-        return self.value() | other.value()
+        return self.enumeration.flags(int.__or__(self, other))
+    
+    __ror__ = __or__
 
     def __xor__( self, other ):
         """Allows to x-or values together - only works if element's values are xorable
@@ -101,7 +155,7 @@ class Element(object):
         :param other: integer
         :return: integer with the xored result"""
         self._checkBitflag()
-        return self.value() ^ other
+        return int.__xor__(self, other)
 
 
     def __and__( self, other ):
@@ -112,20 +166,73 @@ class Element(object):
         if not isinstance( other, int ):
             raise TypeError( "require integer, got %s" % type( other ) )
 
-        if self.value() & other:
+        if int.__and__(self, other):
             return self
 
         return None
 
     def value( self ):
         """:return: own value"""
-        return self._value
+        return int(self)
         
     def name( self ):
         """:return: name of the element"""
         return self._name
 
 
+class Flags(int):
+    """Integer representing a combination of Elements of a bitflag enumeration.
+    
+    Instances are obtained by oring elements or through `Enumeration.flags`, which
+    caches them so each combination exists only once.
+    Membership tests with ``in`` and ``&`` are plain integer operations, ``|`` with
+    elements or flags of the same enumeration, or integers within its range, returns
+    Flags again."""
+    __slots__ = ("enumeration", )
+    
+    def __new__(cls, value, enumeration):
+        inst = int.__new__(cls, value)
+        inst.enumeration = enumeration
+        return inst
+        
+    def __repr__(self):
+        return '|'.join(e.name() for e in self) or '0'
+        
+    __str__ = __repr__
+    
+    def __reduce__(self):
+        return (_restoreFlags, (self.enumeration, int(self)))
+        
+    def __copy__(self):
+        return self
+        
+    def __deepcopy__(self, memo):
+        return self
+    
+    def __or__(self, other):
+        """:return: Flags with the bits of other set as well
+        :raise TypeError: if other is no Element or Flags of our enumeration, or a plain integer
+        :raise ValueError: if other is an integer with bits not being part of our enumeration"""
+        if other.__class__ not in _plainInts and \
+            (getattr(other, 'enumeration', None) is not self.enumeration or \
+            (other.__class__ is not Flags and not isinstance(other, Element))):
+            raise TypeError( "%s is incompatible with %s" % ( other, self ) )
+        return self.enumeration.flags(int.__or__(self, other))
+    
+    __ror__ = __or__
+        
+    def __contains__(self, element):
+        """:return: True if the given element's bit is set"""
+        return bool(self & element)
+        
+    def __iter__(self):
+        """:return: iterator yielding all elements whose bit is set"""
+        for e in self.enumeration:
+            if self & e:
+                yield e
+        # END for each element
+
+
 class Enumeration(tuple):
     """This class represents an enumeration. You should not normally create
     multiple instances of the same enumeration, instead create one with
@@ -141,12 +248,13 @@ class Enumeration(tuple):
     are _repr_'d by the name of the element, which is convenient for testing,
     debugging, and generation text output.
 
-    :note: pickling this class with Elements will fail as they contain cyclic
-        references that it cannot deal with
-    :todo: implement proper pickle __getstate__ and __setstate__ that deal with
-        that problem
+    Enumerations and their Elements may be pickled. Enumerations created by `create`
+    which are reachable as module globals or class members of their module are 
+    pickled by reference, hence they unpickle as the very same instance. All others 
+    are pickled by value, and equal enumerations unpickle as the same instance.
     """
-    _slots_ = ( "_nameMap", "_valueMap", "_supports_bitflags" )
+    _slots_ = ( "_names", "_nameMap", "_valueMap", "_supports_bitflags", "_flagCache", 
+                "_module", "_reference" )
 
     def __new__(self, names, values, **kwargs ):
         """This method is needed to get the tuple parent class to do the
@@ -159,6 +267,31 @@ class Enumeration(tuple):
             return super( Enumeration, self ).__setattr__( name, value )
 
         raise AttributeError( "No assignments allowed" )
+        
+    def __reduce__(self):
+        """Pickle a reference to our module level instance if possible, otherwise 
+        pickle detached copies of our elements to break the cycle between elements 
+        and their enumeration"""
+        reference = self._findReference()
+        if reference is not None:
+            return (_lookupEnumeration, reference)
+        # END pickle by reference
+        
+        values = list()
+        for value in self:
+            if isinstance(value, Element):
+                value = value.__class__(value.name(), int(value))
+            # END detach elements
+            values.append(value)
+        # END for each value
+        return (_restoreEnumeration, (self.__class__, self._names, values, 
+                                      dict(_is_bitflag=self._supports_bitflags)))
+        
+    def __copy__(self):
+        return self
+        
+    def __deepcopy__(self, memo):
+        return self
 
     def __getattr__( self , attr ):
         """Prefer to return value from our value map"""
@@ -183,9 +316,13 @@ class Enumeration(tuple):
         # We are a tuple of our values, plus more....
         tuple.__init__(self)
 
+        self._names = tuple(names)
         self._nameMap = {}
         self._valueMap = {}
         self._supports_bitflags = kwargs.get( "_is_bitflag", False )        # insurance for bitflags
+        self._flagCache = {}
+        self._module = None                 # name of the module which created us, see `create`
+        self._reference = None              # ( module, attribute path ) we are reachable under
 
 
         for i in xrange(len(names)):
@@ -227,6 +364,55 @@ class Enumeration(tuple):
             raise ValueError("Value %r is not a member of this enumeration" % value)
         # END exception handling  
 
+    def flags(self, value=0):
+        """:return: `Flags` instance representing the given integer value, which 
+            may be a combination of our elements. Instances are cached, equal 
+            combinations will always return the same Flags instance
+        :param value: integer value, 0 by default
+        :raise TypeError: if we do not support bitflags
+        :raise ValueError: if value has bits set which are not part of this enumeration"""
+        try:
+            return self._flagCache[value]
+        except KeyError:
+            if not self._supports_bitflags:
+                raise TypeError("Enumeration %s has no bitflag support" % (self, ))
+            # END check bitflags
+            mask = 0
+            for elm in self:
+                mask |= int(elm)
+            # END for each element
+            if value & ~mask:
+                raise ValueError("Value %r has bits set which are not part of this enumeration" % value)
+            # END check range
+            flags = Flags(value, self)
+            self._flagCache[value] = flags
+            return flags
+        # END handle cache
+
+    def _findReference(self):
+        """:return: tuple( modulename, attributenames ) allowing to retrieve this instance
+            from the module which created it, or None if it is not reachable there"""
+        if self._reference is not None:
+            return self._reference
+        module = sys.modules.get(self._module)
+        if module is None:
+            return None
+        
+        for name, value in module.__dict__.items():
+            if value is self:
+                self._reference = (self._module, (name, ))
+            elif isinstance(value, type):
+                for attr, classvalue in value.__dict__.items():
+                    if classvalue is self:
+                        self._reference = (self._module, (name, attr))
+                        break
+                # END for each class member
+            # END check value
+            if self._reference is not None:
+                break
+        # END for each module global
+        return self._reference
+
     def _nextOrPrevious( self, element, direction, wrap_around ):
         """do-it method, see `next` and `previous`
         
@@ -273,16 +459,50 @@ class Enumeration(tuple):
     __call__ = valueFromName
 
 
+# Enumerations pickled by value, each combination is restored only once
+# ( cls, names, values, bitflag ) -> Enumeration
+_restoredEnumerations = dict()
+
+def _restoreEnumeration(cls, names, values, kwargs):
+    """:return: Enumeration of type cls, used when unpickling"""
+    key = (cls, tuple(names), tuple((v.__class__, int(v)) if isinstance(v, Element) else v for v in values), 
+           kwargs.get("_is_bitflag", False))
+    try:
+        return _restoredEnumerations[key]
+    except KeyError:
+        enumeration = _restoredEnumerations[key] = cls(names, values, **kwargs)
+        return enumeration
+    # END handle cache
+    
+def _lookupEnumeration(modulename, attributes):
+    """:return: Enumeration reachable from the given module by the given attribute names,
+        used when unpickling"""
+    __import__(modulename)
+    obj = sys.modules[modulename]
+    for attr in attributes:
+        obj = getattr(obj, attr)
+    # END for each attribute
+    return obj
+    
+def _restoreElement(enumeration, name):
+    """:return: element with the given name in enumeration, used when unpickling"""
+    return enumeration.valueFromName(name)
+    
+def _restoreFlags(enumeration, value):
+    """:return: Flags instance of enumeration, used when unpickling"""
+    return enumeration.flags(value)
+
+
 def create(*elements, **kwargs ):
     """Factory method for Enumerations. Accepts of list of values that
     can either be strings or (name, value) tuple pairs. Strings will
     have an Element created for use as their value.
     If you provide elements, the member returned when you access the enumeration
-    will be the element itself.
+    will be the element itself. Element values are integers.
 
     Example:  Enumeration.create('fred', 'bob', ('joe', 42))
     Example:  Enumeration.create('fred', cls = EnumerationSubClass )
-    Example:  Enumeration.create(Element('fred', Marge), ...)
+    Example:  Enumeration.create(Element('fred', 42), ...)
 
     :param kwargs: 
          * cls: The class to create an enumeration with, must be an instance of Enumeration
@@ -301,7 +521,8 @@ def create(*elements, **kwargs ):
 
     # check range
     if bitflag:
-        maxbits = int( platform.architecture()[0][:-3] )
+        # the sign bit cannot be used
+        maxbits = sys.maxint.bit_length()
         if maxbits < len( elements ):
             raise ValueError( "You system can only represent %i bits in one integer, %i tried" % ( maxbits, len( elements ) ) )
 
@@ -336,5 +557,7 @@ def create(*elements, **kwargs ):
             raise "Unsupported element type: %s" % type( element )
     # END for each element
 
-    return cls( names, values, **kwargs )
+    enumeration = cls( names, values, **kwargs )
+    enumeration._module = sys._getframe(1).f_globals.get('__name__')       # allows pickling by reference
+    return enumeration
 
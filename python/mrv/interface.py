@@ -2,7 +2,6 @@
 """Contains interface definitions """
 __docformat__ = "restructuredtext"
 
-from collections import deque as Deque
 import logging
 log = logging.getLogger('mrv.interface')
 
@@ -93,35 +92,24 @@ class iDagItem( Interface ):
 
     def childrenDeep( self , order = kOrder_BreadthFirst, predicate=lambda x: True ):
         """:return: list of all children of path, [ child1 , child2 ]
-        :param order: order enumeration
+        :param order: order enumeration, depth first returns the children of an item
+            before its next sibling
         :param predicate: returns true if x may be returned
         :note: the child objects returned are supposed to be valid paths, not just relative paths"""
-        out = []
+        # util imports this module
+        from util import ( collectGraph, kTraverseDepthFirst, kTraverseBreadthFirst )
         if order == self.kOrder_DepthFirst:
-            def depthSearch( child ):
-                if not predicate( c ):
-                    return
-                children = child.children( predicate = predicate )
-                for c in children:
-                    depthSearch( c )
-                out.append( child )
-            # END recursive search method
-
-            depthSearch( self )
-        # END if depth first
+            order = kTraverseDepthFirst
         elif order == self.kOrder_BreadthFirst:
-            childstack = Deque( [ self ] )
-            while childstack:
-                item = childstack.pop( )
-                if not predicate( item ):
-                    continue
-                children = item.children( predicate = predicate )
-
-                childstack.extendleft( children )
-                out.extend( children )
-            # END while childstack
-        # END if breadth first
-        return out
+            order = kTraverseBreadthFirst
+        else:
+            raise ValueError( "Invalid order: %r" % order )
+        # END convert order
+        
+        if not predicate( self ):
+            return list()
+        return collectGraph( self, lambda item: item.children( predicate = predicate ), order = order,
+                             visit_once = False, ignore_startitem = True )
 
     def isPartOf( self, other ):
         """:return: True if self is a part of other, and thus can be found in other
@@ -1,26 +1,201 @@
 # -*- coding: utf-8 -*-
-"""Contains parser allowing to retrieve dependency information from maya ascii files
+"""Contains parser allowing to retrieve dependency information from maya ascii and binary files
 and convert it into an easy-to-use networkx graph with convenience methods.
 """
 __docformat__ = "restructuredtext"
 
-from networkx import DiGraph, NetworkXError
+from networkx import DiGraph, NetworkXError, strongly_connected_components
 from util import iterNetworkxGraph
 from path import make_path
 
 import sys
 import os
 import re
+import cPickle
+import hashlib
+import struct
 
 import logging
 log = logging.getLogger("mrv.mdepparse")
 
+#{ Utilities
+
+def _fileDigest( filepath ):
+    """:return: md5 hex digest of the contents of the file at filepath"""
+    digest = hashlib.md5()
+    filehandle = open( filepath, "rb" )
+    try:
+        while True:
+            data = filehandle.read( 1024 * 1024 )
+            if not data:
+                break
+            digest.update( data )
+        # END for each block
+    finally:
+        filehandle.close()
+    return digest.hexdigest()
+
+def _scanFile( args ):
+    """Parse the references of a file whose entry in the `MayaFileIndex` is out of date
+    
+    :param args: tuple( graphcls, mafile, allPaths, stat, oldentry|None )
+    :return: tuple( mafile, newentry, None ) or tuple( mafile, None, errormessage ) on failure
+    :note: runs in worker processes, hence it must be a module level function"""
+    graphcls, mafile, allPaths, st, oldentry = args
+    allPaths = bool( allPaths )
+    try:
+        if oldentry is not None and oldentry[ MayaFileIndex.iDigest ] is not None and \
+            oldentry[ MayaFileIndex.iSize ] == st.st_size and \
+            oldentry[ MayaFileIndex.iAllPaths ] == allPaths:
+            # only the modification time changed - compare the content
+            digest = _fileDigest( os.path.expandvars( mafile ) )
+            if digest == oldentry[ MayaFileIndex.iDigest ]:
+                return ( mafile, ( st.st_mtime, st.st_size, digest, allPaths, oldentry[ MayaFileIndex.iRefs ] ), None )
+        # END check content
+        
+        refs = graphcls._parseReferences( mafile, allPaths )
+        
+        # the digest is only worth it if we read the whole file anyway
+        digest = None
+        if allPaths:
+            digest = _fileDigest( os.path.expandvars( mafile ) )
+        return ( mafile, ( st.st_mtime, st.st_size, digest, allPaths, refs ), None )
+    except IOError, e:
+        return ( mafile, None, str( e ) )
+    # END handle errors
+
+# tags of IFF chunks containing other chunks
+_iffgrouptags = set( ( 'FORM', 'FOR4', 'FOR8', 'LIST', 'LIS4', 'LIS8', 'CAT ', 'CAT4', 'CAT8', 'PROP' ) )
+
+def _iterIffChunks( filehandle ):
+    """Iterate all data chunks of the IFF file, like maya binary files, descending into groups.
+    Chunk data is not read, hence only the chunk headers are touched.
+    
+    :return: iterator yielding tuple( tag, dataoffset, datasize ) for each data chunk.
+        The file position may be changed while handling a chunk
+    :note: handles 32 bit ( FOR4 ) and 64 bit ( FOR8 ) files, which use 8 byte sizes
+        and alignment"""
+    filehandle.seek( 0 )
+    if filehandle.read( 4 ) == 'FOR8':
+        header, typesize, align = struct.Struct( '>4s4xQ' ), 8, 8
+    else:
+        header, typesize, align = struct.Struct( '>4sL' ), 4, 4
+    # END handle format
+
+    pos = 0
+    while True:
+        filehandle.seek( pos )
+        data = filehandle.read( header.size )
+        if len( data ) < header.size:
+            break
+        tag, size = header.unpack( data )
+        pos += header.size
+        
+        if tag in _iffgrouptags:
+            pos += typesize     # children follow the group type
+            continue
+        # END descend into groups
+        
+        yield ( tag, pos, size )
+        pos += size + ( -size % align )
+    # END for each chunk
+
+#} END utilities
+
+class MayaFileReference( object ):
+    """Describes a file statement of a maya ascii file, or a file reference of a maya binary file"""
+    __slots__ = ( 'path', 'is_reference', 'depth', 'namespace', 'reference_node' )
+    
+    def __init__( self, path, is_reference = True, depth = 0, namespace = None, reference_node = None ):
+        self.path = path                        # path as stored in the file
+        self.is_reference = is_reference        # True for -r statements, False for -rdi statements
+        self.depth = depth                      # value of -rdi, the depth of the reference in the hierarchy
+        self.namespace = namespace              # value of -ns, or None
+        self.reference_node = reference_node    # value of -rfn, or None
+        
+    def __repr__( self ):
+        return "%s(%r, is_reference=%r, depth=%i, namespace=%r, reference_node=%r)" % ( type( self ).__name__,
+                    self.path, self.is_reference, self.depth, self.namespace, self.reference_node )
+    
+
+class MayaFileIndex( object ):
+    """Keeps the references parsed from maya files along with the modification time,
+    size and possibly the content digest of the file. It allows to skip parsing files
+    that did not change since they have been parsed before.
+    
+    The index can be stored on disk and reloaded later"""
+    __slots__ = ( '_path', '_entries' )
+    
+    # indices into the entry tuples
+    iMTime, iSize, iDigest, iAllPaths, iRefs = range( 5 )
+    
+    def __init__( self, path = None ):
+        """Initialize the index, reading its entries from path if it exists
+        
+        :param path: if not None, the file the index will be read from and written to"""
+        self._path = path
+        self._entries = dict()
+        if path is not None and os.path.isfile( path ):
+            filehandle = open( path, "rb" )
+            try:
+                self._entries = cPickle.load( filehandle )
+            finally:
+                filehandle.close()
+        # END read existing index
+    
+    def __len__( self ):
+        return len( self._entries )
+    
+    def __contains__( self, mafile ):
+        return mafile in self._entries
+        
+    def entry( self, mafile ):
+        """:return: entry tuple( mtime, size, digest|None, allPaths, refs ) of the given file, or None"""
+        return self._entries.get( mafile )
+    
+    def setEntry( self, mafile, entry ):
+        """Set the given entry for mafile, see `entry`"""
+        self._entries[ mafile ] = entry
+        
+    def removeEntry( self, mafile ):
+        """Remove the entry of the given file if it exists"""
+        self._entries.pop( mafile, None )
+        
+    def isUpToDate( self, mafile, st, allPaths ):
+        """:return: True if the entry of mafile is still valid for a file with the given stat
+            result, parsed with the given allPaths mode"""
+        entry = self._entries.get( mafile )
+        if entry is None:
+            return False
+        return ( entry[ self.iMTime ] == st.st_mtime and entry[ self.iSize ] == st.st_size and
+                 entry[ self.iAllPaths ] == bool( allPaths ) )
+    
+    def save( self, path = None ):
+        """Write the index to the given path, or the path we were initialized with"""
+        path = path or self._path
+        if path is None:
+            raise ValueError( "No path given to write the index to" )
+        filehandle = open( path, "wb" )
+        try:
+            cPickle.dump( self._entries, filehandle, cPickle.HIGHEST_PROTOCOL )
+        finally:
+            filehandle.close()
+        # END assure file is closed
+
+
 class MayaFileGraph( DiGraph ):
     """Contains dependnecies between maya files including utility functions
     allowing to more easily find what you are looking for"""
     kAffects,kAffectedBy = range( 2 )
 
     refpathregex = re.compile( '.*-r .*"(.*)";' )
+    
+    # file statement at the start of a line, its flags and values in group 1, the file path in group 2
+    # NOTE: starting with a literal allows the regex engine to skip quickly to candidates
+    filestatementregex = re.compile( r'\nfile((?:\s+(?:"(?:[^"\\]|\\.)*"|[^\s";]+))*?)\s+"((?:[^"\\]|\\.)*)";' )
+    fileflagregex = re.compile( r'-(rdi|ns|rfn)\s+(?:"((?:[^"\\]|\\.)*)"|([^\s";]+))|-(r)\b' )
+    requiresregex = re.compile( r'\nrequires\b' )
+    scanblocksize = 1024 * 1024
 
     invalidNodeID = "__invalid__"
     invalidPrefix = ":_iv_:"
@@ -44,42 +219,115 @@ class MayaFileGraph( DiGraph ):
         self.add_edge( self.invalidNodeID, self.invalidPrefix + str( invalidfile ) )
 
     @classmethod
-    def _parseReferences( cls, mafile, allPaths = False ):
-        """:return: list of reference strings parsed from the given maya ascii file
+    def _referenceFromMatch( cls, match ):
+        """:return: `MayaFileReference` from a match of the filestatementregex"""
+        ref = MayaFileReference( match.group( 2 ), is_reference = False )
+        for flagmatch in cls.fileflagregex.finditer( match.group( 1 ) ):
+            flag = flagmatch.group( 1 ) or flagmatch.group( 4 )
+            value = flagmatch.group( 2 )
+            if value is None:
+                value = flagmatch.group( 3 )
+            # END get value
+            
+            if flag == 'r':
+                ref.is_reference = True
+            elif flag == 'rdi':
+                ref.depth = int( value )
+            elif flag == 'ns':
+                ref.namespace = value
+            elif flag == 'rfn':
+                ref.reference_node = value
+        # END for each flag
+        return ref
+
+    @classmethod
+    def _scanBinaryReferences( cls, mbfile, allPaths = False ):
+        """:return: list of `MayaFileReference` instances, one for each file reference
+            chunk in the given maya binary file
+        :param allPaths: if False, scanning stops at the first node, as the file 
+            references are stored in front of the nodes
         :raise IOError: if the file could not be read"""
         outrefs = list()
-        filehandle = open( os.path.expandvars( mafile ), "r" )
-
-        num_rdi_paths = 0       # amount of -rdi paths we found - lateron we have to remove the items
-                                # at the respective position as both lists match
-
-        # parse depends
-        for line in filehandle:
-
-            # take the stupid newlines into account !
-            line = line.strip()
-            if not line.endswith( ";" ):
-                try:
-                    line = line + filehandle.next()
-                except StopIteration:
+        filehandle = open( os.path.expandvars( mbfile ), "rb" )
+        try:
+            for tag, offset, size in _iterIffChunks( filehandle ):
+                if tag == 'CREA' and not allPaths:
                     break
-            # END newline special handling
-
-            match = cls.refpathregex.match( line )
-
-            if match:
-                outrefs.append( match.group(1) )
-            # END -r path match
-
-            # see whether we can abort early
-            if not allPaths and line.startswith( "requires" ):
-                break
-        # END for each line
-
-        filehandle.close()
+                if tag != 'FREF':
+                    continue
+                
+                # null terminated strings, starting with the path
+                filehandle.seek( offset )
+                path = filehandle.read( size ).split( '\0', 1 )[0]
+                if path:
+                    outrefs.append( MayaFileReference( path ) )
+            # END for each chunk
+        finally:
+            filehandle.close()
+        # END assure file is closed
+        return outrefs
 
+    @classmethod
+    def scanReferences( cls, mafile, allPaths = False ):
+        """:return: list of `MayaFileReference` instances, one for each file statement
+            in the given maya ascii file, or each file reference in the given maya binary file
+        :param allPaths: if True, the whole file will be scanned, otherwise scanning stops
+            at the requires section which follows the file statements, or at the first
+            node of a binary file. Walking binary files only touches the chunk headers
+        :note: the file is read in blocks, its memory consumption is bounded even if
+            the whole file needs to be scanned
+        :raise IOError: if the file could not be read"""
+        if os.path.splitext( mafile )[1] == ".mb":
+            return cls._scanBinaryReferences( mafile, allPaths )
+        # END handle binary files
+        
+        outrefs = list()
+        filehandle = open( os.path.expandvars( mafile ), "rb" )
+        try:
+            buf = '\n'         # all statements are preceded by a newline
+            while True:
+                block = filehandle.read( cls.scanblocksize )
+                buf += block
+                
+                end = len( buf )
+                if not allPaths:
+                    match = cls.requiresregex.search( buf )
+                    if match:
+                        end = match.start()
+                        block = ''              # stop after this buffer
+                    # END found requires section
+                # END check for end of header
+                
+                lastend = 0
+                for match in cls.filestatementregex.finditer( buf, 0, end ):
+                    outrefs.append( cls._referenceFromMatch( match ) )
+                    lastend = match.end()
+                # END for each file statement
+                
+                if not block:
+                    break
+                
+                # KEEP INCOMPLETE STATEMENTS
+                # Keep the last file statement if it is not yet terminated, otherwise
+                # just enough to find statement or section starts spanning the block boundary
+                keep = max( lastend, len( buf ) - 16 )
+                candidate = buf.rfind( '\nfile', lastend )
+                if candidate > -1 and buf.find( ';', candidate ) == -1:
+                    keep = min( keep, candidate )
+                buf = buf[ keep: ]
+            # END for each block
+        finally:
+            filehandle.close()
+        # END assure file is closed
+        
         return outrefs
 
+    @classmethod
+    def _parseReferences( cls, mafile, allPaths = False ):
+        """:return: list of reference strings parsed from the given maya ascii or binary file
+        :raise IOError: if the file could not be read"""
+        return [ ref.path for ref in cls.scanReferences( mafile, allPaths ) if ref.is_reference ]
+
     def _parseDepends( self, mafile, allPaths ):
         """:return: list of filepath as parsed from the given mafile.
         :param allPaths: if True, the whole file will be parsed, if False, only
@@ -97,9 +345,74 @@ class MayaFileGraph( DiGraph ):
         return outdepends
 
 
+    def _scanFiles( self, mafiles, allPaths, index, workers ):
+        """:return: iterator yielding tuple( mafile, refs ) for each of the given files.
+            Files which could not be read are added as invalid and yield no references
+        :param index: `MayaFileIndex` or None. Files with an up-to-date entry will not be parsed
+        :param workers: amount of processes to parse files with"""
+        if index is None and workers < 2:
+            for mafile in mafiles:
+                yield ( mafile, self._parseDepends( mafile, allPaths ) )
+            return
+        # END plain parsing
+        
+        tasks = list()
+        for mafile in mafiles:
+            try:
+                st = os.stat( os.path.expandvars( mafile ) )
+            except OSError, e:
+                self._addInvalid( mafile )
+                log.warn("Parsing Failed: %s" % str( e ))
+                yield ( mafile, list() )
+                continue
+            # END handle missing files
+            
+            if index is not None and index.isUpToDate( mafile, st, allPaths ):
+                yield ( mafile, index.entry( mafile )[ MayaFileIndex.iRefs ] )
+                continue
+            # END skip unchanged files
+            
+            oldentry = index is not None and index.entry( mafile ) or None
+            tasks.append( ( type( self ), mafile, allPaths, st, oldentry ) )
+        # END for each file
+        
+        if not tasks:
+            return
+        
+        pool = None
+        results = None
+        if workers > 1 and len( tasks ) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool( min( workers, len( tasks ) ) )
+            results = pool.imap_unordered( _scanFile, tasks, max( 1, min( 64, len( tasks ) / ( workers * 4 ) ) ) )
+        else:
+            results = ( _scanFile( task ) for task in tasks )
+        # END create results
+        
+        try:
+            for mafile, entry, errmsg in results:
+                log.info("Parsed %s" % ( mafile ))
+                if entry is None:
+                    self._addInvalid( mafile )
+                    log.warn("Parsing Failed: %s" % errmsg)
+                    if index is not None:
+                        index.removeEntry( mafile )
+                    yield ( mafile, list() )
+                    continue
+                # END handle failure
+                
+                if index is not None:
+                    index.setEntry( mafile, entry )
+                yield ( mafile, entry[ MayaFileIndex.iRefs ] )
+            # END for each result
+        finally:
+            if pool is not None:
+                pool.terminate()
+        # END assure pool is closed
+
     def addFromFiles( self, mafiles, parse_all_paths = False,
                     to_os_path = lambda f: make_path(f).expandvars(),
-                    os_path_to_db_key = lambda f: f):
+                    os_path_to_db_key = lambda f: f, index = None, workers = 0 ):
         """Parse the dependencies from the given maya ascii files and add them to
         this graph
         
@@ -107,57 +420,69 @@ class MayaFileGraph( DiGraph ):
         :param parse_all_paths: if True, default False, all paths found in the file will be used.
             This will slow down the parsing as the whole file will be searched for references
             instead of just the header of the file
-        :param to_os_path: functor returning an MA file from given posssibly parsed file
+        :param to_os_path: functor returning an ma or mb file from given posssibly parsed file
             that should be existing on the system parsing the files.
-            The passed in file could also be an mb file ( which cannot be parsed ), thus it
-            would be advantageous to return a corresponding ma file
             This is required as references can have environment variables inside of them
         :param os_path_to_db_key: converts the given path as used in the filesystem into
             a path to be used as key in the database. It should be general.
             Ideally, os_path_to_db_key is the inverse as to_os_path.
+        :param index: if not None, a `MayaFileIndex` keeping the references of files parsed
+            previously. Files which did not change since then will not be parsed again, the
+            index will be updated with all newly parsed files. Save it yourself afterwards.
+        :param workers: if larger than 1, files will be parsed by the given amount of
+            processes. Files are parsed in waves, each wave consisting of the files referenced
+            by the previous one
         :note: if the parsed path contain environment variables you must start the
             tool such that these can be resolved by the system. Otherwise files might
             not be found
         :todo: parse_all_paths still to be implemented"""
         files_parsed = set()                     # assure we do not duplicate work
-        for mafile in mafiles:
-            depfiles = [ mafile.strip() ]
-            while depfiles:
-                curfile = to_os_path( depfiles.pop() )
-
-                # ASSURE MA FILE
-                if os.path.splitext( curfile )[1] != ".ma":
-                    log.info( "Skipped non-ma file: %s" % curfile )
+        exists = dict()                          # os path -> bool, caches the existance checks
+        depfiles = [ mafile.strip() for mafile in mafiles ]
+        while depfiles:
+            # GATHER FILES
+            ##############
+            curfiles = list()
+            for depfile in depfiles:
+                curfile = to_os_path( depfile )
+
+                # ASSURE MAYA FILE
+                if os.path.splitext( curfile )[1] not in ( ".ma", ".mb" ):
+                    log.info( "Skipped non-maya file: %s" % curfile )
                     continue
-                # END assure ma file
+                # END assure maya file
 
                 if curfile in files_parsed:
                     continue
 
-                curfiledepends = self._parseDepends( curfile, parse_all_paths )
                 files_parsed.add( curfile )
-
-                # create edges
-                curfilestr = str( curfile )
-                valid_depends = list()
+                curfiles.append( curfile )
+            # END for each file to parse
+            depfiles = list()
+
+            for curfile, curfiledepends in self._scanFiles( curfiles, parse_all_paths, index, workers ):
+                # create edges - files without dependencies are kept as well
+                curfilekey = os_path_to_db_key( str( curfile ) )
+                self.add_node( curfilekey )
                 for depfile in curfiledepends:
-                    print depfile
                     # only valid files may be adjusted - we keep them as is otherwise
                     dbdepfile = to_os_path( depfile )
-                    print dbdepfile
-                    if os.path.exists( dbdepfile ):
-                        valid_depends.append( depfile )             # store the orig path - it will be converted later
+                    is_valid = exists.get( dbdepfile )
+                    if is_valid is None:
+                        is_valid = exists[ dbdepfile ] = os.path.exists( dbdepfile )
+                    # END cache existance check
+                    
+                    if is_valid:
+                        depfiles.append( depfile )                      # store the orig path - it will be converted later
                         dbdepfile = os_path_to_db_key( dbdepfile )      # make it db key path
                     else:
                         dbdepfile = depfile                             # invalid - revert it
                         self._addInvalid( depfile )                     # store it as invalid, no further processing
 
-                    self.add_edge( dbdepfile, os_path_to_db_key( curfilestr ) )
-
-                # add to stack and go on
-                depfiles.extend( valid_depends )
-            # END dependency loop
-        # END for each file to parse
+                    self.add_edge( dbdepfile, curfilekey )
+                # END for each dependency
+            # END for each parsed file
+        # END dependency loop
 
         #} END edit
 
@@ -165,9 +490,9 @@ class MayaFileGraph( DiGraph ):
     def depends( self, filePath, direction = kAffects,
                    to_os_path = lambda f: os.path.expandvars( f ),
                     os_path_to_db_key = lambda f: f, return_unresolved = False,
-                   invalid_only = False, **kwargs ):
+                   invalid_only = False, leaf_only = False, **kwargs ):
         """:return: list of paths ( converted to os paths ) that are related to
-            the given filePath
+            the given filePath, paths are returned before the paths they lead to
         :param direction: specifies search direction, either :
             kAffects = Files that filePath affects
             kAffectedBy = Files that affect filePath
@@ -177,34 +502,46 @@ class MayaFileGraph( DiGraph ):
             a valid key, depending on the format of filepaths stored in this graph
         :param invalid_only: if True, only invalid dependencies will be returned, all
             including the invalid ones otherwise
+        :param leaf_only: if True, only paths at the end of the dependency chains
+            will be returned
         :param to_os_path: see `addFromFiles`
         :param os_path_to_db_key: see `addFromFiles`
-        :param kwargs: passed to `iterNetworkxGraph`"""
-        kwargs[ 'direction' ] = direction
-        kwargs[ 'ignore_startitem' ] = 1            # default
-        kwargs[ 'branch_first' ] = 1        # default
-
+        :param kwargs: passed to `iterNetworkxGraph`. Unless they limit the traversal, 
+            for instance using depth, prune or stop, the query is answered from the 
+            cached reachability information, see `reachable`"""
         keypath = os_path_to_db_key( to_os_path( filePath ) )   # convert key
-        invalid = set( self.invalidFiles() )
+        invalid = self._invalidSet()
 
         if return_unresolved:
             to_os_path = lambda f: f
+        
+        degree = self.out_degree
+        if direction == self.kAffectedBy:
+            degree = self.in_degree
+        # END get leaf check
 
-        outlist = list()
-
-        try:
-            for d, f in iterNetworkxGraph( self, keypath, **kwargs ):
-                is_valid = f not in invalid
-                f = to_os_path( f )     # remap only valid paths
-
-                if is_valid and invalid_only:   # skip valid ones ?
-                    continue
-
-                outlist.append( f )
-            # END for each file in dependencies
-        except NetworkXError:
+        if not self.has_node( keypath ):
             log.debug( "Skipped Path %s ( %s ): unknown to dependency graph" % ( filePath, keypath ) )
-
+            return list()
+        # END handle unknown paths
+        
+        if self._isClosureQuery( kwargs ):
+            related = self._closureOrdered( self.reachable( keypath, direction ), direction )
+        else:
+            kwargs[ 'direction' ] = direction
+            kwargs[ 'ignore_startitem' ] = 1            # default
+            kwargs[ 'branch_first' ] = 1        # default
+            related = ( f for d, f in iterNetworkxGraph( self, keypath, **kwargs ) )
+        # END choose query
+        
+        outlist = list()
+        for f in related:
+            if invalid_only and f not in invalid:   # skip valid ones ?
+                continue
+            if leaf_only and degree( f ):
+                continue
+            outlist.append( to_os_path( f ) )
+        # END for each file in dependencies
         return outlist
 
     def invalidFiles( self ):
@@ -218,5 +555,349 @@ class MayaFileGraph( DiGraph ):
         except NetworkXError:
             return list()
         # END no invalid found exception handling
+        
+    def dependsMulti( self, filePaths, direction = kAffects,
+                        to_os_path = lambda f: os.path.expandvars( f ),
+                        os_path_to_db_key = lambda f: f, return_unresolved = False,
+                        invalid_only = False ):
+        """Bulk version of `depends`, answering the query for multiple files at once
+        using the cached reachability information of the graph.
+        
+        :return: dict mapping each of the given filePaths to a sorted list of all paths
+            related to it. Paths unknown to the graph map to empty lists
+        :note: see `depends` for a description of the arguments. As opposed to `depends`,
+            the depth of the search cannot be limited"""
+        invalid = self._invalidSet()
+        if return_unresolved:
+            outpath = lambda f: f
+        else:
+            outpath = to_os_path
+        # END handle path conversion
+        
+        out = dict()
+        for filePath in filePaths:
+            keypath = os_path_to_db_key( to_os_path( filePath ) )   # convert key
+            related = self.reachable( keypath, direction )
+            if invalid_only:
+                related = related & invalid
+            out[ filePath ] = sorted( outpath( f ) for f in related )
+        # END for each file path
+        return out
+        
+    def reachable( self, keypath, direction = kAffects ):
+        """:return: frozenset of all paths as stored in the graph which are related to 
+            keypath in the given direction, or an empty set if it is not part of the graph.
+        :param keypath: path as stored in the graph
+        :note: results are cached until the graph changes, repeated queries are 
+            answered in constant time"""
+        index = self._componentIndex()
+        compindex = index[ 'component' ].get( keypath )
+        if compindex is None:
+            return frozenset()
+        
+        related = self._componentClosure( compindex, direction )
+        members = index[ 'members' ][ compindex ]
+        if len( members ) > 1:
+            # all members of a reference cycle are related to each other
+            related = related | members.difference( ( keypath, ) )
+        return related
+    
+    #} END query
+    
+    #{ Caching
+    
+    @staticmethod
+    def _isClosureQuery( kwargs ):
+        """:return: True if a query using the given keyword arguments of `iterNetworkxGraph`
+            returns all related paths, which allows to use the cached closures"""
+        return ( kwargs.get( 'depth', -1 ) == -1 and kwargs.get( 'prune' ) is None and 
+                 kwargs.get( 'stop' ) is None and kwargs.get( 'visit_once', True ) and 
+                 kwargs.get( 'ignore_startitem', True ) and 
+                 not set( kwargs ).difference( ( 'depth', 'prune', 'stop', 'visit_once', 
+                                                 'ignore_startitem', 'branch_first' ) ) )
+        
+    def _closureOrdered( self, nodes, direction ):
+        """:return: list of the given nodes sorted such that each node comes before all
+            nodes reachable from it in direction
+        :note: as each node reaches less nodes than the nodes leading to it, sorting
+            by the size of the cached closures yields a topological order"""
+        index = self._componentIndex()
+        component = index[ 'component' ]
+        size = lambda n: len( self._componentClosure( component[ n ], direction ) )
+        return sorted( nodes, key = lambda n: ( -size( n ), n ) )
+    
+    def __getstate__( self ):
+        """Do not pickle our caches"""
+        state = self.__dict__.copy()
+        state.pop( '_querycache', None )
+        return state
+    
+    def _queryCache( self ):
+        """:return: dict for caching query information, it will be reset once the graph changes"""
+        cache = self.__dict__.get( '_querycache' )
+        if cache is None:
+            cache = self._querycache = dict()
+        return cache
+        
+    def _invalidateQueryCache( self ):
+        """Drop all cached query information"""
+        self.__dict__.pop( '_querycache', None )
+        
+    def _invalidSet( self ):
+        """:return: frozenset of all invalid files, see `invalidFiles`"""
+        cache = self._queryCache()
+        invalid = cache.get( 'invalid' )
+        if invalid is None:
+            invalid = cache[ 'invalid' ] = frozenset( self.invalidFiles() )
+        return invalid
+        
+    def _componentIndex( self ):
+        """:return: dict with the 'component' dict mapping each node to the index of its 
+            strongly connected component, the 'members' list with frozensets of nodes 
+            per component, and dicts caching closures for each direction"""
+        cache = self._queryCache()
+        index = cache.get( 'components' )
+        if index is None:
+            component = dict()
+            members = list()
+            for nodes in strongly_connected_components( self ):
+                for node in nodes:
+                    component[ node ] = len( members )
+                members.append( frozenset( nodes ) )
+            # END for each component
+            index = cache[ 'components' ] = { 'component' : component, 'members' : members,
+                                              self.kAffects : dict(), self.kAffectedBy : dict() }
+        # END build index
+        return index
+        
+    def _componentClosure( self, compindex, direction ):
+        """:return: frozenset of all nodes reachable from the component at compindex
+            in the given direction, excluding the component's own members.
+        :note: closures of all components reached are computed and cached as well"""
+        index = self._componentIndex()
+        component, members, closures = index[ 'component' ], index[ 'members' ], index[ direction ]
+        neighbors = self.successors_iter
+        if direction == self.kAffectedBy:
+            neighbors = self.predecessors_iter
+        
+        def adjacent( c ):
+            out = set( component[ n ] for m in members[ c ] for n in neighbors( m ) )
+            out.discard( c )
+            return out
+        # END utility
+        
+        # the components form an acyclic graph, hence a post-order walk allows
+        # to build each closure from the closures of the adjacent components
+        stack = [ ( compindex, False ) ]
+        while stack:
+            c, expanded = stack.pop()
+            if c in closures:
+                continue
+            
+            if expanded:
+                related = set()
+                for a in adjacent( c ):
+                    related |= members[ a ]
+                    related |= closures[ a ]
+                closures[ c ] = frozenset( related )
+            else:
+                stack.append( ( c, True ) )
+                stack.extend( ( a, False ) for a in adjacent( c ) if a not in closures )
+            # END handle expansion state
+        # END for each component
+        return closures[ compindex ]
+    
+    #} END caching
+    
+    
+def _queryCacheInvalidator( name ):
+    """:return: method calling the DiGraph method with the given name after dropping
+        the query cache of the graph"""
+    method = getattr( DiGraph, name )
+    def invalidate_and_call( self, *args, **kwargs ):
+        self._invalidateQueryCache()
+        return method( self, *args, **kwargs )
+    # END method
+    invalidate_and_call.__name__ = name
+    invalidate_and_call.__doc__ = method.__doc__
+    return invalidate_and_call
+
+# all methods changing the graph invalidate the cache
+for _methodname in ( 'add_node', 'add_nodes_from', 'remove_node', 'remove_nodes_from', 'add_edge',
+                     'add_edges_from', 'remove_edge', 'remove_edges_from', 'clear' ):
+    setattr( MayaFileGraph, _methodname, _queryCacheInvalidator( _methodname ) )
+del( _methodname )
+
+
+
+class MayaFileDatabase( object ):
+    """Stores the dependencies of a `MayaFileGraph` in an sqlite database, allowing
+    to query them without loading the whole graph.
+    
+    Paths are stored only once, dependencies are stored as pairs of path ids, indexed
+    in both directions."""
+    kAffects, kAffectedBy = MayaFileGraph.kAffects, MayaFileGraph.kAffectedBy
+    
+    # maximum amount of ids per query
+    querybatchsize = 500
+    
+    __slots__ = ( '_connection', )
+    
+    def __init__( self, path ):
+        """Open the database at the given path, it will be created if it does not exist"""
+        import sqlite3
+        self._connection = sqlite3.connect( path )
+        self._connection.text_factory = str
+        self._connection.executescript( """
+            CREATE TABLE IF NOT EXISTS files ( id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, 
+                                                invalid INTEGER NOT NULL DEFAULT 0 );
+            CREATE TABLE IF NOT EXISTS edges ( src INTEGER NOT NULL, dst INTEGER NOT NULL,
+                                                PRIMARY KEY ( src, dst ) );
+            CREATE INDEX IF NOT EXISTS edges_dst ON edges ( dst );
+            """ )
+    
+    def __len__( self ):
+        """:return: amount of files stored in the database"""
+        return self._connection.execute( "SELECT COUNT(*) FROM files" ).fetchone()[0]
+    
+    def close( self ):
+        """Close the database, this instance may not be used anymore afterwards"""
+        self._connection.close()
+    
+    #{ Edit
+    
+    def _fileIds( self, paths ):
+        """:return: dict mapping the given paths to their ids, files are added if required"""
+        cursor = self._connection.cursor()
+        cursor.executemany( "INSERT OR IGNORE INTO files ( path ) VALUES ( ? )", ( ( p, ) for p in paths ) )
+        ids = dict()
+        for batch in self._iterBatches( paths ):
+            query = "SELECT path, id FROM files WHERE path IN (%s)" % ",".join( "?" * len( batch ) )
+            ids.update( cursor.execute( query, batch ) )
+        # END for each batch
+        return ids
+    
+    def updateFromGraph( self, graph ):
+        """Update the database with the dependencies stored in the given graph.
+        
+        The dependencies of all files in graph will be replaced, even if they have no
+        dependencies anymore, all other dependencies will be kept. This allows to update the database
+        incrementally with a graph created from changed files only.
+        
+        :param graph: `MayaFileGraph` instance"""
+        invalid = set( graph.invalidFiles() )
+        ignore = lambda n: n == graph.invalidNodeID or n.startswith( graph.invalidPrefix )
+        paths = list( set( n for n in graph.nodes_iter() if not ignore( n ) ) | invalid )
+        
+        try:
+            ids = self._fileIds( paths )
+            cursor = self._connection.cursor()
+            for path in paths:
+                if not graph.has_node( path ):
+                    continue        # invalid file which could not be parsed
+                depends = [ p for p in graph.predecessors( path ) if not ignore( p ) ]
+                cursor.execute( "DELETE FROM edges WHERE dst = ?", ( ids[ path ], ) )
+                cursor.executemany( "INSERT OR IGNORE INTO edges ( src, dst ) VALUES ( ?, ? )",
+                                    ( ( ids[ d ], ids[ path ] ) for d in depends ) )
+            # END for each file
+            cursor.executemany( "UPDATE files SET invalid = ? WHERE id = ?", 
+                                ( ( int( path in invalid ), ids[ path ] ) for path in paths ) )
+            self._connection.commit()
+        except Exception:
+            self._connection.rollback()
+            raise
+        # END transaction
+    
+    #} END edit
+    
+    #{ Query
+    
+    def _iterBatches( self, items ):
+        """:return: iterator yielding lists of at most querybatchsize items"""
+        items = list( items )
+        for i in range( 0, len( items ), self.querybatchsize ):
+            yield items[ i : i + self.querybatchsize ]
+    
+    def depends( self, filePath, direction = kAffects,
+                   to_os_path = lambda f: os.path.expandvars( f ),
+                    os_path_to_db_key = lambda f: f, return_unresolved = False,
+                   invalid_only = False, depth = -1, leaf_only = False, **kwargs ):
+        """:return: list of paths ( converted to os paths ) that are related to
+            the given filePath, sorted by their distance to it
+        :param depth: if -1, all dependencies are returned, if 1 only direct dependencies
+            and so on
+        :param leaf_only: if True, only paths at the end of the dependency chains
+            will be returned
+        :param kwargs: ignored, for compatability with `MayaFileGraph.depends`
+        :note: see `MayaFileGraph.depends` for all other arguments"""
+        keypath = os_path_to_db_key( to_os_path( filePath ) )   # convert key
+        row = self._connection.execute( "SELECT id FROM files WHERE path = ?", ( keypath, ) ).fetchone()
+        if row is None:
+            log.debug( "Skipped Path %s ( %s ): unknown to dependency database" % ( filePath, keypath ) )
+            return list()
+        # END handle unknown files
+        
+        if return_unresolved:
+            to_os_path = lambda f: f
+        
+        srccol, dstcol = "src", "dst"
+        if direction == self.kAffectedBy:
+            srccol, dstcol = dstcol, srccol
+        
+        # WALK LEVELS
+        ##############
+        visited = set( ( row[0], ) )
+        level = [ row[0] ]
+        found = list()
+        d = 0
+        while level and ( depth < 0 or d < depth ):
+            d += 1
+            nextlevel = list()
+            for batch in self._iterBatches( level ):
+                query = "SELECT %s FROM edges WHERE %s IN (%s)" % ( dstcol, srccol, ",".join( "?" * len( batch ) ) )
+                for ( fid, ) in self._connection.execute( query, batch ):
+                    if fid not in visited:
+                        visited.add( fid )
+                        nextlevel.append( fid )
+                # END for each dependency
+            # END for each batch
+            found.extend( nextlevel )
+            level = nextlevel
+        # END for each level
+        
+        # RESOLVE PATHS
+        ################
+        info = dict()
+        for batch in self._iterBatches( found ):
+            query = "SELECT id, path, invalid, EXISTS ( SELECT 1 FROM edges WHERE edges.%s = files.id ) FROM files WHERE id IN (%s)" % ( srccol, ",".join( "?" * len( batch ) ) )
+            for fid, path, invalid, has_depends in self._connection.execute( query, batch ):
+                info[ fid ] = ( path, invalid, has_depends )
+        # END for each batch
+        
+        outlist = list()
+        for fid in found:
+            path, invalid, has_depends = info[ fid ]
+            if invalid_only and not invalid:
+                continue
+            if leaf_only and has_depends:
+                continue
+            outlist.append( to_os_path( path ) )
+        # END for each found file
+        return outlist
+    
+    def invalidFiles( self ):
+        """:return: list of filePaths that could not be parsed, most probably
+            because they could not be found by the system"""
+        return [ row[0] for row in self._connection.execute( "SELECT path FROM files WHERE invalid = 1" ) ]
+    
+    def toGraph( self ):
+        """:return: `MayaFileGraph` containing all dependencies stored in this database"""
+        graph = MayaFileGraph( )
+        paths = dict( self._connection.execute( "SELECT id, path FROM files" ) )
+        graph.add_nodes_from( paths.itervalues() )
+        graph.add_edges_from( ( paths[ src ], paths[ dst ] ) for src, dst in self._connection.execute( "SELECT src, dst FROM edges" ) )
+        for path in self.invalidFiles():
+            graph._addInvalid( path )
+        return graph
+    
     #} END query
-
@@ -15,6 +15,10 @@ import sys
 
 
 
+def isDatabaseFile( filepath ):
+    """:return: True if the given dependency file is a `MayaFileDatabase`"""
+    return filepath.endswith( ".db" )
+
 def main( fileList, **kwargs ):
     """Called if this module is called directly, creating a file containing
         dependency information
@@ -34,13 +38,16 @@ EDIT
 -----
 -t  Target file used to store the parsed dependency information
     If not given, the command will automatically be in query mode.
-    The file format is simply a pickle of the underlying Networkx graph
+    If the file ends with .db, the dependencies will be stored in an sqlite database
+    which can be queried without loading all dependencies. An existing database will be
+    updated with the dependencies of the parsed files.
+    Otherwise the file format is simply a pickle of the underlying Networkx graph
 
 -s  Source dependency file previously written with -t. If specified, this file
     will be read to quickly be read for queries. If not given, the information
     will be parsed first. Thus it is recommended to have a first run storing
     the dependencies and do all queries just reading in the dependencies using
-    -s
+    -s. Databases ending with .db are the fastest to query.
 
 -i  if given, a list of input files will be read from stdin. The tool will start
     parsing the files as the come through the pipe
@@ -49,6 +56,14 @@ EDIT
     than just parsing references as the whole file needs to be read
     TODO: actual implementation
 
+-j int
+    the amount of processes to use for parsing files, default 1
+
+--index indexfile
+    file keeping the references of all files parsed previously. Only files which
+    changed since they have been parsed the last time will be parsed again.
+    The index will be created if it does not exist, and updated after parsing
+
 --to-fs-map tokenmap
     map one part of the path to another in order to make it a valid path
     in the filesystem, i.e:
@@ -130,8 +145,8 @@ def tokensToRemapFunc( tokenstring ):
 if __name__ == "__main__":
     # parse the arguments as retrieved from the command line !
     try:
-        opts, rest = getopt.getopt( sys.argv[1:], "iat:s:ld:benvo:", [ "affects", "affected-by",
-                                                                        "to-fs-map=","to-db-map=" ] )
+        opts, rest = getopt.getopt( sys.argv[1:], "iat:s:ld:benvo:j:", [ "affects", "affected-by",
+                                                                        "to-fs-map=","to-db-map=", "index=" ] )
     except getopt.GetoptError,e:
         _usageAndExit( str( e ) )
 
@@ -146,6 +161,10 @@ if __name__ == "__main__":
     #####################
     allpaths = "-a" in opts
     kwargs_creategraph = dict( ( ( "parse_all_paths", allpaths ), ) )
+    kwargs_creategraph[ 'workers' ] = int( opts.get( "-j", 1 ) )
+    indexFile = opts.get( "--index", None )
+    if indexFile:
+        kwargs_creategraph[ 'index' ] = MayaFileIndex( indexFile )
     kwargs_query = dict()
 
     # PATH REMAPPING
@@ -181,10 +200,18 @@ if __name__ == "__main__":
 
     if not sourceFile:
         graph = main( filelist, **kwargs_creategraph )
+        if indexFile:
+            if verbose:
+                sys.stdout.write("Saving index to %s\n" % indexFile)
+            kwargs_creategraph[ 'index' ].save()
+        # END save index
     else:
         if verbose:
             sys.stdout.write("Reading dependencies from: %s\n" % sourceFile)
-        graph = gpickle.read_gpickle( sourceFile )
+        if isDatabaseFile( sourceFile ):
+            graph = MayaFileDatabase( sourceFile )
+        else:
+            graph = gpickle.read_gpickle( sourceFile )
 
 
 
@@ -194,7 +221,12 @@ if __name__ == "__main__":
     if targetFile:
         if verbose:
             sys.stdout.write("Saving dependencies to %s\n" % targetFile)
-        gpickle.write_gpickle( graph, targetFile )
+        if isinstance( graph, MayaFileDatabase ):
+            graph = graph.toGraph()
+        if isDatabaseFile( targetFile ):
+            MayaFileDatabase( targetFile ).updateFromGraph( graph )
+        else:
+            gpickle.write_gpickle( graph, targetFile )
 
 
     # QUERY MODE
@@ -216,11 +248,7 @@ if __name__ == "__main__":
         if not flag in opts:
             continue
 
-        # PREPARE LEAF FUNCTION
-        prune = lambda i,g: False
-        if "-l" in opts:
-            degreefunc = ( ( direction == MayaFileGraph.kAffects ) and MayaFileGraph.out_degree ) or MayaFileGraph.in_degree
-            prune = lambda i,g: degreefunc( g, i ) != 0
+        kwargs_query[ 'leaf_only' ] = "-l" in opts
 
         listcopy = list()           # as we read from iterators ( stdin ), its required to copy it to iterate it again
 
@@ -230,7 +258,7 @@ if __name__ == "__main__":
             listcopy.append( filepath )
             queried_files = True            # used as flag to determine whether filers have been applied or not
             filepath = filepath.strip()     # could be from stdin
-            depends = graph.depends( filepath, direction = direction, prune = prune,
+            depends = graph.depends( filepath, direction = direction,
                                         visit_once=1, branch_first=1, depth=depth,
                                         return_unresolved=0, **kwargs_query )
 
@@ -292,6 +320,8 @@ if __name__ == "__main__":
         else:
             if queried_files and dotgraph is not None:
                 pydot.write_dot( dotgraph, dotOutputFile )
+            elif isinstance( graph, MayaFileDatabase ):
+                pydot.write_dot( graph.toGraph(), dotOutputFile )
             else:
                 pydot.write_dot( graph, dotOutputFile )
     # END dot writing
@@ -38,11 +38,15 @@ import glob
 import shutil
 import codecs
 import re
+import stat
+import threading
+import Queue
+import cPickle
 from interface import iDagItem
 log = logging.getLogger("mrv.path")
 
 __version__ = '3.0'
-__all__ = ['Path', 'BasePath', 'make_path']
+__all__ = ['Path', 'BasePath', 'make_path', 'DigestCache']
 
 # Platform-specific support for path.owner
 if os.name == 'nt':
@@ -56,6 +60,16 @@ else:
     except ImportError:
         pwd = None
 
+# Directory listings providing the type of each entry
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+# END handle scandir availability
+
 # Pre-2.3 support.  Are unicode filenames supported?
 _base = str
 _getcwd = os.getcwd
@@ -87,10 +101,210 @@ if hasattr(file, 'newlines'):
 # cache used for path expansion
 _varprog = re.compile(r'\$(\w+|\{[^}]*\})')
 
+# path string -> (expanded path, ((varname, value), ...)) - the value tuple is the
+# fingerprint of the environment the expansion depended on, value is None if
+# the variable was not set
+_expandcache = dict()
+_MAXEXPANDCACHE = 10000
+
+# amount of bytes to read at once when computing digests
+_digestchunksize = 1024 * 1024
+
 class TreeWalkWarning(Warning):
     pass
 
 
+#{ Utilities
+
+def _listdir_types(dirpath):
+    """:return: list of tuples(name, isdir, isfile) for each item in the directory at dirpath.
+        Items which cannot be accessed are neither directories nor files
+    :raise OSError: if dirpath cannot be listed
+    :note: uses scandir if available, which provides the types without additional system calls"""
+    out = list()
+    if _scandir is not None:
+        for entry in _scandir(dirpath):
+            try:
+                isdir = entry.is_dir()
+                isfile = not isdir and entry.is_file()
+            except OSError:
+                isdir = isfile = False
+            # END handle inaccessible entries
+            out.append((entry.name, isdir, isfile))
+        # END for each entry
+        return out
+    # END scandir
+    
+    for name in os.listdir(dirpath):
+        try:
+            mode = os.stat(os.path.join(dirpath, name)).st_mode
+        except OSError:
+            mode = 0
+        # END handle inaccessible entries
+        out.append((name, stat.S_ISDIR(mode), stat.S_ISREG(mode)))
+    # END for each name
+    return out
+
+
+class _DirectoryLister(object):
+    """Lists directories on a pool of threads, allowing to list directories ahead of time.
+    This pays off on network file systems, which have a high latency per call"""
+    __slots__ = ('_queue', '_results', '_cond', '_stopped', '_threads')
+    _pending = object()
+    
+    def __init__(self, workers):
+        self._queue = Queue.Queue()
+        self._results = dict()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = list()
+        for i in range(workers):
+            t = threading.Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+        # END for each worker
+        
+    def _run(self):
+        """Worker thread main loop"""
+        while True:
+            dirpath = self._queue.get()
+            if dirpath is None or self._stopped:
+                return
+            try:
+                result = (_listdir_types(dirpath), None)
+            except Exception:
+                result = (None, sys.exc_info()[1])
+            # END handle errors
+            
+            self._cond.acquire()
+            try:
+                if dirpath in self._results:
+                    self._results[dirpath] = result
+                    self._cond.notifyAll()
+                # END store result if still required
+            finally:
+                self._cond.release()
+        # END for each directory
+        
+    def request(self, dirpath):
+        """Start listing the given directory"""
+        self._cond.acquire()
+        try:
+            if dirpath in self._results:
+                return
+            self._results[dirpath] = self._pending
+        finally:
+            self._cond.release()
+        self._queue.put(dirpath)
+        
+    def get(self, dirpath):
+        """:return: listing of dirpath as returned by `_listdir_types`
+        :raise OSError: if the directory could not be listed"""
+        self.request(dirpath)
+        self._cond.acquire()
+        try:
+            while self._results[dirpath] is self._pending:
+                self._cond.wait()
+            entries, exc = self._results.pop(dirpath)
+        finally:
+            self._cond.release()
+        # END wait for result
+        
+        if exc is not None:
+            raise exc
+        return entries
+        
+    def stop(self):
+        """Stop all workers, pending requests will not be handled anymore"""
+        self._stopped = True
+        for t in self._threads:
+            self._queue.put(None)
+        # END for each thread
+        
+
+def _digest_file(filepath, hashobject):
+    """:return: digest of the file at the given os path, computed using hashobject"""
+    f = open(filepath, 'rb')
+    try:
+        while True:
+            d = f.read(_digestchunksize)
+            if not d:
+                break
+            hashobject.update(d)
+        # END for each chunk
+    finally:
+        f.close()
+    # END assure file gets closed
+    return hashobject.digest()
+
+#} END utilities
+
+
+class DigestCache(object):
+    """Keeps the digests of files keyed by their device, inode, size and modification 
+    time, which allows to skip hashing files which did not change.
+    
+    As the path is not part of the key, moved or renamed files keep their digest.
+    On systems without inode numbers, the path will be used instead.
+    
+    The cache can be stored on disk and reloaded later"""
+    __slots__ = ('_path', '_entries')
+    
+    def __init__(self, path=None):
+        """Initialize the cache, reading its entries from path if it exists
+        
+        :param path: if not None, the file the cache will be read from and written to"""
+        self._path = path
+        self._entries = dict()
+        if path is not None and os.path.isfile(path):
+            f = open(path, 'rb')
+            try:
+                self._entries = cPickle.load(f)
+            finally:
+                f.close()
+        # END read existing cache
+        
+    def __len__(self):
+        return len(self._entries)
+        
+    @classmethod
+    def _key(cls, filepath, st, hashname):
+        """:return: key for the file at filepath with the given stat result"""
+        if st.st_ino:
+            location = (st.st_dev, st.st_ino)
+        else:
+            location = os.path.normcase(os.path.abspath(filepath))
+        # END handle missing inodes
+        return (hashname, location, st.st_size, st.st_mtime)
+        
+    def get(self, filepath, st, hashname):
+        """:return: cached digest of the file at filepath, computed with the hash 
+            algorithm called hashname, or None if it is unknown or outdated
+        :param st: result of os.stat(filepath)"""
+        return self._entries.get(self._key(filepath, st, hashname))
+        
+    def set(self, filepath, st, hashname, digest):
+        """Store the digest of the file at filepath, see `get`"""
+        self._entries[self._key(filepath, st, hashname)] = digest
+        
+    def clear(self):
+        """Remove all entries"""
+        self._entries.clear()
+        
+    def save(self, path=None):
+        """Write the cache to the given path, or the path we were initialized with"""
+        path = path or self._path
+        if path is None:
+            raise ValueError("No path given to write the cache to")
+        f = open(path, 'wb')
+        try:
+            cPickle.dump(self._entries, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        # END assure file is closed
+
+
 class Path( _base, iDagItem ):
     """ Represents a filesystem path.
 
@@ -202,10 +416,32 @@ class Path( _base, iDagItem ):
         
         :note: It is a slightly changed copy of the version in posixfile
             as the windows version was implemented differently ( it expands
-            variables to an empty space which is undesireable )"""
+            variables to an empty space which is undesireable )
+        :note: results are cached per path string. A cached result is only used
+            if all variables it was expanded from still have the same values in 
+            the environment"""
         if '$' not in path:
             return path
         
+        key = path
+        if isinstance(key, BasePath):
+            # our own hash expands variables
+            key = _base(key)
+        # END assure plain string key
+        
+        cached = _expandcache.get(key)
+        if cached is not None:
+            rval, fingerprint = cached
+            getenv = os.environ.get
+            for name, value in fingerprint:
+                if getenv(name) != value:
+                    break
+            else:
+                return rval
+            # END verify environment didn't change
+        # END handle cache
+        
+        fingerprint = list()
         i = 0
         while True:
             m = _varprog.search(path, i)
@@ -215,20 +451,29 @@ class Path( _base, iDagItem ):
             name = m.group(1)
             if name.startswith('{') and name.endswith('}'):
                 name = name[1:-1]
-            if name in os.environ:
+            value = os.environ.get(name)
+            fingerprint.append((name, value))
+            if value is not None:
                 tail = path[j:]
-                path = path[:i] + os.environ[name]
+                path = path[:i] + value
                 i = len(path)
                 path += tail
             else:
                 i = j
             # END handle variable exists in environ
         # END loop forever
+        
+        if len(_expandcache) >= _MAXEXPANDCACHE:
+            _expandcache.clear()
+        # END prune cache
+        _expandcache[key] = (path, tuple(fingerprint))
         return path 
 
     @classmethod
     def _expandvars_deep(cls, path):
         """As above, but recursively expands as many variables as possible"""
+        if '$' not in path:
+            return path
         rval = cls._expandvars(path)
         while str(rval) != str(path):
             path = rval
@@ -250,6 +495,15 @@ class Path( _base, iDagItem ):
         """Expands all environment variables recursively"""
         return type(self)(self._expandvars_deep(self))
         
+    def frozen(self):
+        """:return: copy of self with all environment variables expanded recursively
+            and the user directory expanded, based on the environment as it is now.
+            
+            Use it within hot loops doing many queries on the same path, as 
+            the returned path does not need to be expanded anymore. It will not 
+            follow changes to the environment though."""
+        return type(self)(os.path.expanduser(self._expandvars_deep(self)))
+        
     def expandvars_deep_or_raise(self):
         """Expands all environment variables recursively, and raises ValueError
         if the path still contains variables afterwards"""
@@ -485,7 +739,7 @@ class Path( _base, iDagItem ):
 
         return [p for p in self.listdir(pattern) if p.isfile()]
 
-    def walk(self, pattern=None, errors='strict', predicate=lambda p: True):
+    def walk(self, pattern=None, errors='strict', predicate=lambda p: True, workers=0):
         """create iterator over files and subdirs, recursively.
 
         The iterator yields path objects naming each child item of
@@ -500,63 +754,103 @@ class Path( _base, iDagItem ):
             exception.  The other allowed values are 'warn', which
             reports the error via log.warn(), and 'ignore'.
         :param predicate: returns True for each Path p to be yielded by iterator
+        :param workers: if larger than 1, directories will be listed ahead of time by
+            the given amount of threads, which speeds up walking network file systems.
+            The order of the items is not affected
         """
-        if errors not in ('strict', 'warn', 'ignore'):
-            raise ValueError("invalid errors parameter")
-
+        return self._walk(pattern, errors, predicate, None, workers)
+        
+    def _walk_listing(self, dirpath, errors, lister):
+        """:return: listing of dirpath as returned by `_listdir_types`, or None if it could not
+            be listed and errors is not 'strict'"""
         try:
-            childList = self.listdir()
+            if lister is not None:
+                return lister.get(self._expandvars(dirpath))
+            return _listdir_types(self._expandvars(dirpath))
         except Exception:
             if errors == 'ignore':
-                return
+                return None
             elif errors == 'warn':
                 log.warn(
                     "Unable to list directory '%s': %s"
-                    % (self, sys.exc_info()[1]))
-                childList = list()
+                    % (dirpath, sys.exc_info()[1]))
+                return None
             else:
                 raise
             # END handle errors value
         # END listdir exception handling
-
-        for child in childList:
-            if ( pattern is None or child.fnmatch(pattern) ) and predicate(child):
-                yield child
-                
-            try:
-                isdir = child.isdir()
-            except Exception:
-                isdir = False
-                if errors == 'ignore':
-                    pass
-                elif errors == 'warn':
-                    log.warn(
-                        "Unable to access '%s': %s"
-                        % (child, sys.exc_info()[1]))
-                else:
-                    raise
-                # END handle errors value
-            # END directory access exception handling
+        
+    def _walk(self, pattern, errors, predicate, kind, workers):
+        """Implements `walk`, `walkdirs` and `walkfiles`
+        
+        :param kind: None to yield all items, 'dir' or 'file' to yield only directories 
+            or files respectively"""
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
             
-            if not isdir:
-                continue
+        match = None
+        if pattern is not None:
+            match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+        # END precompile pattern
+        
+        lister = None
+        if workers > 1:
+            lister = _DirectoryLister(workers)
+        # END setup threads
+        
+        def listing(dirpath):
+            entries = self._walk_listing(dirpath, errors, lister)
+            if lister is not None and entries:
+                for name, isdir, isfile in entries:
+                    if isdir:
+                        lister.request(self._expandvars(dirpath / name))
+                # END for each subdirectory
+            # END prefetch subdirectories
+            return entries
+        # END utility
+        
+        try:
+            entries = listing(self)
+            if not entries:
+                return
                 
-            for item in child.walk(pattern, errors, predicate):
-                yield item
-            # END for each item
-        # END for each child in childlist
+            # iterative depth first traversal, keeping the listing of each directory
+            # on the current branch
+            stack = [(self, iter(entries))]
+            while stack:
+                parent, items = stack[-1]
+                for name, isdir, isfile in items:
+                    child = parent / name
+                    if ((match is None or match(os.path.normcase(name))) and 
+                        (kind is None or (kind == 'dir' and isdir) or (kind == 'file' and isfile)) and
+                        predicate(child)):
+                        yield child
+                    # END yield child
+                    
+                    if isdir:
+                        entries = listing(child)
+                        if entries:
+                            stack.append((child, iter(entries)))
+                            break
+                    # END descend into directory
+                else:
+                    stack.pop()
+                # END for each item
+            # END while there are directories
+        finally:
+            if lister is not None:
+                lister.stop()
+        # END assure threads are stopped
 
-    def walkdirs(self, pattern=None, errors='strict', predicate=lambda p: True):
+    def walkdirs(self, pattern=None, errors='strict', predicate=lambda p: True, workers=0):
         """ D.walkdirs() -> iterator over subdirs, recursively.
         see `walk` for a parameter description """
-        pred = lambda p: p.isdir() and predicate(p)
-        return self.walk(pattern, errors, pred)
+        return self._walk(pattern, errors, predicate, 'dir', workers)
 
-    def walkfiles(self, pattern=None, errors='strict', predicate=lambda p: True):
+    def walkfiles(self, pattern=None, errors='strict', predicate=lambda p: True, workers=0):
         """ D.walkfiles() -> iterator over files in D, recursively.
         see `walk` for a parameter description"""
-        pred = lambda p: p.isfile() and predicate(p)
-        return self.walk(pattern, errors, pred)
+        return self._walk(pattern, errors, predicate, 'file', workers)
         
     def fnmatch(self, pattern):
         """ Return True if self.basename() matches the given pattern.
@@ -836,18 +1130,134 @@ class Path( _base, iDagItem ):
         :note: This reads through the entire file.
         """
 
-        f = self.open('rb')
+        return _digest_file(self._expandvars(self), hashobject)
+        
+    @classmethod
+    def _digest_item(cls, path, hashfactory, cache):
+        """:return: digest of the given path, using and updating the cache if possible"""
+        filepath = cls._expandvars_deep(path)
+        if cache is None:
+            return _digest_file(filepath, hashfactory())
+        
+        hashobject = hashfactory()
+        hashname = getattr(hashobject, 'name', None)
+        if hashname is None:
+            return _digest_file(filepath, hashobject)
+        
+        st = os.stat(filepath)
+        digest = cache.get(filepath, st, hashname)
+        if digest is None:
+            digest = _digest_file(filepath, hashobject)
+            # the file could have changed while we were reading it
+            if os.stat(filepath).st_mtime == st.st_mtime:
+                cache.set(filepath, st, hashname, digest)
+            # END cache digest of unchanged file
+        # END compute digest
+        return digest
+        
+    @classmethod
+    def digests(cls, paths, hashfactory, workers=0, cache=None, errors='strict'):
+        """Compute the digests of many files, possibly in parallel.
+        
+        :return: iterator yielding (path, digest) tuples as soon as the digest of 
+            a path is available. If workers is larger than 1, the order will not
+            correspond to the order of paths.
+        :param paths: iterable of paths or strings, it will be consumed lazily
+        :param hashfactory: callable returning a new hash object which supports the 
+            'update' and 'digest' methods, like hashlib.md5
+        :param workers: if larger than 1, files will be read and hashed by the 
+            given amount of threads. As file reads and hashlib release the interpreter 
+            lock, this pays off for large files or network file systems
+        :param cache: `DigestCache` instance or None. If set, the digests of unchanged
+            files will be taken from the cache, and new digests will be added to it.
+            The hash objects need a 'name' attribute to be cached, like the ones 
+            provided by hashlib
+        :param errors: controls behavior when a file cannot be read. The default is 
+            'strict', which causes an exception. The other allowed values are 'warn', 
+            which reports the error via log.warn(), and 'ignore'."""
+        if workers < 2:
+            for path in paths:
+                path = cls(path)
+                try:
+                    digest = cls._digest_item(path, hashfactory, cache)
+                except (OSError, IOError):
+                    if errors == 'strict':
+                        raise
+                    elif errors == 'warn':
+                        log.warn("Unable to compute digest of '%s': %s" % (path, sys.exc_info()[1]))
+                    continue
+                # END handle errors
+                yield (path, digest)
+            # END for each path
+            return
+        # END serial mode
+        
+        inqueue = Queue.Queue(workers * 4)
+        outqueue = Queue.Queue()
+        done = object()
+        state = dict(stopped=False)
+        
+        def feed():
+            try:
+                try:
+                    for path in paths:
+                        if state['stopped']:
+                            break
+                        inqueue.put(cls(path))
+                    # END for each path
+                except Exception:
+                    outqueue.put((None, sys.exc_info()[1]))
+                # END handle iteration errors
+            finally:
+                for i in range(workers):
+                    inqueue.put(done)
+            # END assure workers will finish
+            
+        def work():
+            try:
+                while True:
+                    path = inqueue.get()
+                    if path is done:
+                        break
+                    if state['stopped']:
+                        continue
+                    try:
+                        outqueue.put((path, cls._digest_item(path, hashfactory, cache)))
+                    except Exception:
+                        outqueue.put((path, sys.exc_info()[1]))
+                    # END handle errors
+                # END for each path
+            finally:
+                outqueue.put(done)
+            # END assure we are accounted for
+        
+        threads = [threading.Thread(target=feed)]
+        threads.extend(threading.Thread(target=work) for i in range(workers))
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        # END for each thread
+        
         try:
-            while True:
-                d = f.read(8192)
-                if not d:
-                    break
-                hashobject.update(d)
+            remaining = workers
+            while remaining:
+                item = outqueue.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                path, digest = item
+                if isinstance(digest, Exception):
+                    if path is None or errors == 'strict' or not isinstance(digest, (OSError, IOError)):
+                        raise digest
+                    elif errors == 'warn':
+                        log.warn("Unable to compute digest of '%s': %s" % (path, digest))
+                    continue
+                # END handle errors
+                yield item
+            # END for each result
         finally:
-            f.close()
-        # END assure file gets closed
-        
-        return hashobject.digest()
+            state['stopped'] = True
+        # END assure threads stop if we are interrupted
 
     #} END Reading or writing an enitre file at once
 
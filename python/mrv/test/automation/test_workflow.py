@@ -109,9 +109,53 @@ class TestWorkflow( unittest.TestCase ):
                     outtypeinst = outtype()
 
                 scwfl.makeTargets( (1.0,2.0,3.0), errtypeinst, outtypeinst )
+                scwfl.makeTargets( (1.0,2.0,3.0), errtypeinst, outtypeinst, batch=True )
             # END for each done type
         # END for each outtype
 
+    def test_batchTargets( self ):
+        scwfl = workflows.simpleconnection
+        targets = ( 1.0, 5, 2.0, "someInput", {}, 3.0, 4 )
+
+        # batch mode reports the same results as the serial mode, but in group order
+        def make( **kwargs ):
+            err, done = StringIO(), list()
+            scwfl.makeTargets( targets, err, done, **kwargs )
+            return err.getvalue(), done
+        # END utility
+
+        serialerr, serialdone = make( )
+        batcherr, batchdone = make( batch=True )
+        self.failUnless( sorted( batchdone ) == sorted( serialdone ) )
+        self.failUnless( serialerr.count( "UNHANDLED" ) == batcherr.count( "UNHANDLED" ) == 1 )
+        # targets of the same type stay in order
+        self.failUnless( [ t for t in batchdone if isinstance( t, float ) ] == [ 1.0, 2.0, 3.0 ] )
+
+        # routes are resolved per target, as targets may be rated by value
+        calls = list()
+        targetRating = scwfl.targetRating
+        def valueRating( target ):
+            calls.append( target )
+            if target == 2.0:
+                return ( 0, None )
+            return targetRating( target )
+        scwfl.targetRating = valueRating
+        try:
+            err, done = make( batch=True )
+        finally:
+            del( scwfl.targetRating )
+        self.failUnless( calls == list( targets ) )
+        self.failUnless( err.count( "UNHANDLED" ) == 2 and "Cannot handle target 2.0" in err )
+
+        # results are still correct when making single targets afterwards
+        self.failUnless( scwfl.makeTarget( 2.0 ) == 8.0 )
+        self.failUnless( scwfl.makeTarget( 4 ) == 16 )
+
+        # worker processes
+        workererr, workerdone = make( workers=2 )
+        self.failUnless( sorted( workerdone ) == sorted( serialdone ) )
+        self.failUnless( workererr.count( "UNHANDLED" ) == 1 )
+
 
 
     def test_workflowfacades( self ):
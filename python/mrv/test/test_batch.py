@@ -13,10 +13,141 @@ else:
 
 
 import mrv.batch as batch
+from cStringIO import StringIO
+import time
+import os
+import sys
+import tempfile
+
+def residentItem( item ):
+    """Called by resident workers for each item"""
+    print "output must not disturb the worker protocol"
+    open( os.environ[ 'MRV_TEST_BATCH_PIDS' ], 'a' ).write( "%i\n" % os.getpid() )
+    if item == "fail":
+        raise ValueError( "failed on purpose" )
+    if item == "die":
+        os._exit( 1 )
+    if item == "sleep":
+        time.sleep( 0.3 )
+
 
 class TestBatch( unittest.TestCase ):
 
     def test_base( self ):
         # currently we only test import
-        pass 
+        pass
+
+    def test_process( self ):
+        if not os.path.exists( "/bin/sh" ):
+            return
+        # END skip on non-posix systems
+        
+        # children exit with an error if their input contains 'fail', and write
+        # a lot to stderr, which must not block them
+        script = 'for i in $(seq 2000); do echo "error line $i of $@" >&2; done; case "$*" in *fail*) exit 1;; esac'
+        inputs = [ "a", "b", "fail", "c", "d" ]
+        err, done = StringIO(), StringIO()
+        st = time.time()
+        batch.process( "/bin/sh", ( "-c", script, "sh" ), inputs, err, done, inputsPerProcess=1, numJobs=2 )
+        elapsed = time.time() - st
+        
+        # finished jobs are noticed right away - polling would take a second per job
+        assert elapsed < 2.5
+        assert sorted( done.getvalue().splitlines() ) == [ "a", "b", "c", "d" ]
+        assert len( err.getvalue().splitlines() ) == len( inputs ) * 2000
+        
+        # jobs may take longer than we block on the queue at once
+        timeout = batch._waitTimeout
+        batch._waitTimeout = 0.05
+        try:
+            done = StringIO()
+            batch.process( "/bin/sh", ( "-c", "sleep 0.3", "sh" ), [ "a" ], None, done, inputsPerProcess=1 )
+            assert done.getvalue() == "a\n"
+        finally:
+            batch._waitTimeout = timeout
+        # END restore timeout
+ 
+
+
+    def test_processStream( self ):
+        if not os.path.exists( "/bin/sh" ):
+            return
+        # END skip on non-posix systems
+        
+        # jobs start while the input still arrives - the stream only continues
+        # once the first item was done
+        done = StringIO()
+        def stream( ):
+            yield "a\n"
+            st = time.time()
+            while not done.getvalue() and time.time() - st < 5.0:
+                time.sleep( 0.01 )
+            # END wait for first item
+            assert done.getvalue() == "a\n"
+            yield "b"
+            yield ""        # empty items are skipped
+        # END stream generator
+        batch.processStream( "/bin/sh", ( "-c", "true", "sh" ), stream(), None, done )
+        assert done.getvalue().splitlines() == [ "a", "b" ]
+        
+        # the amount of inputs per job is adjusted to the measured time per input
+        err = StringIO()
+        inputs = [ str( i ) for i in range( 20 ) ]
+        batch.processStream( "/bin/sh", ( "-c", 'echo $# >&2', "sh" ), inputs, err, None,
+                             jobDuration = 10.0, maxInputsPerProcess = 5 )
+        counts = [ int( c ) for c in err.getvalue().split() ]
+        assert counts[0] == 1 and max( counts ) == 5 and sum( counts ) == len( inputs )
+        
+        # jobs may take longer than we block on the queue at once
+        timeout = batch._waitTimeout
+        batch._waitTimeout = 0.05
+        try:
+            done = StringIO()
+            batch.processStream( "/bin/sh", ( "-c", "sleep 0.3", "sh" ), [ "a" ], None, done )
+            assert done.getvalue() == "a\n"
+        finally:
+            batch._waitTimeout = timeout
+        # END restore timeout
 
+    def test_processResident( self ):
+        if not hasattr( os, 'fork' ):
+            return
+        # END skip on non-posix systems
+        
+        pidfile = tempfile.mktemp( "batch_pids" )
+        env = os.environ.copy()
+        os.environ[ 'MRV_TEST_BATCH_PIDS' ] = pidfile
+        os.environ[ 'PYTHONPATH' ] = os.pathsep.join( ( os.path.dirname( os.path.dirname( os.path.dirname( batch.__file__ ) ) ),
+                                                        env.get( 'PYTHONPATH', '' ) ) )
+        try:
+            inputs = [ "a", "fail", "b", "die", "c", "d" ]
+            err, done = StringIO(), StringIO()
+            batch.processResident( sys.executable, ( ), "mrv.test.test_batch.residentItem", inputs, err, done,
+                                   numJobs = 1, maxItemsPerWorker = 2 )
+            pids = open( pidfile ).read().split()
+            
+            # items may take longer than we block on the queue at once
+            timeout = batch._waitTimeout
+            batch._waitTimeout = 0.05
+            try:
+                sleepdone = StringIO()
+                batch.processResident( sys.executable, ( ), "mrv.test.test_batch.residentItem", [ "sleep" ], 
+                                       None, sleepdone, numJobs = 1 )
+                assert sleepdone.getvalue() == "sleep\n"
+            finally:
+                batch._waitTimeout = timeout
+            # END restore timeout
+        finally:
+            os.environ.clear()
+            os.environ.update( env )
+            if os.path.exists( pidfile ):
+                os.remove( pidfile )
+        # END restore environment
+        
+        assert done.getvalue().splitlines() == [ "a", "b", "c", "d" ]
+        errmsg = err.getvalue()
+        assert "failed on purpose" in errmsg and "died while processing 'die'" in errmsg
+        
+        # workers are recycled after two items, or when they die
+        assert len( pids ) == len( inputs )
+        assert pids[0] == pids[1] and len( set( pids ) ) == 3
@@ -196,6 +196,53 @@ class TestConfigAccessor( unittest.TestCase ):
         assert ca['doesntexist',2].value == 2
 
 
+    def test_index( self ):
+        """ConfigAccessor: the key and section index follows changes to the configuration"""
+        ca = ConfigAccessor( )
+        ca.readfp( [ ConfigStringIO( "[section]\nkey = 1\n[shared]\nkey = 2\n" ),
+                     ConfigStringIO( "[section]\nkey = 3\nother = 4\n" ) ], close_fp = False )
+        
+        # earlier nodes come first
+        keys = ca.keysByName( "key" )
+        assert len( keys ) == 3
+        assert keys[-1][0].value == 3
+        assert ca.get( "section.key" ).value == 1 and ca.get( "shared.key" ).value == 2
+        # only the first section of the given name is searched
+        self.failUnlessRaises( NoOptionError, ca.get, "section.other" )
+        assert ca.get( "other" ).value == 4
+        self.failUnlessRaises( NoOptionError, ca.get, "shared.other" )
+        
+        # keys created through sections are found
+        ca.section( "shared" ).keyDefault( "other", 5 )
+        assert [ k.value for k, s in ca.keysByName( "other" ) ] == [ 5, 4 ]
+        assert ca.get( "shared.other" ).value == 5
+        
+        # new sections and their keys
+        section = ca.sectionDefault( "new" )
+        assert ca.section( "new" ) is section and ca.hasSection( "new" )
+        section.setKey( "key", 6 )
+        assert len( ca.keysByName( "key" ) ) == 4
+        
+        merged = Section( "merged", -1 )
+        merged.setKey( "mergedkey", 7 )
+        ca.mergeSection( merged )
+        assert ca.get( "merged.mergedkey" ).value == 7
+        
+        # removal
+        ca.section( "shared" ).removeKey( "other" )
+        assert [ k.value for k, s in ca.keysByName( "other" ) ] == [ 4 ]
+        ca.section( "new" ).keys.remove( "key" )
+        assert len( ca.keysByName( "key" ) ) == 3
+        assert ca.removeSection( "section" ) == 0
+        assert not ca.hasSection( "section" )
+        assert [ k.value for k, s in ca.keysByName( "key" ) ] == [ 2 ]
+        assert not ca.keysByName( "other" )
+        
+        # rereading resets the index
+        ca.readfp( ConfigStringIO( "[section]\nkey = 1\n" ) )
+        assert len( ca.keysByName( "key" ) ) == 1 and not ca.hasSection( "shared" )
+        
+
 class TestConfigManager( unittest.TestCase ):
     """ Test the ConfigAccessor Class and all its featuers"""
 
@@ -295,6 +342,66 @@ class TestConfigManager( unittest.TestCase ):
         
 
 
+    def test_cache( self ):
+        """ConfigManager: the parsed configuration can be cached"""
+        cachefile = os.path.join( self.testpath, "config.cache" )
+        cm = ConfigManager( _getprefixedinifps( 'valid', dirname=self.testpath ), write_back_on_desctruction=False, cache=cachefile )
+        assert os.path.isfile( cachefile )
+        
+        # the cached version is used without parsing
+        prev_parse = ConfigNode.parse
+        def parse( self ):
+            raise AssertionError( "should not parse" )
+        ConfigNode.parse = parse
+        try:
+            cmc = ConfigManager( _getprefixedinifps( 'valid', dirname=self.testpath ), write_back_on_desctruction=False, cache=cachefile )
+        finally:
+            ConfigNode.parse = prev_parse
+        # END restore parse method
+        assert not ConfigDiffer( cm.config, cmc.config ).hasDifferences()
+        assert cmc.config.keysByName( "my_key_with_property" )[0][0].properties.key( 'property' ).value == 'value'
+        
+        # changes can be written back
+        cmc.config.sectionDefault( "cachedSection" ).keyDefault( "cachedKey", "cachedValue" )
+        cmc.write()
+        
+        # changed files invalidate the cache
+        cm = ConfigManager( _getprefixedinifps( 'valid', dirname=self.testpath ), write_back_on_desctruction=False, cache=cachefile )
+        assert cm.config.get( "cachedSection.cachedKey" ).value == "cachedValue"
+        
+        # changes keeping size and modification time invalidate it as well
+        for fp in _getprefixedinifps( 'valid', dirname=self.testpath ):
+            name = fp.name()
+            fp.close()
+            if "cachedValue" in open( name, 'rb' ).read():
+                break
+        # END for each file
+        os.utime( name, ( 1000, 1000 ) )
+        cm = ConfigManager( _getprefixedinifps( 'valid', dirname=self.testpath ), write_back_on_desctruction=False, cache=cachefile )
+        content = open( name, 'rb' ).read()
+        open( name, 'wb' ).write( content.replace( "cachedValue", "changdValue" ) )
+        os.utime( name, ( 1000, 1000 ) )
+        cm = ConfigManager( _getprefixedinifps( 'valid', dirname=self.testpath ), write_back_on_desctruction=False, cache=cachefile )
+        assert cm.config.get( "cachedSection.cachedKey" ).value == "changdValue"
+        
+        # other file objects don't use the cache
+        os.remove( cachefile )
+        cm = ConfigManager( ConfigStringIO( "[section]\nkey = 1\n" ), write_back_on_desctruction=False, cache=cachefile )
+        assert not os.path.exists( cachefile )
+        
+        # corrupted caches are ignored
+        open( cachefile, "w" ).write( "garbage" )
+        cm = ConfigManager( _getprefixedinifps( 'valid', dirname=self.testpath ), write_back_on_desctruction=False, cache=cachefile )
+        assert cm.config.hasSection( "cachedSection" )
+        
+        # file descriptors
+        descriptorcache = os.path.join( self.testpath, "descriptors.cache" )
+        tagdir = _getIniFileDir( base_dir = 'taggedINI' )
+        names = [ fp.name() for fp in ConfigManager.taggedFileDescriptors( [ tagdir ], [ sys.platform ], cache=descriptorcache ) ]
+        assert names and os.path.isfile( descriptorcache )
+        assert [ fp.name() for fp in ConfigManager.taggedFileDescriptors( [ tagdir ], [ sys.platform ], cache=descriptorcache ) ] == names
+        assert [ fp.name() for fp in ConfigManager.taggedFileDescriptors( [ tagdir ], [ sys.platform ] ) ] == names
+        
     def test_taggedFileDescriptors( self ):
         """ConfigManager: check if filedescriptor parsing is generally working"""
 
@@ -3,6 +3,10 @@
 import unittest
 from mrv.dge import *
 from random import randint
+import threading
+import weakref
+import gc
+import mrv.dge as dge
 import tempfile
 
 A = Attribute
@@ -49,6 +53,29 @@ class SimpleNode( NodeBase ):
         raise PlugUnhandled( )
 
 
+class ThreadedNode( NodeBase ):
+    """Sums its inputs and may be computed concurrently"""
+    thread_safe = True
+
+    #{ Plugs
+    inA = plug( A( float, 0, default = 1.0 ) )
+    inB = plug( A( float, 0, default = 1.0 ) )
+    outSum = plug( A( float, 0 ) )
+
+    inA.affects( outSum )
+    inB.affects( outSum )
+    #} END plugs
+
+    def __init__( self, name ):
+        super( ThreadedNode, self ).__init__( id = name )
+        self.thread = None
+
+    def compute( self, plug, mode ):
+        if plug == ThreadedNode.outSum:
+            self.thread = threading.currentThread()
+            return self.inA.get() + self.inB.get()
+        raise PlugUnhandled( )
+
 #}
 
 
@@ -77,7 +104,7 @@ class TestDGEngine( unittest.TestCase ):
         del( addrem )
         self.failUnless( len( list( graph.iterNodes() ) ) == 2 )
         # get the node back and remove it properly
-        addrem = list( graph.iterNodes() )[1]
+        addrem = [ n for n in graph.iterNodes() if n is not s1 ][0]
         graph.removeNode( addrem )
         del( addrem )
         self.failUnless( len( list( graph.iterNodes() ) ) == 1 )
@@ -255,6 +282,26 @@ class TestDGEngine( unittest.TestCase ):
         self.failUnless( len( SimpleNode.filterCompatiblePlugs( inplugs, floatattr ) ) == 2 )
         self.failUnlessRaises( TypeError, SimpleNode.filterCompatiblePlugs, inplugs, floatattr, raise_on_ambiguity = 1 )
 
+        # bulk filtering
+        results = SimpleNode.filterCompatiblePlugsMulti( inplugs, ( intattr, 5, 2.0, 3, floatattr ) )
+        self.failUnless( len( results ) == 5 )
+        self.failUnless( results[0] == SimpleNode.filterCompatiblePlugs( inplugs, intattr ) )
+        self.failUnless( results[1] == results[3] == SimpleNode.filterCompatiblePlugs( inplugs, 5 ) )
+        self.failUnless( results[1] is not results[3] )
+        self.failUnless( results[2] == SimpleNode.filterCompatiblePlugs( inplugs, 2.0 ) )
+        self.failUnless( len( results[4] ) == 2 )
+        self.failUnlessRaises( TypeError, SimpleNode.filterCompatiblePlugsMulti, inplugs, ( 1, floatattr ), raise_on_ambiguity = 1 )
+        self.failUnless( Attribute.ratingKey( 1 ) == Attribute.ratingKey( 3 ) != Attribute.ratingKey( 1.0 ) )
+        self.failUnless( Attribute.ratingKey( floatattr ) is floatattr and Attribute.ratingKey( int ) is int )
+
+        # ratings are cached, but can be cleared
+        class MyFloat( float ):
+            pass
+        rate = floatattr.compatabilityRate( MyFloat( 1.0 ) )
+        self.failUnless( rate and rate == floatattr.compatabilityRate( MyFloat( 2.0 ) ) )
+        Attribute.clearRatingCache()
+        self.failUnless( floatattr.compatabilityRate( MyFloat( 2.0 ) ) == rate )
+
     def test_duplication( self ):
         """dgengine: duplicate a graph"""
         # test shallow copy
@@ -276,3 +323,253 @@ class TestDGEngine( unittest.TestCase ):
         self.failUnless( len( list( graph.iterConnectedNodes() ) ) == len( list( g2.iterConnectedNodes() ) ) )
 
 
+    def test_evaluationPlan( self ):
+        """dgengine: compile and evaluate a graph plan"""
+        graph = Graph()
+        s1 = SimpleNode( "s1" )
+        s2 = SimpleNode( "s2" )
+        s3 = SimpleNode( "s3" )
+        for node in ( s1, s2, s3 ):
+            graph.addNode( node )
+
+        s1.outRand >> s2.inFloat
+        s2.inInt.set( 2 )
+        s2.outMult >> s3.inFloat
+        s3.inInt.set( 3 )
+
+        # other tests change the flags on class level
+        multattr = SimpleNode.outMult.attr
+        randattr = SimpleNode.outRand.attr
+        prevflags = ( multattr.flags, randattr.flags )
+        multattr.flags = A.uncached
+        randattr.flags = 0
+        try:
+            plan = graph.compile( ( s3.outMult, ) )
+            self.failUnless( graph.compile( ( s3.outMult, ) ) is plan )
+
+            # uncached plugs are not part of the plan, dependencies come first
+            self.failUnless( list( plan ) == [ s1.outRand ] )
+            
+            # flag changes invalidate
+            multattr.flags = 0
+            self.failUnless( not plan.isValid() )
+            self.failUnless( list( plan ) == [ s1.outRand, s2.outMult, s3.outMult ] )
+            
+            graph.disconnect( s2.outMult, s3.inFloat )
+            self.failUnless( not plan.isValid() )
+            self.failUnless( graph.compile( ( s3.outMult, ) ) is not plan )
+            s2.outMult >> s3.inFloat
+
+            self.failUnless( list( plan ) == [ s1.outRand, s2.outMult, s3.outMult ] )
+            self.failUnless( plan.isValid() )
+
+            value = plan.evaluate()[0]
+            self.failUnless( value == s1.outRand.get() * 2 * 3 )
+            self.failUnless( s1.outRand.hasCache() and s2.outMult.hasCache() )
+            self.failUnless( plan.evaluate()[0] == value )
+
+            # node removal invalidates
+            graph.removeNode( s1 )
+            self.failUnless( not plan.isValid() )
+        finally:
+            multattr.flags, randattr.flags = prevflags
+        # END assure class attributes are restored
+
+    def test_parallelEvaluation( self ):
+        """dgengine: evaluate independent branches concurrently"""
+        graph = Graph()
+        a, b, c = [ ThreadedNode( name ) for name in "abc" ]
+        for node in ( a, b, c ):
+            graph.addNode( node )
+        a.outSum >> c.inA
+        b.outSum >> c.inB
+        a.inA.set( 2.0 )
+
+        plan = graph.compile( ( c.outSum, ) )
+        levels = plan.levels()
+        self.failUnless( len( levels ) == 2 )
+        self.failUnless( set( levels[0] ) == set( ( a.outSum, b.outSum ) ) and levels[1] == ( c.outSum, ) )
+
+        self.failUnless( graph.evaluate( ( c.outSum, ), workers = 2 ) == [ 5.0 ] )
+        self.failUnless( a.thread is not threading.currentThread() )
+        self.failUnless( b.thread is not threading.currentThread() )
+
+        # errors are passed on to the caller
+        a.inA.set( 4.0 )
+        a.compute = lambda plug, mode: 1 / 0
+        self.failUnlessRaises( ZeroDivisionError, graph.evaluate, ( c.outSum, ), workers = 2 )
+
+        # nodes which are not thread-safe are computed by the caller
+        del( a.compute )
+        a.thread_safe = False
+        self.failUnless( graph.evaluate( ( c.outSum, ), workers = 2 ) == [ 7.0 ] )
+        self.failUnless( a.thread is threading.currentThread() )
+
+    def test_cacheStore( self ):
+        """dgengine: keep cached values in a budgeted store"""
+        graph = Graph()
+        a, b, c = [ ThreadedNode( name ) for name in "abc" ]
+
+        for node in ( a, b, c ):
+            graph.addNode( node )
+        store = graph.cacheStore()
+        self.failUnless( a.cacheStore() is store and len( store ) == 0 )
+        a.inA.set( 2.0 )
+        self.failUnless( a.inA.hasCache() and len( store ) == 1 )
+
+        for node in ( a, b, c ):
+            node.outSum.get()
+        self.failUnless( len( store ) == 4 )
+        self.failUnless( ( a, "outSum" ) in list( store ) )
+
+        # set values are never evicted, computed values are evicted least recently used first
+        b.outSum.get()
+        store.setBudget( max_entries = 2 )
+        self.failUnless( len( store ) == 3 )
+        self.failUnless( a.inA.hasCache() and not a.outSum.hasCache() )
+        self.failUnless( b.outSum.hasCache() and c.outSum.hasCache() )
+
+        # evicted values are simply recomputed
+        self.failUnless( a.outSum.get() == 3.0 )
+        self.failUnless( a.outSum.hasCache() and not b.outSum.hasCache() )
+
+        store.setBudget( max_bytes = 1 )
+        self.failUnless( len( store ) == 1 and store.numBytes() == 0 )
+        store.setBudget()
+
+        # removed nodes take their caches with them
+        graph.removeNode( a )
+        self.failUnless( len( store ) == 0 and a.inA.cache() == 2.0 )
+        self.failUnless( a.cacheStore() is not store )
+        graph.addNode( a )
+        self.failUnless( len( store ) == 1 and a.inA.cache() == 2.0 )
+        a.clearCache()
+        self.failUnless( not a.inA.hasCache() and len( store ) == 0 )
+
+        # reads and writes may happen concurrently
+        store = CacheStore( max_entries = 8 )
+        nodes = [ object() for i in range( 32 ) ]
+        errors = list()
+        def access( ):
+            try:
+                for i in range( 3000 ):
+                    node = nodes[ randint( 0, len( nodes ) - 1 ) ]
+                    if i % 3:
+                        store.get( node, "value" )
+                        store.has( node, "value" )
+                    else:
+                        store.put( node, "value", i )
+                # END for each access
+            except Exception, e:
+                errors.append( e )
+        # END access
+        threads = [ threading.Thread( target = access ) for i in range( 4 ) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.failUnless( not errors and len( store ) <= 8 )
+
+    def test_lazyDirtyPropagation( self ):
+        """dgengine: clear affected caches lazily, respecting the order of changes"""
+        graph = Graph()
+        a, b = ThreadedNode( "a" ), ThreadedNode( "b" )
+        graph.addNode( a )
+        graph.addNode( b )
+        a.outSum >> b.inA
+
+        self.failUnless( b.outSum.get() == 3.0 )
+        store = graph.cacheStore()
+        stamp = store.stamp( b, "outSum" )
+        self.failUnless( stamp > store.stamp( a, "outSum" ) )
+
+        # many changes in a row, one propagation
+        for value in range( 10 ):
+            a.inA.set( float( value ) )
+            a.inB.set( float( value ) )
+        self.failUnless( store.stamp( b, "outSum" ) == stamp )
+        self.failUnless( not b.outSum.hasCache() )
+        self.failUnless( b.outSum.get() == 19.0 )
+
+        # a value set after an upstream change survives
+        a.inA.set( 1.0 )
+        b.inA.set( 5.0, ignore_connection = True )
+        self.failUnless( b.outSum.get() == 6.0 )
+
+        # an upstream change after a value was set clears it
+        b.inA.set( 5.0, ignore_connection = True )
+        a.inA.set( 2.0 )
+        self.failUnless( not b.inA.hasCache() )
+        self.failUnless( b.outSum.get() == 12.0 )
+
+        # explicit clearing is lazy too
+        a.inB.clearCache( clear_affected = True )
+        self.failUnless( not a.outSum.hasCache() and not b.outSum.hasCache() )
+        self.failUnless( b.outSum.get() == 4.0 )
+
+        # pending changes do not keep discarded graphs alive
+        graph = Graph()
+        c = ThreadedNode( "c" )
+        graph.addNode( c )
+        c.inA.set( 1.0 )
+        noderef = weakref.ref( c )
+        del( graph, c )
+        gc.collect()
+        self.failUnless( noderef() is None )
+
+    def test_plugTables( self ):
+        """dgengine: precomputed plug tables follow changes to plugs"""
+        node = SimpleNode( "s" )
+        self.failUnless( len( node.plugs() ) == len( SimpleNode.plugsStatic() ) == 6 )
+        self.failUnless( [ p.name() for p in SimpleNode.plugsStatic() ] == sorted( p.name() for p in node.plugs() ) )
+        self.failUnless( set( node.inputPlugs() ) == set( SimpleNode.inputPlugsStatic() ) )
+        self.failUnless( set( node.outputPlugs() ) == set( SimpleNode.outputPlugsStatic() ) )
+        self.failUnless( SimpleNode.outFailCompute in node.outputPlugs() )
+        self.failUnless( SimpleNode.inInt.affected() == ( SimpleNode.outMult, ) )
+
+        # new plugs and relations are picked up
+        SimpleNode.inExtra = plug( A( float, 0 ) )
+        try:
+            self.failUnless( SimpleNode.inExtra.name() == "inExtra" )
+            self.failUnless( SimpleNode.inExtra in node.inputPlugs() )
+            SimpleNode.inExtra.affects( SimpleNode.outRand )
+            self.failUnless( SimpleNode.inExtra in SimpleNode.outRand.affectedBy() )
+        finally:
+            del( SimpleNode.inExtra )
+            SimpleNode.outRand._affectedBy = SimpleNode.outRand._affectedBy[:-1]
+        # END restore class
+        self.failUnless( len( node.plugs() ) == 6 )
+        
+        # other class members and other classes keep their tables
+        table = dge._PlugTable.get( SimpleNode )
+        class OtherNode( NodeBase ):
+            inOther = plug( A( int, 0 ) )
+        # END other node class
+        OtherNode.inExtra = plug( A( float, 0 ) )
+        SimpleNode.someMember = 1
+        del( SimpleNode.someMember )
+        A( int, A.computable )
+        self.failUnless( dge._PlugTable.get( SimpleNode ) is table )
+        
+        # plugs overridden by other members are dropped
+        class DerivedNode( SimpleNode ):
+            pass
+        # END derived node
+        self.failUnless( SimpleNode.inInt in DerivedNode.plugsStatic() )
+        DerivedNode.inInt = None
+        self.failUnless( SimpleNode.inInt not in DerivedNode.plugsStatic() )
+        self.failUnless( SimpleNode.inInt in SimpleNode.plugsStatic() )
+
+        # computable flag changes the partitions
+        attr = SimpleNode.inInt.attr
+        attr.flags |= A.computable
+        try:
+            self.failUnless( SimpleNode.inInt in node.outputPlugs() )
+        finally:
+            attr.flags ^= A.computable
+        self.failUnless( SimpleNode.inInt in node.inputPlugs() )
+
+        # instance level plugs come first
+        node.inInstance = plug( A( int, 0 ) )
+        self.failUnless( node.plugs()[0] is node.__dict__[ 'inInstance' ] )
+        self.failUnless( node.__dict__[ 'inInstance' ] in node.inputPlugs() )
@@ -7,9 +7,18 @@ import unittest
 import mrv.enum as Enumeration
 import operator
 import pickle
+import copy
 from cStringIO import StringIO
 
 
+# module level enumerations are pickled by reference
+eModule = Enumeration.create( "first", "second", bitflag = 1 )
+
+class Holder( object ):
+    eMember = Enumeration.create( "one", "two" )
+# END holder
+
+
 class ElementTestCase(unittest.TestCase):
     def testElementComparisons(self):
         e = Enumeration.create('fred', 'bob', 'joe', 'larry', 'moe')
@@ -196,29 +205,58 @@ class EnumerateTestCase(unittest.TestCase):
         self.failUnless( e1.previous( e1[0], wrap_around = 1 ) == e1[0] )
 
     def testPickleUnpickle( self ):
-        src = StringIO()
-        p = pickle.Pickler(src)
-
-        e1 = Enumeration.create( "hello" )
-
-        # remove cycle ! Hangs otherwise
-        e1[0].enumeration = None
-
-        p.dump( e1[0] )
-
-        dst = StringIO( src.getvalue() )
-        up = pickle.Unpickler( dst )
-
-        elm = up.load( )
-        self.failUnless( elm == e1[0] )
-
+        e1 = Enumeration.create( "hello", "world" )
+        f1 = Enumeration.create( "foo", "bar", bitflag = 1 )
+        
+        for proto in range(pickle.HIGHEST_PROTOCOL + 1):
+            src = StringIO()
+            p = pickle.Pickler(src, proto)
+            
+            # elements first, the enumeration is pickled with them
+            p.dump( ( e1[1], e1, f1.foo | f1.bar ) )
+    
+            dst = StringIO( src.getvalue() )
+            up = pickle.Unpickler( dst )
+    
+            elm, e2, flags = up.load( )
+            assert e2 is not e1 and len(e2) == len(e1)
+            assert elm is e2.world and elm.enumeration is e2
+            assert elm != e1.world and elm.value() == e1.world.value()
+            assert elm > e2.hello
+            
+            assert flags == f1.foo | f1.bar
+            assert flags is flags.enumeration.flags(int(flags))
+            assert flags.enumeration.foo in flags
+            
+            # enumerations pickled by value are restored only once
+            assert pickle.loads( pickle.dumps( e1, proto ) ) is e2
+            
+            # module level enumerations are pickled by reference
+            for elm in ( eModule.second, Holder.eMember.two, eModule.first | eModule.second ):
+                assert pickle.loads( pickle.dumps( elm, proto ) ) is elm
+            # END for each module level item
+        # END for each protocol
+        
+        # detached elements work as well
+        elm = Enumeration.Element("single", 1)
+        assert pickle.loads(pickle.dumps(elm)).name() == "single"
+        
+        # copies are the elements themselves
+        assert copy.deepcopy(e1.world) is e1.world
+        assert copy.copy(e1) is e1
 
     def testBitFlags( self ):
         e1 = Enumeration.create( "foo", "bar", "this", bitflag = 1 )
 
         orres = e1.foo | e1.bar
         assert isinstance( orres, int )
-        self.failUnlessRaises( TypeError, operator.or_, e1.foo, 4 )
+        
+        # plain integers within the range of the enumeration may be ored
+        assert e1.foo | 4 is e1.foo | e1.this
+        assert 4 | e1.foo is e1.foo | e1.this
+        self.failUnlessRaises( ValueError, operator.or_, e1.foo, 8 )
+        self.failUnlessRaises( ValueError, operator.or_, 8, e1.foo )
+        self.failUnlessRaises( TypeError, operator.or_, e1.foo, 4.0 )
 
         self.failUnless( e1.foo & orres )
         self.failUnless( e1.bar & orres )
@@ -232,6 +270,28 @@ class EnumerateTestCase(unittest.TestCase):
 
         # xor
         assert e1.foo ^ e1.foo.value() == 0
+        
+        # flags
+        assert isinstance(orres, Enumeration.Flags)
+        assert orres is e1.bar | e1.foo
+        assert orres is e1.flags(3)
+        assert e1.flags() == 0 and not list(e1.flags())
+        allflags = orres | e1.this
+        assert list(allflags) == list(e1)
+        assert e1.foo in orres and e1.this not in orres
+        assert repr(orres) == "foo|bar"
+        assert orres & e1.bar and not orres & e1.this
+        
+        self.failUnlessRaises(ValueError, e1.flags, 8)
+        assert orres | 4 is allflags and 4 | orres is allflags
+        self.failUnlessRaises(ValueError, operator.or_, orres, 8)
+        self.failUnlessRaises(TypeError, operator.or_, orres, Enumeration.create("foo", bitflag=1).foo)
+        self.failUnlessRaises(TypeError, Enumeration.create("foo").flags, 1)
+        
+        # elements are integers
+        assert e1.this == e1.this and e1.this != 4 and e1.this.value() == 4
+        assert e1.this + 0 == 4
+        self.failUnlessRaises(TypeError, Enumeration.Element, "fails", "value")
 
     def test_dict( self ):
         # should always work as elements or global items
@@ -2,6 +2,10 @@
 """Tests for the maya dependency parser"""
 from mrv.test.lib import *
 from mrv.mdepparse import *
+import tempfile
+import cPickle
+import struct
+import os
 
 
 class TestMayaDependencyParsing( unittest.TestCase ):
@@ -25,3 +29,214 @@ class TestMayaDependencyParsing( unittest.TestCase ):
         # END for each possible parse_all_paths value
         
         
+
+    def test_scanReferences( self ):
+        reffile = get_maya_file('ref2re.ma')
+        refs = MayaFileGraph.scanReferences(reffile)
+        assert len(refs) == 8
+        assert len([ r for r in refs if r.is_reference ]) == 2
+        assert refs[1].depth == 2 and refs[1].namespace == "ref10m" and refs[1].reference_node == "ref4m2r:ref10mRN"
+        assert refs[-1].is_reference and refs[-1].namespace == "ref4m2r1" and refs[-1].path.endswith("ref4m2r.ma")
+        
+        # statements spanning block boundaries are found as well
+        blocksize = MayaFileGraph.scanblocksize
+        try:
+            for size in ( 17, 64, 1000 ):
+                MayaFileGraph.scanblocksize = size
+                for parse_all_paths in range(2):
+                    assert [ r.path for r in MayaFileGraph.scanReferences(reffile, parse_all_paths) ] == [ r.path for r in refs ]
+            # END for each blocksize
+        finally:
+            MayaFileGraph.scanblocksize = blocksize
+        # END restore blocksize
+        
+        # other statements using the -r flag are no references
+        assert not MayaFileGraph._parseReferences(get_maya_file('instancetest.ma'), True)
+        
+    def _writeBinaryFile( self, filepath, refs, large = False, trailing_refs = tuple() ):
+        """Write a maya binary file referencing the given paths
+        :param trailing_refs: paths of references to store behind the nodes"""
+        if large:
+            chunk = lambda tag, data: struct.pack( ">4s4xQ", tag, len( data ) ) + data + "\0" * ( -len( data ) % 8 )
+            group = lambda tag, gtype, data: chunk( tag, gtype + "\0" * 4 + data )
+        else:
+            chunk = lambda tag, data: struct.pack( ">4sL", tag, len( data ) ) + data + "\0" * ( -len( data ) % 4 )
+            group = lambda tag, gtype, data: chunk( tag, gtype + data )
+        # END handle format
+        
+        groupid = ( large and "FOR8" ) or "FOR4"
+        header = group( groupid, "HEAD", chunk( "VERS", "2011\0" ) )
+        references = "".join( chunk( "FREF", ref + "\0ns\0" ) for ref in refs )
+        nodes = group( groupid, "XFRM", chunk( "CREA", "\0" * 5000 ) )
+        trailing = "".join( chunk( "FREF", ref + "\0ns\0" ) for ref in trailing_refs )
+        open( filepath, "wb" ).write( group( groupid, "Maya", header + references + nodes + trailing ) )
+        
+    def test_binaryReferences( self ):
+        # real binary files have no references, but can be walked
+        for mbfile in ( 'mesh40k.mb', 'samurai_jet_graph.mb' ):
+            assert MayaFileGraph.scanReferences(get_maya_file(mbfile)) == list()
+        # END for each real file
+        
+        reffile = get_maya_file('ref2re.ma')
+        mbfile = tempfile.mktemp( ".mb" )
+        try:
+            for large in range(2):
+                self._writeBinaryFile( mbfile, [ reffile, "/doesnt/exist.mb" ], large )
+                refs = MayaFileGraph.scanReferences(mbfile)
+                assert [ r.path for r in refs ] == [ reffile, "/doesnt/exist.mb" ]
+                assert refs[0].is_reference
+                
+                # binary files feed the same graph
+                mfg = MayaFileGraph.createFromFiles([mbfile])
+                assert reffile in mfg.depends(mbfile, mfg.kAffectedBy)
+                assert mfg.invalidFiles() == [ "/doesnt/exist.mb" ]
+                
+                # scanning stops at the nodes unless all paths are requested
+                self._writeBinaryFile( mbfile, [ reffile ], large, trailing_refs = [ "/trailing.mb" ] )
+                assert [ r.path for r in MayaFileGraph.scanReferences(mbfile) ] == [ reffile ]
+                assert [ r.path for r in MayaFileGraph.scanReferences(mbfile, allPaths = True) ] == [ reffile, "/trailing.mb" ]
+            # END for each format
+        finally:
+            os.remove( mbfile )
+        # END cleanup
+        
+    def test_incremental( self ):
+        reffile = get_maya_file('ref2re.ma')
+        indexfile = tempfile.mktemp( "mdepindex" )
+        
+        try:
+            reference = MayaFileGraph.createFromFiles([reffile])
+            
+            # parallel and indexed parsing yield the same graph
+            for workers in ( 0, 2 ):
+                index = MayaFileIndex( indexfile )
+                mfg = MayaFileGraph.createFromFiles([reffile], index=index, workers=workers)
+                assert sorted(mfg.edges()) == sorted(reference.edges())
+                assert len(index) == 4
+                index.save()
+            # END for each amount of workers
+            
+            # unchanged files are not parsed again
+            index = MayaFileIndex( indexfile )
+            assert len(index) == 4
+            parsed = list()
+            parseReferences = MayaFileGraph._parseReferences
+            def countingParse( cls, mafile, allPaths = False ):
+                parsed.append( mafile )
+                return parseReferences( mafile, allPaths )
+            MayaFileGraph._parseReferences = classmethod( countingParse )
+            try:
+                mfg = MayaFileGraph.createFromFiles([reffile], index=index)
+                assert sorted(mfg.edges()) == sorted(reference.edges())
+                assert not parsed
+                
+                # changed modes require reparsing
+                MayaFileGraph.createFromFiles([reffile], index=index, parse_all_paths=True)
+                assert len(parsed) == 4
+                
+                # touched files are only parsed again if their content changed, 
+                # or if the mode differs
+                st = os.stat( reffile )
+                os.utime( reffile, ( st.st_atime, st.st_mtime + 10 ) )
+                try:
+                    MayaFileGraph.createFromFiles([reffile], index=index, parse_all_paths=True)
+                    assert len(parsed) == 4
+                    mfg = MayaFileGraph.createFromFiles([reffile], index=index)
+                    assert len(parsed) == 8
+                    assert sorted(mfg.edges()) == sorted(reference.edges())
+                finally:
+                    os.utime( reffile, ( st.st_atime, st.st_mtime ) )
+                # END restore modification time
+            finally:
+                MayaFileGraph._parseReferences = classmethod( parseReferences.im_func )
+            # END restore parse method
+        finally:
+            if os.path.exists( indexfile ):
+                os.remove( indexfile )
+        # END cleanup
+
+    def test_reachability( self ):
+        reffile = get_maya_file('ref2re.ma')
+        mfg = MayaFileGraph.createFromFiles([reffile])
+        mfg._addInvalid( "/doesnt/exist.ma" )
+        mfg.add_edge( "/doesnt/exist.ma", get_maya_file('ref10m.ma') )
+        
+        nodes = [ n for n in mfg.nodes() if n != mfg.invalidNodeID and not n.startswith( mfg.invalidPrefix ) ]
+        for direction in ( mfg.kAffects, mfg.kAffectedBy ):
+            multi = mfg.dependsMulti( nodes + [ "/unknown.ma" ], direction )
+            assert multi[ "/unknown.ma" ] == list()
+            invalid_only = mfg.dependsMulti( nodes, direction, invalid_only = True )
+            for node in nodes:
+                assert multi[ node ] == sorted( mfg.depends( node, direction ) )
+                assert invalid_only[ node ] == sorted( mfg.depends( node, direction, invalid_only = True ) )
+                
+                # unlimited queries use the closures, they match the traversal
+                related = mfg.depends( node, direction )
+                walked = mfg.depends( node, direction, stop = lambda i, g: False )
+                assert sorted( related ) == sorted( walked ) == sorted( mfg.reachable( node, direction ) )
+                for i, path in enumerate( related ):
+                    assert not mfg.reachable( path, direction ).intersection( related[ : i ] )
+                assert sorted( mfg.depends( node, direction, leaf_only = True ) ) == sorted( mfg.depends( node, direction, leaf_only = True, stop = lambda i, g: False ) )
+            # END for each node
+        # END for each direction
+        assert "/doesnt/exist.ma" in mfg.reachable( reffile, mfg.kAffectedBy )
+        
+        # changes invalidate the cache, cycles are supported
+        mfg.add_edge( reffile, get_maya_file('ref8m.ma') )
+        assert reffile in mfg.reachable( get_maya_file('ref8m.ma'), mfg.kAffectedBy )
+        assert reffile not in mfg.reachable( reffile, mfg.kAffectedBy )
+        assert reffile in mfg.reachable( get_maya_file('ref4m2r.ma'), mfg.kAffects )
+        assert sorted( mfg.dependsMulti( [ reffile ], mfg.kAffects )[ reffile ] ) == sorted( mfg.depends( reffile, mfg.kAffects ) )
+        
+        # caches are not pickled
+        assert '_querycache' not in cPickle.loads( cPickle.dumps( mfg, 2 ) ).__dict__
+        
+    def test_database( self ):
+        reffile = get_maya_file('ref2re.ma')
+        dbfile = tempfile.mktemp( ".db" )
+        
+        try:
+            mfg = MayaFileGraph.createFromFiles([reffile])
+            mfg._addInvalid( "/doesnt/exist.ma" )
+            db = MayaFileDatabase( dbfile )
+            db.updateFromGraph( mfg )
+            db.close()
+            
+            # queries match the ones of the graph
+            db = MayaFileDatabase( dbfile )
+            assert len(db) == 5
+            assert db.invalidFiles() == [ "/doesnt/exist.ma" ]
+            for direction in ( mfg.kAffects, mfg.kAffectedBy ):
+                for node in mfg.nodes():
+                    if node.startswith( mfg.invalidPrefix ) or node == mfg.invalidNodeID:
+                        continue
+                    for depth in ( -1, 1 ):
+                        assert sorted( db.depends( node, direction, depth = depth ) ) == sorted( mfg.depends( node, direction, depth = depth ) )
+                # END for each node
+            # END for each direction
+            assert db.depends( "/unknown.ma" ) == list()
+            
+            # leafs
+            leafs = db.depends( reffile, db.kAffectedBy, leaf_only = True )
+            assert len( leafs ) == 2 and not [ l for l in leafs if "ref4m2r" in l ]
+            
+            # conversion
+            assert sorted( db.toGraph().edges() ) == sorted( mfg.edges() )
+            
+            # incremental updates replace the dependencies of the given files only
+            subgraph = MayaFileGraph()
+            subgraph.add_edge( "/new/dependency.ma", reffile )
+            db.updateFromGraph( subgraph )
+            assert db.depends( reffile, db.kAffectedBy, depth = 1 ) == [ "/new/dependency.ma" ]
+            assert len( db.depends( get_maya_file('ref4m2r.ma'), db.kAffectedBy ) ) == 2
+            
+            # files which lost all their dependencies are cleared as well
+            subgraph = MayaFileGraph()
+            subgraph.add_node( reffile )
+            db.updateFromGraph( subgraph )
+            assert db.depends( reffile, db.kAffectedBy ) == list()
+            db.close()
+        finally:
+            if os.path.exists( dbfile ):
+                os.remove( dbfile )
+        # END cleanup
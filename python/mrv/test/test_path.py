@@ -80,6 +80,46 @@ class TestPath( unittest.TestCase ):
         expanded = Path("$%s/something" % first_var).expand_or_raise()
         assert os.environ[first_var] in expanded
         
+    def test_expand_cache(self):
+        tvar = "PATH_TEST_CACHE_VAR"
+        nvar = "PATH_TEST_CACHE_NESTED_VAR"
+        os.environ[tvar] = "first"
+        os.environ.pop(nvar, None)
+        p = Path("$%s/${%s}/file" % (tvar, nvar))
+        unexpanded = "${%s}" % nvar
+        
+        try:
+            assert p.expandvars() == "first/%s/file" % unexpanded
+            # the cache is used, and remains valid
+            assert p.expandvars() == "first/%s/file" % unexpanded
+            assert p._expandvars(p) is p._expandvars(p)
+            
+            # changes to the environment are picked up, including newly set ones
+            os.environ[tvar] = "second"
+            assert p.expandvars() == "second/%s/file" % unexpanded
+            os.environ[nvar] = "$" + tvar
+            assert p.expandvars() == "second/$%s/file" % tvar
+            assert p.expandvars_deep() == "second/second/file"
+            
+            del(os.environ[tvar])
+            assert p.expandvars() == "$%s/$%s/file" % (tvar, tvar)
+            
+            # frozen paths are fully expanded and don't follow the environment
+            os.environ[tvar] = "third"
+            frozen = p.frozen()
+            assert isinstance(frozen, type(p))
+            assert not frozen.containsvars() and frozen == "third/third/file"
+            os.environ[tvar] = "fourth"
+            assert frozen == "third/third/file"
+            assert p.expandvars_deep() == "fourth/fourth/file"
+            
+            # user directories are expanded as well
+            assert Path("~").frozen() == os.path.expanduser("~")
+        finally:
+            os.environ.pop(tvar, None)
+            os.environ.pop(nvar, None)
+        # END assure environment is restored
+        
     def test_all(self):
         # go through all methods in path and test them in a certain variety of cases
         # This test clearly is an afterthought as the original Path type didn't come 
@@ -501,6 +541,96 @@ class TestPath( unittest.TestCase ):
         
         assert addir.rmtree() == addir and not addir.isdir()
         
+    def test_digests(self):
+        import hashlib
+        files = list()
+        for i in range(10):
+            f = self.workdir / ("file%i" % i)
+            f.write_bytes(str(i) * (i * 1000))
+            files.append(f)
+        # END for each file
+        reference = dict((f, hashlib.md5(f.bytes()).digest()) for f in files)
+        missing = self.workdir / "missing"
+        
+        cachefile = self.workdir / "digests.cache"
+        for workers in (0, 4):
+            cache = DigestCache(cachefile)
+            # strings are converted
+            results = dict(Path.digests((str(f) for f in files), hashlib.md5, workers, cache))
+            assert results == reference
+            assert len(cache) == len(files)
+            for p in results:
+                assert isinstance(p, Path)
+            
+            # cached results are used, and stored
+            assert dict(Path.digests(files, hashlib.md5, workers, cache)) == reference
+            assert len(cache) == len(files)
+            cache.save()
+            assert len(DigestCache(cachefile)) == len(files)
+            
+            # unknown hash objects are not cached
+            assert dict(Path.digests(files, DigestMock, workers, cache))[files[3]] == 3000
+            
+            # errors
+            self.failUnlessRaises(IOError, list, Path.digests(files + [missing], hashlib.md5, workers))
+            assert dict(Path.digests(files + [missing], hashlib.md5, workers, errors='ignore')) == reference
+            assert dict(Path.digests(files + [missing], hashlib.md5, workers, errors='warn')) == reference
+            cachefile.remove()
+        # END for each worker count
+        
+        # modified files are hashed again
+        cache = DigestCache()
+        assert len(list(Path.digests(files, hashlib.md5, cache=cache))) == len(files)
+        files[1].write_bytes("changed")
+        files[1].setutime((0, 0))
+        assert dict(Path.digests(files[1:2], hashlib.md5, cache=cache))[files[1]] == hashlib.md5("changed").digest()
+        assert len(cache) == len(files) + 1
+        
+        # the digest of a single file
+        assert files[2].digest(hashlib.md5()) == reference[files[2]]
+        
+    def test_walk(self):
+        workdir = self.workdir
+        for dirpath in ('a/aa/aaa', 'a/ab', 'b', 'c/ca/caa/caaa'):
+            (workdir / dirpath).makedirs()
+            for name in ('file.a', 'file.b'):
+                (workdir / dirpath / name).touch()
+        # END create tree
+        
+        # depth first, each directory is returned before its children
+        def walk_reference(path):
+            for child in path.listdir():
+                yield child
+                if child.isdir():
+                    for item in walk_reference(child):
+                        yield item
+            # END for each child
+        # END reference implementation
+        reference = list(walk_reference(workdir))
+        assert len(reference) == 9 + 8     # dirs + files
+        
+        for workers in (0, 4):
+            assert list(workdir.walk(workers=workers)) == reference
+            assert list(workdir.walkfiles('*.b', workers=workers)) == [p for p in reference if p.isfile() and p.ext() == '.b']
+            assert list(workdir.walkdirs(workers=workers)) == [p for p in reference if p.isdir()]
+            
+            # items within the environment variable are preserved
+            envworkdir = Path("$%s" % self.envtmp) / workdir.basename()
+            assert [p.expandvars() for p in envworkdir.walk(workers=workers)] == reference
+            
+            # stopping early is fine
+            walker = workdir.walk(workers=workers)
+            walker.next()
+            walker.close()
+        # END for each amount of workers
+        
+        # the dag interface traverses the same way
+        assert workdir.childrenDeep(order=workdir.kOrder_DepthFirst) == reference
+        bfs = workdir.childrenDeep()
+        assert sorted(bfs) == sorted(reference)
+        assert [len(p.splitall()) for p in bfs] == sorted(len(p.splitall()) for p in reference)
+        assert workdir.childrenDeep(predicate=lambda p: p.isdir()) == [p for p in bfs if p.isdir()]
+        
     def test_separator(self):
         # assert Path.sep == os.path.sep
         
@@ -43,5 +43,111 @@ class TestCase(unittest.TestCase):
             worker.make_assertion()
         # END for each function type
         
+        # waiting until idle drains the output queue
+        for i in range(100):
+            worker.call("fun", i, this='that')
+        # END for each call
+        worker.wait_until_idle()
+        assert worker.inq.empty()
+        
         worker.call('quit')
     
+        
+    def test_thread_pool(self):
+        import threading
+        import time
+        self.failUnlessRaises(ValueError, ThreadPool, 0)
+        pool = ThreadPool(3)
+        assert pool.workers() == 3
+        
+        # results and exceptions
+        future = pool.submit(lambda x, y=1: x + y, 1, y=2)
+        assert future.result() == 3 and future.done() and not future.cancelled()
+        assert future.exception() is None
+        
+        future = pool.submit(lambda: 1 / 0)
+        self.failUnlessRaises(ZeroDivisionError, future.result)
+        assert isinstance(future.exception(), ZeroDivisionError)
+        
+        callbacks = list()
+        future.add_done_callback(callbacks.append)
+        assert callbacks == [future]
+        
+        # map and imap
+        assert list(pool.map(lambda x, y: x * y, range(10), range(10))) == [x * x for x in range(10)]
+        assert sorted(pool.imap_unordered(lambda x: x * 2, range(10))) == range(0, 20, 2)
+        self.failUnlessRaises(ZeroDivisionError, list, pool.map(lambda x: 1 / x, range(3)))
+        
+        # timeouts and cancellation - block all workers
+        block = threading.Event()
+        blocked = [pool.submit(block.wait) for i in range(pool.workers())]
+        pending = pool.submit(lambda: 1)
+        self.failUnlessRaises(TimeoutError, pending.result, 0.05)
+        assert not pending.running()
+        assert pending.cancel() and pending.cancelled() and pending.done()
+        self.failUnlessRaises(CancelledError, pending.result)
+        block.set()
+        for future in blocked:
+            future.result()
+            assert not future.cancel()
+        # END for each blocking future
+        
+        # main thread calls - while waiting, the main thread handles them
+        main = threading.currentThread()
+        assert pool.submit(call_in_main_thread, threading.currentThread).result() is main
+        assert list(pool.imap_unordered(lambda x: call_in_main_thread(threading.currentThread), range(2))) == [main, main]
+        self.failUnlessRaises(ZeroDivisionError, pool.submit(call_in_main_thread, lambda: 1 / 0).result)
+        
+        # interleaved iterators only consume their own results
+        def slow(x):
+            time.sleep(0.01 * x)
+            return call_in_main_thread(lambda: x)
+        pairs = zip(pool.imap_unordered(slow, [1, 2]), pool.imap_unordered(slow, [3, 4]))
+        assert sorted(pairs) == [(1, 3), (2, 4)]
+        
+        # running calls cannot be cancelled, callbacks run once
+        block.clear()
+        started = threading.Event()
+        future = pool.submit(lambda: started.set() or block.wait())
+        started.wait()
+        callbacks = list()
+        future.add_done_callback(callbacks.append)
+        assert not future.cancel() and future.running()
+        block.set()
+        future.result()
+        assert callbacks == [future] and not future.cancelled()
+        
+        # calls may also be processed explicitly
+        future = pool.submit(call_in_main_thread, lambda: 5)
+        while not process_main_thread_calls():
+            time.sleep(0.01)
+        # END wait for call
+        assert future.result() == 5
+        
+        # custom executor
+        calls = list()
+        def executor(func, *args, **kwargs):
+            calls.append(func)
+            return func(*args, **kwargs)
+        set_main_thread_executor(executor)
+        try:
+            assert pool.submit(call_in_main_thread, lambda: 6).result() == 6
+            assert len(calls) == 1
+        finally:
+            set_main_thread_executor(None)
+        # END reset executor
+        
+        # stopping cancels pending calls if requested
+        block.clear()
+        blocked = [pool.submit(block.wait) for i in range(pool.workers())]
+        pending = pool.submit(lambda: 1)
+        threading.Timer(0.05, block.set).start()
+        pool.stop_and_join(cancel_pending=True)
+        assert pending.cancelled()
+        self.failUnlessRaises(RuntimeError, pool.submit, lambda: 1)
+        
+        # without cancellation, all calls are made
+        pool = ThreadPool(1)
+        futures = [pool.submit(lambda x: x, i) for i in range(5)]
+        pool.stop_and_join()
+        assert [f.result() for f in futures] == range(5)
@@ -7,6 +7,8 @@ from mrv.util import *
 from mrv.interface import *
 import re
 import weakref
+import threading
+import networkx as nx
 import mrv.info as info
 
 class TestDAGTree( unittest.TestCase ):
@@ -36,6 +38,38 @@ class TestDAGTree( unittest.TestCase ):
         sequence = [ 0, 0, 1 ]
         self.failUnless( len( filter( Or( bool, lambda x: not bool(x) ), sequence ) ) == 3 )
 
+    def test_traversal( self ):
+        graph = nx.DiGraph()
+        graph.add_edges_from( [ ( 0, 1 ), ( 0, 2 ), ( 1, 3 ), ( 2, 3 ), ( 3, 4 ) ] )
+        successors = lambda i: sorted( graph.successors( i ) )
+        
+        assert list( iterGraph( 0, successors ) ) == [ 0, 1, 2, 3, 4 ]
+        assert list( iterGraph( 0, successors, kTraverseDepthFirst ) ) == [ 0, 1, 3, 4, 2 ]
+        assert list( iterGraph( 0, successors, visit_once = False ) ) == [ 0, 1, 2, 3, 3, 4, 4 ]
+        assert list( iterGraph( 0, successors, depth = 1, ignore_startitem = True ) ) == [ 1, 2 ]
+        assert list( iterGraph( 0, successors, with_depth = True ) )[ -1 ] == ( 3, 4 )
+        assert list( iterGraph( 0, successors, prune = lambda i: i % 2 ) ) == [ 0, 2, 4 ]
+        assert list( iterGraph( 0, successors, stop = lambda i: i == 3 ) ) == [ 0, 1, 2 ]
+        self.failUnlessRaises( ValueError, iterGraph, 0, successors, order = 5 )
+        
+        # the networkx adapter yields the legacy order, last successor first
+        assert list( iterNetworkxGraph( graph, 0, branch_first = False ) ) == [ ( 1, 2 ), ( 2, 3 ), ( 3, 4 ), ( 1, 1 ) ]
+        assert list( iterNetworkxGraph( graph, 0, prune = lambda i, g: i[ 1 ] == 3 ) ) == [ ( 1, 2 ), ( 1, 1 ), ( 3, 4 ) ]
+        
+        # topological order
+        graph.add_edge( 1, 2 )
+        topo = list( iterGraph( 0, successors, kTraverseTopological ) )
+        assert topo == [ 0, 1, 2, 3, 4 ]
+        assert list( iterGraph( 0, successors, kTraverseTopological, depth = 1 ) ) == [ 0, 2, 1 ]
+        
+        graph.add_edge( 4, 1 )
+        self.failUnlessRaises( ValueError, list, iterGraph( 0, successors, kTraverseTopological ) )
+        
+        # collect into existing lists
+        out = [ -1 ]
+        assert collectGraph( 4, successors, out, depth = 0 ) is out and out == [ -1, 4 ]
+        assert collectGraph( 4, successors, depth = 0 ) == [ 4 ]
+
     def test_interfaceBase( self ):
         class IMasterTest( InterfaceMaster ):
             im_provide_on_instance = True
@@ -293,6 +327,169 @@ class TestDAGTree( unittest.TestCase ):
         sender.clearAllEvents()
         assert not sender.estrong._getFunctionSet(sender)
         
+    def test_event_dispatch(self):
+        class Sender(EventSender):
+            e = Event()
+        # END class
+        
+        class Listener(object):
+            def __init__(self):
+                self.calls = list()
+            def __call__(self, *args, **kwargs):
+                self.calls.append((args, kwargs))
+            def method(self, *args):
+                self.calls.append((args, dict()))
+        # END listener
+        
+        sender = Sender()
+        fset = sender.e._getFunctionSet(sender)
+        
+        # dead listeners remove themselves without sending
+        dead = Listener()
+        sender.e = dead
+        sender.e = dead.method
+        assert len(fset) == 2
+        del(dead)
+        assert len(fset) == 0
+        
+        # listeners may remove themselves, new listeners are called next time
+        listener = Listener()
+        def remove_self(*args):
+            sender.e.remove(remove_self)
+            sender.e = listener
+        sender.e = remove_self
+        assert sender.e.send(1)
+        assert not listener.calls and len(fset) == 1
+        sender.e.send(2)
+        assert listener.calls == [((2, ), dict())]
+        
+        # deferral coalesces identical events
+        listener.calls = list()
+        other = Sender()
+        other.e = listener
+        Event.beginDeferral()
+        Event.beginDeferral()
+        assert Event.isDeferring()
+        sender.e.send(1, a=1)
+        sender.e.send(2)
+        sender.e.send(1, a=1)
+        other.e.send(1, a=1)
+        # unhashable arguments
+        sender.e.send([1])
+        sender.e.send([1])
+        assert Event.endDeferral()
+        assert not listener.calls
+        assert Event.endDeferral()
+        assert not Event.isDeferring()
+        assert listener.calls == [((1, ), dict(a=1)), ((2, ), dict()), ((1, ), dict(a=1)), 
+                                  (([1], ), dict()), (([1], ), dict())]
+        self.failUnlessRaises(AssertionError, Event.endDeferral)
+        
+        # immediate delivery again
+        sender.e.send(3)
+        assert listener.calls[-1] == ((3, ), dict())
+        
+        # listeners reraising errors do not lose the remaining deferred events
+        def fail(*args):
+            raise ValueError("failed")
+        failing = Sender()
+        failing.reraise_on_error = True
+        failing.e = fail
+        listener.calls = list()
+        Event.beginDeferral()
+        failing.e.send(4)
+        sender.e.send(5)
+        self.failUnlessRaises(ValueError, Event.endDeferral)
+        assert not Event.isDeferring()
+        assert listener.calls == [((5, ), dict())]
+        
+    def test_event_dispatcher(self):
+        class Listener(object):
+            def __init__(self):
+                self.calls = list()
+                self.threads = set()
+            def __call__(self, *args):
+                self.calls.append(args)
+                self.threads.add(threading.currentThread())
+        # END listener
+        
+        # per event dispatcher, not yet started to control the queue
+        dispatcher = EventDispatcher(maxsize=2, policy=EventDispatcher.kDropOldest)
+        class Sender(EventSender):
+            e = Event(async=dispatcher)
+            sync = Event()
+        # END sender class
+        
+        listener = Listener()
+        sender = Sender()
+        sender.e = listener
+        sender.sync = listener
+        
+        for i in range(3):
+            assert sender.e.send(i)
+        # END for each event
+        assert not listener.calls
+        dispatcher.start()
+        dispatcher.flush()
+        assert listener.calls == [(1, ), (2, )]
+        assert listener.threads == set((dispatcher, ))
+        
+        # synchronous events are still delivered directly
+        sender.sync.send(3)
+        assert listener.calls[-1] == (3, )
+        assert threading.currentThread() in listener.threads
+        dispatcher.stop_and_join()
+        
+        # coalescing
+        listener = Listener()
+        dispatcher = EventDispatcher(policy=EventDispatcher.kCoalesce)
+        class CoalescingSender(EventSender):
+            event_dispatcher = dispatcher
+            e = Event()
+        # END sender class
+        
+        sender = CoalescingSender()
+        sender.e = listener
+        for i in (1, 1, 2, 1, [1], [1]):
+            sender.e.send(i)
+        # END for each event
+        self.failUnlessRaises(RuntimeError, dispatcher.flush)
+        dispatcher.start()
+        dispatcher.flush()
+        assert listener.calls == [(1, ), (2, ), ([1], ), ([1], )]
+        
+        # once delivered, the same event may be sent again
+        sender.e.send(1)
+        dispatcher.flush()
+        assert listener.calls[-1] == (1, ) and len(listener.calls) == 5
+        dispatcher.stop_and_join()
+        
+        # the default dispatcher
+        listener = Listener()
+        class DefaultSender(EventSender):
+            event_dispatcher = True
+            e = Event()
+        # END sender class
+        sender = DefaultSender()
+        sender.e = listener
+        sender.e.send(1)
+        EventDispatcher.default().flush()
+        assert listener.calls == [(1, )] and EventDispatcher.default() in listener.threads
+        
+        # events and senders may explicitly be synchronous
+        class SyncSender(DefaultSender):
+            sync = Event(async=False)
+        # END sender class
+        listener = Listener()
+        sender = SyncSender()
+        sender.sync = listener
+        assert sender.sync.send(2)
+        
+        sender.event_dispatcher = False
+        sender.e = listener
+        sender.e.send(3)
+        assert listener.calls == [(2, ), (3, )] and listener.threads == set((threading.currentThread(), ))
+        
     def test_info(self):
         assert len(info.version) == 5
         major, minor, micro, level, serial = info.version
@@ -4,6 +4,24 @@ __docformat__ = "restructuredtext"
 import threading
 import inspect
 import Queue
+import time
+import sys
+import logging
+log = logging.getLogger("mrv.thread")
+
+__all__ = ("do_terminate_threads", "terminate_threads", "set_main_thread_executor", 
+           "call_in_main_thread", "process_main_thread_calls", "CancelledError", 
+           "TimeoutError", "TerminatableThread", "WorkerThread", "Future", "ThreadPool")
+
+#{ Exceptions
+
+class CancelledError(Exception):
+    """Raised when retrieving the result of a cancelled `Future`"""
+    
+class TimeoutError(Exception):
+    """Raised if a `Future` did not finish in time"""
+
+#} END exceptions
 
 #{ Decorators
 
@@ -42,8 +60,262 @@ def terminate_threads( func ):
 
 #} END decorators
 
+#{ Main Thread Marshalling
+
+# callable( func, *args, **kwargs ) executing func in the main thread and returning 
+# its result, or None to use our own queue
+_main_thread_executor = None
+
+# calls to be made in the main thread, as (future, func, args, kwargs) tuples, 
+# and finished futures waking up the main thread while it waits
+_main_queue = Queue.Queue()
+
+def _in_main_thread():
+    """:return: True if we are called from the main thread"""
+    return isinstance(threading.currentThread(), threading._MainThread)
+
+def set_main_thread_executor(executor):
+    """Set the function used by `call_in_main_thread` to execute functions in the 
+    main thread.
+    
+    :param executor: callable(func, *args, **kwargs) which executes func in the main
+        thread and returns its result, like maya.utils.executeInMainThreadWithResult.
+        If None, calls will be queued until the main thread processes them using 
+        `process_main_thread_calls`, or while it waits for a `Future`"""
+    global _main_thread_executor
+    _main_thread_executor = executor
+    
+def call_in_main_thread(func, *args, **kwargs):
+    """Call func with the given arguments in the main thread and return its result.
+    Exceptions will be reraised in the calling thread.
+    
+    :note: if called from the main thread, func is called directly"""
+    if _in_main_thread():
+        return func(*args, **kwargs)
+    if _main_thread_executor is not None:
+        return _main_thread_executor(func, *args, **kwargs)
+    
+    future = Future()
+    _main_queue.put((future, func, args, kwargs))
+    return future.result()
+    
+def _put_wake_token(future):
+    """Done callback waking up the main thread while it waits"""
+    _main_queue.put(future)
+
+def _process_main_thread_call(item):
+    """Execute the given item of the main queue"""
+    if not isinstance(item, tuple):
+        # wake-up token
+        return False
+    future, func, args, kwargs = item
+    future._run(func, args, kwargs)
+    return True
+
+def process_main_thread_calls():
+    """Execute all calls queued by other threads using `call_in_main_thread`. 
+    It must be called from the main thread, for instance when the application is idle.
+    
+    :return: amount of processed calls"""
+    count = 0
+    while True:
+        try:
+            item = _main_queue.get_nowait()
+        except Queue.Empty:
+            break
+        count += _process_main_thread_call(item)
+    # END for each queued item
+    return count
+
+#} END main thread marshalling
+
 #{ Classes
+
+class Future(object):
+    """Represents the result of a call which is being computed asynchronously.
+    
+    :note: while the main thread waits for a future, it executes calls queued 
+        by `call_in_main_thread`, allowing the computation to call into the main thread"""
+    __slots__ = ('_cond', '_state', '_result', '_exc_info', '_callbacks')
+    kPending, kRunning, kCancelled, kFinished = range(4)
     
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._state = self.kPending
+        self._result = None
+        self._exc_info = None
+        self._callbacks = list()
+        
+    def _finish(self, state, result, exc_info):
+        """Set our final state and run all callbacks"""
+        self._cond.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            callbacks = self._set_done(state)
+        finally:
+            self._cond.release()
+        # END handle lock
+        self._run_callbacks(callbacks)
+        
+    def _set_done(self, state):
+        """Set the given final state and wake up waiting threads, our lock must be held
+        :return: list of callbacks to run once the lock was released"""
+        self._state = state
+        self._cond.notifyAll()
+        callbacks = self._callbacks
+        self._callbacks = list()
+        return callbacks
+        
+    def _run_callbacks(self, callbacks):
+        """Call all the given done callbacks"""
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.error("Callback of future failed", exc_info=True)
+        # END for each callback
+        
+    def _set_running(self):
+        """Mark us running
+        :return: False if we have been cancelled and should not run"""
+        self._cond.acquire()
+        try:
+            if self._state != self.kPending:
+                return False
+            self._state = self.kRunning
+            return True
+        finally:
+            self._cond.release()
+            
+    def _run(self, func, args, kwargs):
+        """Call func and keep its result or exception, unless we have been cancelled"""
+        if not self._set_running():
+            return
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._finish(self.kFinished, None, sys.exc_info())
+        else:
+            self._finish(self.kFinished, result, None)
+        # END handle exceptions
+        
+    def _wait(self, timeout):
+        """Wait until we are done
+        :raise TimeoutError: if we are not done after timeout seconds"""
+        if self.done():
+            return
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        # END compute deadline
+        
+        if _in_main_thread() and _main_thread_executor is None:
+            # handle calls from other threads while waiting, and let us be woken 
+            # up by our callback. Wake-up tokens of other waiters may be dropped, 
+            # as each waiter checks its condition before blocking
+            self.add_done_callback(_put_wake_token)
+            while not self.done():
+                try:
+                    if deadline is None:
+                        item = _main_queue.get()
+                    else:
+                        item = _main_queue.get(True, max(deadline - time.time(), 0))
+                    # END handle timeout
+                except Queue.Empty:
+                    break
+                _process_main_thread_call(item)
+            # END while we are not done
+        else:
+            self._cond.acquire()
+            try:
+                while self._state < self.kCancelled:
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    # END handle timeout
+                # END while not done
+            finally:
+                self._cond.release()
+        # END handle main thread
+        
+        if not self.done():
+            raise TimeoutError("Future did not finish within %f s" % timeout)
+        
+    #{ Interface
+    
+    def cancel(self):
+        """Cancel the call if it did not yet start
+        
+        :return: True if the call was cancelled"""
+        self._cond.acquire()
+        try:
+            if self._state == self.kCancelled:
+                return True
+            if self._state != self.kPending:
+                return False
+            callbacks = self._set_done(self.kCancelled)
+        finally:
+            self._cond.release()
+        self._run_callbacks(callbacks)
+        return True
+        
+    def cancelled(self):
+        """:return: True if the call was cancelled"""
+        return self._state == self.kCancelled
+        
+    def running(self):
+        """:return: True if the call is currently being executed"""
+        return self._state == self.kRunning
+        
+    def done(self):
+        """:return: True if the call finished or was cancelled"""
+        return self._state >= self.kCancelled
+        
+    def result(self, timeout=None):
+        """:return: the return value of the call, waiting for it if required
+        :param timeout: maximum amount of seconds to wait, or None to wait forever
+        :raise CancelledError: if the call was cancelled
+        :raise TimeoutError: if the call did not finish in time
+        :raise Exception: the exception raised by the call"""
+        self._wait(timeout)
+        if self._state == self.kCancelled:
+            raise CancelledError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+        
+    def exception(self, timeout=None):
+        """:return: the exception raised by the call, or None if it succeeded
+        :raise CancelledError: if the call was cancelled
+        :raise TimeoutError: if the call did not finish in time"""
+        self._wait(timeout)
+        if self._state == self.kCancelled:
+            raise CancelledError()
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+        
+    def add_done_callback(self, callback):
+        """Call callback(future) once we are done, or right away if we are done already.
+        
+        :note: the callback runs in the thread finishing the call"""
+        self._cond.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._cond.release()
+        callback(self)
+        
+    #} END interface
+    
+
 class TerminatableThread(threading.Thread):
     """A simple thread able to terminate itself on behalf of the user.
     
@@ -132,6 +404,12 @@ class WorkerThread(TerminatableThread):
     
     class InvalidRoutineError(Exception):
         """Class sent as return value in case of an error"""
+    
+    #{ Configuration
+    # seconds to wait for output at most before checking the input queue again 
+    # in `wait_until_idle`
+    idle_poll_interval = 0.05
+    #} END configuration
         
     def __init__(self, inq = None, outq = None):
         super(WorkerThread, self).__init__()
@@ -155,7 +433,9 @@ class WorkerThread(TerminatableThread):
         results off the output queue."""
         while not self.inq.empty():
             try:
-                self.outq.get(False)
+                # block to let the worker run, the timeout allows to notice tasks 
+                # which do not produce output
+                self.outq.get(True, self.idle_poll_interval)
             except Queue.Empty:
                 continue
         # END while there are tasks on the queue
@@ -203,7 +483,7 @@ class WorkerThread(TerminatableThread):
                     rval = getattr(self, routine)(*args, **kwargs)
                 else:
                     # ignore unknown items
-                    print "%s: task %s was not understood - terminating" % (self.getName(), str(tasktuple))
+                    log.error("%s: task %s was not understood - terminating" % (self.getName(), str(tasktuple)))
                     self.outq.put(self.InvalidRoutineError(routine))
                     break
                 # END make routine call
@@ -211,7 +491,7 @@ class WorkerThread(TerminatableThread):
             except StopIteration:
                 break
             except Exception,e:
-                print "%s: Task %s raised unhandled exception: %s" % (self.getName(), str(tasktuple), str(e))
+                log.error("%s: Task %s raised unhandled exception: %s" % (self.getName(), str(tasktuple), str(e)))
                 self.outq.put(e)
             # END routine exception handling
         # END endless loop
@@ -219,5 +499,140 @@ class WorkerThread(TerminatableThread):
     def quit(self):
         raise StopIteration
     
+
+class _PoolWorker(TerminatableThread):
+    """Thread executing the tasks of a `ThreadPool`"""
+    __slots__ = '_queue'
+    
+    def __init__(self, queue):
+        super(_PoolWorker, self).__init__()
+        self.setDaemon(True)
+        self._queue = queue
+        
+    def run(self):
+        """Execute tasks until we receive None or should terminate"""
+        while not self._should_terminate():
+            task = self._queue.get()
+            if task is None:
+                break
+            future, func, args, kwargs = task
+            future._run(func, args, kwargs)
+        # END for each task
+
+
+class ThreadPool(object):
+    """Executes calls on a fixed amount of threads, returning a `Future` for each call.
+    
+    It can be used as executor for `mrv.dge.EvaluationPlan`.
+    
+    Usage::
+    
+        pool = ThreadPool(4)
+        future = pool.submit(func, arg)
+        result = future.result()
+        results = list(pool.map(func, args))
+        pool.stop_and_join()
+    
+    :note: calls requiring the main thread, like calls into the maya API, should 
+        use `call_in_main_thread`"""
+    __slots__ = ('_queue', '_threads', '_stopped')
+    
+    def __init__(self, workers):
+        """Start the given amount of worker threads"""
+        if workers < 1:
+            raise ValueError("Need at least one worker, got %i" % workers)
+        self._queue = Queue.Queue()
+        self._stopped = False
+        self._threads = [_PoolWorker(self._queue).start() for i in xrange(workers)]
+        
+    #{ Interface
+    
+    def workers(self):
+        """:return: amount of worker threads"""
+        return len(self._threads)
+    
+    def submit(self, func, *args, **kwargs):
+        """Schedule func to be called with the given arguments
+        
+        :return: `Future` providing the result of the call
+        :raise RuntimeError: if the pool was stopped"""
+        if self._stopped:
+            raise RuntimeError("Cannot submit calls to a stopped pool")
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+        
+    def map(self, func, *iterables):
+        """As the builtin map, but calls func concurrently. All calls are submitted 
+        right away.
+        
+        :return: iterator yielding the results in order. Exceptions are reraised
+            when the respective result is retrieved"""
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+        
+    def imap_unordered(self, func, iterable):
+        """Call func with each item of iterable concurrently
+        
+        :return: iterator yielding the results in the order they become available. 
+            Exceptions are reraised when the respective result is retrieved.
+            All calls are submitted right away"""
+        futures = [self.submit(func, item) for item in iterable]
+        finished = Queue.Queue()
+        
+        # in the main thread, we handle its calls while waiting for results
+        in_main_thread = _in_main_thread() and _main_thread_executor is None
+        for future in futures:
+            future.add_done_callback(finished.put)
+            if in_main_thread:
+                future.add_done_callback(_put_wake_token)
+            # END wake up main thread
+        # END for each future
+        return self._iter_finished(len(futures), finished, in_main_thread)
+        
+    def _iter_finished(self, count, finished, in_main_thread):
+        """:return: iterator over the results of count futures, which put 
+            themselves into the finished queue once they are done
+        :param in_main_thread: if True, calls queued for the main thread will be 
+            processed while waiting"""
+        for i in xrange(count):
+            if in_main_thread:
+                while True:
+                    try:
+                        future = finished.get_nowait()
+                        break
+                    except Queue.Empty:
+                        _process_main_thread_call(_main_queue.get())
+                    # END handle empty queue
+                # END while we have no result
+            else:
+                future = finished.get()
+            # END handle main thread
+            yield future.result()
+        # END for each future
+        
+    def stop_and_join(self, cancel_pending=False):
+        """Stop accepting new calls and wait for the worker threads to finish
+        
+        :param cancel_pending: if True, calls which did not yet start will be cancelled,
+            otherwise they will be executed before the workers stop"""
+        self._stopped = True
+        if cancel_pending:
+            while True:
+                try:
+                    task = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                task[0].cancel()
+            # END for each pending task
+        # END cancel pending calls
+        
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        # END for each thread
+        
+    #} END interface
     
 #} END classes
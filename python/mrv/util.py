@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 """All kinds of utility methods and classes that are used in more than one modules """
 import networkx as nx
-from collections import deque as Deque
 import weakref
 import inspect
 import itertools
+import threading
+import Queue
+import atexit
+import sys
 from interface import iDuplicatable
+from thread import WorkerThread
 
 from path import make_path
 
@@ -15,8 +19,9 @@ log = logging.getLogger("mrv.util")
 
 __docformat__ = "restructuredtext"
 __all__ = ("decodeString", "decodeStringOrList", "capitalize", "uncapitalize", 
-    "pythonIndex", "copyClsMembers", "packageClasses", "iterNetworkxGraph", 
-           "Call", "CallAdv", "WeakInstFunction", "Event", "EventSender", 
+    "pythonIndex", "copyClsMembers", "packageClasses", "iterGraph", "collectGraph", "iterNetworkxGraph", 
+           "kTraverseBreadthFirst", "kTraverseDepthFirst", "kTraverseTopological", 
+           "Call", "CallAdv", "WeakInstFunction", "Event", "EventSender", "EventDispatcher", 
            "InterfaceMaster", "Singleton", "CallOnDeletion", 
            "DAGTree", "PipeSeparatedFile", "MetaCopyClsMembers", "And", "Or", 
            "list_submodules", "list_subpackages") 
@@ -144,8 +149,157 @@ def packageClasses(importBase, packageFile, predicate = lambda x: True):
     # import the modules
     return outclasses
 
-def iterNetworkxGraph(graph, startItem, direction = 0, prune = lambda i,g: False,
-                       stop = lambda i,g: False, depth = -1, branch_first=True,
+kTraverseBreadthFirst, kTraverseDepthFirst, kTraverseTopological = range(3)
+_nil = object()         # marks exhausted iterators
+
+def _iterGraphBreadthFirst(start, neighbors, prune, stop, depth, visit_once, ignore_startitem, with_depth):
+    """Level by level traversal, see `iterGraph`"""
+    visited = set()
+    level = [start]
+    d = 0
+    while level:
+        nextlevel = list()
+        expand = depth < 0 or d < depth
+        for item in level:
+            if visit_once:
+                if item in visited:
+                    continue
+                visited.add(item)
+            # END handle visited items
+            
+            oitem = with_depth and (d, item) or item
+            if stop is not None and stop(oitem):
+                continue
+                
+            if (prune is None or not prune(oitem)) and not (ignore_startitem and item == start):
+                yield oitem
+                
+            if expand:
+                nextlevel.extend(neighbors(item))
+        # END for each item on the level
+        level = nextlevel
+        d += 1
+    # END while there are levels
+    
+def _iterGraphDepthFirst(start, neighbors, prune, stop, depth, visit_once, ignore_startitem, with_depth):
+    """Traversal using a stack of neighbor iterators, see `iterGraph`"""
+    visited = set()
+    stack = [iter((start, ))]
+    while stack:
+        item = next(stack[-1], _nil)
+        if item is _nil:
+            stack.pop()
+            continue
+        # END handle exhausted level
+        
+        if visit_once:
+            if item in visited:
+                continue
+            visited.add(item)
+        # END handle visited items
+        
+        d = len(stack) - 1
+        oitem = with_depth and (d, item) or item
+        if stop is not None and stop(oitem):
+            continue
+            
+        if (prune is None or not prune(oitem)) and not (ignore_startitem and item == start):
+            yield oitem
+            
+        if depth < 0 or d < depth:
+            stack.append(iter(neighbors(item)))
+    # END while there are iterators
+    
+def _iterGraphTopological(start, neighbors, prune, stop, depth, visit_once, ignore_startitem, with_depth):
+    """Reverse post-order of a depth first traversal, see `iterGraph`"""
+    if stop is not None and stop(with_depth and (0, start) or start):
+        return
+    
+    visited = set((start, ))
+    path = [start]
+    onpath = set(path)
+    stack = [iter(depth != 0 and neighbors(start) or ())]
+    postorder = list()
+    while stack:
+        item = next(stack[-1], _nil)
+        if item is _nil:
+            stack.pop()
+            item = path.pop()
+            onpath.remove(item)
+            postorder.append((len(path), item))
+            continue
+        # END handle finished item
+        
+        if item in visited:
+            if item in onpath:
+                raise ValueError("Cannot sort items topologically as %r is part of a cycle" % (item, ))
+            continue
+        # END handle visited items
+        visited.add(item)
+        
+        d = len(path)
+        if stop is not None and stop(with_depth and (d, item) or item):
+            continue
+        
+        path.append(item)
+        onpath.add(item)
+        stack.append(iter((depth < 0 or d < depth) and neighbors(item) or ()))
+    # END while there are iterators
+    
+    for d, item in reversed(postorder):
+        if ignore_startitem and d == 0:
+            continue
+        oitem = with_depth and (d, item) or item
+        if prune is None or not prune(oitem):
+            yield oitem
+    # END for each item in topological order
+    
+_graphIterators = { kTraverseBreadthFirst : _iterGraphBreadthFirst, 
+                    kTraverseDepthFirst : _iterGraphDepthFirst, 
+                    kTraverseTopological : _iterGraphTopological }
+
+def iterGraph(start, neighbors, order = kTraverseBreadthFirst, prune = None, stop = None, 
+              depth = -1, visit_once = True, ignore_startitem = False, with_depth = False):
+    """:return: iterator yielding items of a graph reachable from start
+    :param start: item at which to start the traversal, it has depth 0
+    :param neighbors: function returning an iterable of items adjacent to the given item
+    :param order: 
+         * kTraverseBreadthFirst: all items of one depth level are returned before the next level
+         * kTraverseDepthFirst: the neighbors of an item are returned before its next sibling
+         * kTraverseTopological: items are returned before all items reachable from them, 
+           depth is the level at which an item was first found. All items are retrieved
+           before the first one is returned, visit_once is implied. 
+           Raises ValueError if the graph contains a cycle.
+    :param prune: if not None, return True if the item should not be returned. The 
+        traversal continues at pruned items
+    :param stop: if not None, return True if the traversal should not continue at the item. 
+        It will not be returned
+    :param depth: define at which level the iteration should not go deeper, -1 means no limit
+    :param visit_once: if True, items will only be handled once, although they might be 
+        encountered several times. Items must be hashable in that case
+    :param ignore_startitem: if True, the start item will not be returned
+    :param with_depth: if True, pairs of depth, item will be returned and passed to prune and stop
+    :note: passing None for prune and stop skips their calls entirely"""
+    try:
+        iterator = _graphIterators[order]
+    except KeyError:
+        raise ValueError("Invalid traversal order: %r" % order)
+    # END handle order
+    return iterator(start, neighbors, prune, stop, depth, visit_once, ignore_startitem, with_depth)
+    
+def collectGraph(start, neighbors, out = None, **kwargs):
+    """Collect all items of `iterGraph` into a list
+    
+    :return: out, or a new list if it was None
+    :param out: list to append items to, allows to reuse existing lists
+    :param kwargs: passed to `iterGraph`"""
+    if out is None:
+        out = list()
+    out.extend(iterGraph(start, neighbors, **kwargs))
+    return out
+
+def iterNetworkxGraph(graph, startItem, direction = 0, prune = None,
+                       stop = None, depth = -1, branch_first=True,
                        visit_once = True, ignore_startitem=1):
     """:return: iterator yielding pairs of depth, item 
     :param direction: specifies search direction, either :
@@ -164,49 +318,27 @@ def iterNetworkxGraph(graph, startItem, direction = 0, prune = lambda i,g: False
         several times
     :param ignore_startitem: if True, the startItem will be ignored and automatically pruned from
         the result
-    :note: this is an adjusted version of `dge.iterShells`"""
-    visited = set()
-    stack = Deque()
-    stack.append((0 , startItem))       # startitem is always depth level 0
-
-    def addToStack(stack, lst, branch_first, dpth):
-        if branch_first:
-            reviter = ((dpth , lst[i]) for i in range(len(lst)-1,-1,-1))
-            stack.extendleft(reviter)
-        else:
-            stack.extend((dpth,item) for item in lst)
-    # END addToStack local method
-
+    :note: this is an adjusted version of `dge.iterShells`, see `iterGraph` for a generic version"""
     # adjust function to define direction
     directionfunc = graph.successors
     if direction == 1:
         directionfunc = graph.predecessors
-
-    while stack:
-        d, item = stack.pop()           # depth of item, item
-
-        if item in visited:
-            continue
-
-        if visit_once:
-            visited.add(item)
-
-        oitem = (d, item)
-        if stop(oitem, graph):
-            continue
-
-        skipStartItem = ignore_startitem and (item == startItem)
-        if not skipStartItem and not prune(oitem, graph):
-            yield oitem
-
-        # only continue to next level if this is appropriate !
-        nd = d + 1
-        if depth > -1 and nd > depth:
-            continue
-
-        addToStack(stack, directionfunc(item), branch_first, nd)
-    # END for each item on work stack
-
+    
+    if prune is not None:
+        graphprune = prune
+        prune = lambda oitem: graphprune(oitem, graph)
+    if stop is not None:
+        graphstop = stop
+        stop = lambda oitem: graphstop(oitem, graph)
+    # END bind predicates to graph
+    
+    order = kTraverseDepthFirst
+    if branch_first:
+        order = kTraverseBreadthFirst
+    
+    # neighbors are traversed last to first
+    return iterGraph(startItem, lambda item: reversed(directionfunc(item)), order, prune, stop, 
+                     depth, visit_once, ignore_startitem, with_depth=True)
 
 
 class Call(object):
@@ -260,17 +392,30 @@ class WeakInstFunction(object):
     When called, the weakreferenced instance pointer will be retrieved, if possible,
     to finally make the call. If it could not be retrieved, the call
     will do nothing."""
-    __slots__ = ("_weakinst", "_clsfunc")
+    __slots__ = ("_weakinst", "_clsfunc", "_hash", "__weakref__")
 
-    def __init__(self, instancefunction):
-        self._weakinst = weakref.ref(instancefunction.im_self)
+    def __init__(self, instancefunction, callback=None):
+        """
+        :param callback: if not None, it will be called with this instance once
+            the instance of the instancefunction was deleted"""
+        notify = None
+        if callback is not None:
+            wself = weakref.ref(self)
+            def notify(ref):
+                if wself() is not None:
+                    callback(wself())
+            # END notification
+        # END handle callback
+        self._weakinst = weakref.ref(instancefunction.im_self, notify)
         self._clsfunc = instancefunction.im_func
+        # keep the hash, it must not change once our instance is gone
+        self._hash = hash((self._clsfunc, instancefunction.im_self))
 
     def __eq__(self, other):
         return hash(self) == hash(other)
 
     def __hash__(self):
-        return hash((self._clsfunc,  self._weakinst()))
+        return self._hash
 
     def __call__(self, *args, **kwargs):
         """
@@ -283,9 +428,105 @@ class WeakInstFunction(object):
         return self._clsfunc(inst, *args, **kwargs)
 
 
+class _EventFunctionSet(set):
+    """Set of event functions as used by the `Event`. 
+    
+    It keeps a tuple of its functions which is only recreated after the set changed, 
+    allowing listeners to alter the set while an event is being sent.
+    Weakly referenced functions remove themselves once their referent is deleted"""
+    __slots__ = ('_callables', '_finalizer')
+    
+    def __init__(self, *args):
+        set.__init__(self, *args)
+        self._callables = None
+        
+        wself = weakref.ref(self)
+        def finalizer(key):
+            fset = wself()
+            if fset is not None:
+                fset.discard(key)
+        # END finalizer
+        self._finalizer = finalizer
+        
+    def finalizer(self):
+        """:return: callback for weak references or `WeakInstFunction` instances 
+            which removes them from this set once their referent is gone"""
+        return self._finalizer
+        
+    def callables(self):
+        """:return: tuple of (key, isweakref) tuples of all functions in this set"""
+        rval = self._callables
+        if rval is None:
+            rval = self._callables = tuple((key, isinstance(key, weakref.ref)) for key in self)
+        return rval
+        
+    def copy(self):
+        """:return: plain set with our functions"""
+        return set(self)
+        
+    #{ Modification Overrides
+    
+    def add(self, key):
+        self._callables = None
+        set.add(self, key)
+        
+    def remove(self, key):
+        self._callables = None
+        set.remove(self, key)
+        
+    def discard(self, key):
+        self._callables = None
+        set.discard(self, key)
+        
+    def pop(self):
+        self._callables = None
+        return set.pop(self)
+        
+    def clear(self):
+        self._callables = None
+        set.clear(self)
+        
+    def update(self, *args):
+        self._callables = None
+        set.update(self, *args)
+        
+    def difference_update(self, *args):
+        self._callables = None
+        set.difference_update(self, *args)
+        
+    def intersection_update(self, *args):
+        self._callables = None
+        set.intersection_update(self, *args)
+        
+    def symmetric_difference_update(self, other):
+        self._callables = None
+        set.symmetric_difference_update(self, other)
+        
+    def __ior__(self, other):
+        self.update(other)
+        return self
+        
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+        
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+        
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+        
+    #} END modification overrides
+        
+
 class Event(object):
     """Descriptor allowing to easily setup callbacks for classes derived from
-    EventSender"""
+    EventSender
+    
+    Events can be deferred using `beginDeferral` and `endDeferral`. Identical events
+    sent in the meanwhile will only be delivered once."""
     _inst_event_attr = '__events__' # dict with event -> set() relation
     
     #{ Configuration
@@ -300,11 +541,20 @@ class Event(object):
     
     # If not None, this value overrides the corresponding value on the EventSender class
     sender_as_argument = None
+    
+    # If not None, this value overrides the event_dispatcher value on the EventSender class
+    dispatcher = None
     #} END configuration
 
-    # internally used to keep track of the current sender. Is None if no event
-    # is being fired
-    _curSender = None
+    # internally used to keep track of the current sender per thread. Its sender 
+    # attribute is None if no event is being fired
+    _state = threading.local()
+    
+    # amount of nested deferrals, and the events deferred in the meanwhile as 
+    # [(event, inst, args, kwargs), ...], and the keys of all coalesced events
+    _deferLevel = 0
+    _deferred = list()
+    _deferredKeys = set()
 
     def __init__(self, **kwargs):
         """
@@ -314,21 +564,28 @@ class Event(object):
                 references
              * remove_failed: if True, defailt False, failed callback handlers
                 will be removed silently
-             * sender_as_argument - see class member"""
+             * sender_as_argument - see class member
+             * async: if True, the event will be delivered asynchronously by the default 
+                `EventDispatcher`. It may also be an `EventDispatcher` instance to use. 
+                If False, the event will be sent synchronously even if the sender has a
+                dispatcher. See `EventSender.event_dispatcher`"""
         self.use_weakref = kwargs.get("weak", self.__class__.use_weakref)
         self.remove_on_error = kwargs.get("remove_failed", self.__class__.remove_on_error)
         self.sender_as_argument = kwargs.get("sender_as_argument", self.__class__.sender_as_argument)
+        self.dispatcher = kwargs.get("async", self.__class__.dispatcher)
         self._last_inst_ref = None
 
-    def _func_to_key(self, eventfunc):
+    def _func_to_key(self, eventfunc, finalizer=None):
         """
         :return: an eventfunction suitable to be used as key in our instance
-            event set"""
+            event set
+        :param finalizer: if not None, it will be called with the returned key once 
+            a weakly referenced function was deleted"""
         if self.use_weakref:
             if inspect.ismethod(eventfunc):
-                eventfunc = WeakInstFunction(eventfunc)
+                eventfunc = WeakInstFunction(eventfunc, finalizer)
             else:
-                eventfunc = weakref.ref(eventfunc)
+                eventfunc = weakref.ref(eventfunc, finalizer)
             # END instance function special handling
         # END if use weak ref
         return eventfunc
@@ -353,41 +610,39 @@ class Event(object):
 
     def __set__(self, inst, eventfunc):
         """Set a new event to our object"""
-        self._getFunctionSet(inst).add(self._func_to_key(eventfunc))
+        functionset = self._getFunctionSet(inst)
+        functionset.add(self._func_to_key(eventfunc, functionset.finalizer()))
 
     def __get__(self, inst, cls = None):
         """Always return self, but keep the instance in case
         we someone wants to send an event."""
-        if inst is not None:
-            inst = weakref.ref(inst)
+        if inst is None:
+            self._last_inst_ref = None
+        else:
+            ref = self._last_inst_ref
+            if ref is None or ref() is not inst:
+                self._last_inst_ref = weakref.ref(inst)
         # END handle instance
-        self._last_inst_ref = inst  
         return self
         
     def _getFunctionSet(self, inst):
         """:return: function set of the given instance containing functions of our event"""
-        if not hasattr(inst, self._inst_event_attr):
-            setattr(inst, self._inst_event_attr, dict())
-        # END initialize set
+        ed = getattr(inst, self._inst_event_attr, None)
+        if ed is None:
+            ed = dict()
+            setattr(inst, self._inst_event_attr, ed)
+        # END initialize dict
         
-        ed = getattr(inst, self._inst_event_attr)
-        try:
-            return ed[self]
-        except KeyError:
-            return ed.setdefault(self, set())
-        # END handle self -> set relation
-    #{ Interface
-        
-    def send(self, *args, **kwargs):
-        """Send our event using the given args
+        functionset = ed.get(self)
+        if functionset is None:
+            functionset = ed[self] = _EventFunctionSet()
+        return functionset
         
-        :note: if an event listener is weak referenced and goes out of scope
-        :note: will catch all event exceptions trown by the methods called
-        :return: False if at least one event call threw an exception, true otherwise"""
-        inst = self._get_last_instance()
+    def _send(self, inst, args, kwargs):
+        """Deliver our event to all listeners registered on inst, see `send`"""
         callbackset = self._getFunctionSet(inst)
         success = True
-        failed_callbacks = list()
+        failed_callbacks = None
         
         sas = inst.sender_as_argument
         if self.sender_as_argument is not None:
@@ -395,52 +650,156 @@ class Event(object):
         # END event override
         
         # keep the sender
-        Event._curSender = inst
+        state = Event._state
+        state.sender = inst
         
-        # copy the set, allowing callbacks to remove themselves during the callback.
-        # Otherwise we have a size change during the iteration
-        for function in callbackset.copy():
-            try:
-                func = self._key_to_func(function)
+        # the tuple of callables will not change, allowing callbacks to remove 
+        # themselves during the callback.
+        for function, isweak in callbackset.callables():
+            func = function
+            if isweak:
+                func = function()
                 if func is None:
-                    log.warn("Listener for callback of %s was not available anymore" % self)
-                    failed_callbacks.append(function)
+                    # it will remove itself from the set
                     continue
                 # END handle no-func
-
-                try:
-                    if sas:
-                        func(inst, *args, **kwargs)
-                    else:
-                        func(*args, **kwargs)
-                except LookupError, e:
-                    # thrown if self in instance methods went out of scope
-                    if inst.reraise_on_error:
-                        raise 
-                    log.error(str(e), exc_info=True)
-                    failed_callbacks.append(function)
-                # END sendder as argument
+            # END dereference function
+            
+            try:
+                if sas:
+                    func(inst, *args, **kwargs)
+                else:
+                    func(*args, **kwargs)
+            except LookupError, e:
+                # thrown if self in instance methods went out of scope
+                if inst.reraise_on_error:
+                    raise 
+                log.error(str(e), exc_info=True)
+                failed_callbacks = failed_callbacks or list()
+                failed_callbacks.append(function)
             except Exception, e :
                 if self.remove_on_error:
+                    failed_callbacks = failed_callbacks or list()
                     failed_callbacks.append(function)
                 
                 if inst.reraise_on_error:
                     raise 
                 log.error(str(e), exc_info=True)
                 success = False
+            # END handle errors
         # END for each registered event
 
         # remove failed listeners
-        for function in failed_callbacks:
-            try:
-                callbackset.remove(function)
-            except KeyError:
-                pass
-            #end ignore all kinds of possibilities to fail here
-        #end for each failed check
+        if failed_callbacks:
+            for function in failed_callbacks:
+                callbackset.discard(function)
+        # END remove failed listeners
 
-        Event._curSender = None
+        state.sender = None
+        return success
+        
+    #{ Deferral
+    
+    @classmethod
+    def beginDeferral(cls):
+        """Defer all events sent from now on until `endDeferral` is called.
+        Calls may be nested, events will be delivered once the outermost deferral ends.
+        
+        :note: use it around operations which would send bursts of events, like 
+            loading a scene
+        :note: deferral is not thread-safe, use it from one thread only"""
+        Event._deferLevel += 1
+        
+    @classmethod
+    def endDeferral(cls):
+        """End a deferral started with `beginDeferral`. If it is the outermost one, 
+        all deferred events will be sent in the order in which they were sent first. 
+        Events sent to the same instance with equal arguments are delivered only once.
+        
+        :return: False if at least one event call threw an exception, True otherwise
+        :raise AssertionError: if there was no deferral
+        :raise Exception: the first exception reraised by a listener, after all 
+            other deferred events have been delivered"""
+        if not Event._deferLevel:
+            raise AssertionError("endDeferral called without beginDeferral")
+        Event._deferLevel -= 1
+        if Event._deferLevel:
+            return True
+        
+        deferred = Event._deferred
+        Event._deferred = list()
+        Event._deferredKeys = set()
+        
+        success = True
+        exc_info = None
+        for event, inst, args, kwargs in deferred:
+            try:
+                success &= event._dispatch(inst, args, kwargs)
+            except Exception:
+                # the remaining events must not get lost
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+                success = False
+            # END handle reraised errors
+        # END for each deferred event
+        
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
         return success
+    
+    @classmethod
+    def isDeferring(cls):
+        """:return: True if events are currently being deferred"""
+        return Event._deferLevel > 0
+        
+    def _defer(self, inst, args, kwargs):
+        """Keep the given event for delivery once the deferral ends"""
+        try:
+            key = (self, id(inst), args, tuple(sorted(kwargs.items())))
+            if key in Event._deferredKeys:
+                return
+            Event._deferredKeys.add(key)
+        except TypeError:
+            # unhashable arguments cannot be coalesced
+            pass
+        # END handle coalescing
+        Event._deferred.append((self, inst, args, kwargs))
+        
+    #} END deferral
+    
+    def _dispatch(self, inst, args, kwargs):
+        """Send our event, or post it to our dispatcher if we are asynchronous
+        
+        :return: see `send`"""
+        dispatcher = self.dispatcher
+        if dispatcher is None:
+            dispatcher = getattr(inst, 'event_dispatcher', None)
+        if not dispatcher:
+            return self._send(inst, args, kwargs)
+        # END handle dispatcher
+        
+        if dispatcher is True:
+            dispatcher = EventDispatcher.default()
+        dispatcher.post(self, inst, args, kwargs)
+        return True
+        
+    #{ Interface
+        
+    def send(self, *args, **kwargs):
+        """Send our event using the given args
+        
+        :note: if an event listener is weak referenced and goes out of scope
+        :note: will catch all event exceptions trown by the methods called
+        :note: if events are deferred, the event will be sent once the deferral ends
+        :note: if we are asynchronous, the event will be posted to the dispatcher
+        :return: False if at least one event call threw an exception, true otherwise.
+            Deferred or asynchronous events always return True"""
+        inst = self._get_last_instance()
+        if Event._deferLevel:
+            self._defer(inst, args, kwargs)
+            return True
+        # END handle deferral
+        return self._dispatch(inst, args, kwargs)
 
     # Alias, to make event sending even easier
     __call__ = send
@@ -461,6 +820,7 @@ class Event(object):
         inst.use_weakref = self.use_weakref
         inst.remove_on_error = self.remove_on_error
         inst.sender_as_argument = self.sender_as_argument
+        inst.dispatcher = self.dispatcher
         return inst
         
     #} END interface 
@@ -499,6 +859,11 @@ class EventSender(object):
     # if True, exceptions thrown when sending events will be reraised immediately
     # and may stop execution of the event sender as well
     reraise_on_error = False
+    
+    # if not None, events will be delivered asynchronously by the given 
+    # `EventDispatcher`, or by the default one if True. Listeners will be called
+    # from the dispatcher's thread
+    event_dispatcher = None
     #} END configuration
 
     @classmethod
@@ -523,9 +888,146 @@ class EventSender(object):
     def sender(self):
         """:return: instance which sent the event you are currently processing
         :raise ValueError: if no event is currently in progress"""
-        if Event._curSender is None:
+        sender = getattr(Event._state, 'sender', None)
+        if sender is None:
             raise ValueError("Cannot return sender as no event is being sent")
-        return Event._curSender
+        return sender
+    
+
+class _NullQueue(object):
+    """Queue discarding everything put into it"""
+    __slots__ = tuple()
+    
+    def put(self, item, *args):
+        pass
+
+
+class EventDispatcher(WorkerThread):
+    """Thread delivering events in the order they were posted, allowing slow 
+    listeners not to stall the sender.
+    
+    The amount of pending events can be bounded, the policy defines what happens
+    if a new event is posted to a full queue:
+    
+     * kBlock: the sender blocks until there is space in the queue
+     * kDropOldest: the oldest pending event will be dropped
+     * kCoalesce: as kBlock, but events equal to a pending event will not 
+       be queued at all, no matter whether the queue is full or not.
+    
+    Use it with `Event` or `EventSender.event_dispatcher`. It needs to be started
+    before events can be delivered.
+    
+    :note: exceptions raised by listeners are handled like in synchronous mode, 
+        but they cannot be reraised to the sender"""
+    __slots__ = ('policy', '_pending', '_lock')
+    kBlock, kDropOldest, kCoalesce = range(3)
+    
+    _default = None
+    _defaultLock = threading.Lock()
+    
+    def __init__(self, maxsize=0, policy=kBlock):
+        """
+        :param maxsize: maximum amount of pending events, or 0 for no limit
+        :param policy: one of our policy constants"""
+        super(EventDispatcher, self).__init__(Queue.Queue(maxsize), _NullQueue())
+        self.setDaemon(True)
+        self.policy = policy
+        self._pending = set()
+        self._lock = threading.Lock()
+        
+    @classmethod
+    def default(cls):
+        """:return: the default dispatcher, which will be started if necessary"""
+        cls._defaultLock.acquire()
+        try:
+            if EventDispatcher._default is None:
+                EventDispatcher._default = cls().start()
+                atexit.register(EventDispatcher._default._shutdown)
+            return EventDispatcher._default
+        finally:
+            cls._defaultLock.release()
+        # END handle lock
+        
+    def _shutdown(self, timeout=5.0):
+        """Deliver pending events and stop, waiting for at most timeout seconds"""
+        self.inq.put(self.quit)
+        self.join(timeout)
+        
+    def _deliver(self, event, inst, args, kwargs, key):
+        """Called in our thread to send the event"""
+        if key is not None:
+            self._lock.acquire()
+            self._pending.discard(key)
+            self._lock.release()
+        # END handle coalesced events
+        event._send(inst, args, kwargs)
+        
+    def _drop_oldest(self):
+        """Drop the oldest pending event from our queue
+        :return: True if an event was dropped"""
+        queue = self.inq
+        queue.mutex.acquire()
+        try:
+            for task in queue.queue:
+                if isinstance(task, tuple) and task[0] == self._deliver:
+                    queue.queue.remove(task)
+                    key = task[1][-1]
+                    if key is not None:
+                        self._pending.discard(key)
+                    queue.not_full.notify()
+                    return True
+                # END if task is an event
+            # END for each task
+            return False
+        finally:
+            queue.mutex.release()
+        
+    def post(self, event, inst, args, kwargs):
+        """Queue the given event for delivery to the listeners of inst"""
+        key = None
+        if self.policy == self.kCoalesce:
+            try:
+                key = (event, id(inst), args, tuple(sorted(kwargs.items())))
+                self._lock.acquire()
+                try:
+                    if key in self._pending:
+                        return
+                    self._pending.add(key)
+                finally:
+                    self._lock.release()
+            except TypeError:
+                # unhashable arguments cannot be coalesced
+                key = None
+            # END handle coalescing
+        # END coalesce
+        
+        task = (self._deliver, (event, inst, args, kwargs, key))
+        if self.policy == self.kDropOldest:
+            while True:
+                try:
+                    self.inq.put_nowait(task)
+                    return
+                except Queue.Full:
+                    if not self._drop_oldest():
+                        break
+                # END handle full queue
+            # END while task is not queued
+        # END drop oldest
+        self.inq.put(task)
+        
+    def flush(self):
+        """Block until all events posted so far have been delivered
+        
+        :note: if called from within a listener running on our thread, it returns 
+            immediately
+        :raise RuntimeError: if we were not started"""
+        if threading.currentThread() is self:
+            return
+        if not self.isAlive():
+            raise RuntimeError("Cannot flush %r as it is not running" % self)
+        done = threading.Event()
+        self.inq.put((done.set, ))
+        done.wait()
     
 
 class InterfaceMaster(iDuplicatable):